@@ -1,129 +1,117 @@
-from flask import Blueprint, request, jsonify
-import pyodbc
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from datetime import datetime, timedelta
+import csv
+import io
 import os
+import zlib
+
+from database import get_db_connection, db_connection
+from snapshot_cache import SnapshotCache
 
 analytics_bp = Blueprint('analytics', __name__)
 
-def get_db_connection():
-    """Get database connection"""
-    server = os.environ.get('DB_SERVER', 'partnership-sql-server-v2.database.windows.net')
-    database = os.environ.get('DB_DATABASE', 'golden-valley-transit-prod')
-    username = os.environ.get('DB_USERNAME', 'sqladmin')
-    password = os.environ.get('DB_PASSWORD', 'GoldenValley2025')
-    
-    connection_string = (
-        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-        f"SERVER={server};"
-        f"DATABASE={database};"
-        f"UID={username};"
-        f"PWD={password};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=no;"
-        f"Connection Timeout=30;"
-    )
-    
-    return pyodbc.connect(connection_string)
+# Dashboard snapshot: every overview metric in one batch, shared by all viewers
+DASHBOARD_SNAPSHOT_TTL = float(os.environ.get('ANALYTICS_DASHBOARD_TTL', 30))
+DASHBOARD_SNAPSHOT_STALE_TTL = float(os.environ.get('ANALYTICS_DASHBOARD_STALE_TTL', 300))
 
-@analytics_bp.route('/api/analytics/dashboard', methods=['GET'])
-def get_dashboard_metrics():
-    """Get overview dashboard metrics"""
-    try:
-        conn = get_db_connection()
+dashboard_cache = SnapshotCache(
+    ttl=DASHBOARD_SNAPSHOT_TTL,
+    stale_ttl=DASHBOARD_SNAPSHOT_STALE_TTL,
+    name='analytics-dashboard'
+)
+
+# One round trip, three result sets: scalar overview/revenue, claims by status, trips by status
+DASHBOARD_METRICS_SQL = """
+    SELECT
+        (SELECT COUNT(*) FROM operations.trips) as total_trips,
+        (SELECT COUNT(*) FROM operations.trips
+          WHERE scheduled_pickup_time >= CAST(CAST(GETDATE() AS DATE) AS DATETIME)
+            AND scheduled_pickup_time < DATEADD(day, 1, CAST(CAST(GETDATE() AS DATE) AS DATETIME))) as trips_today,
+        (SELECT COUNT(*) FROM medical.patients WHERE status = 'active') as total_patients,
+        drv.total_drivers,
+        drv.available_drivers,
+        rev.total_billed,
+        rev.total_paid,
+        rev.outstanding
+    FROM (
+        SELECT
+            COUNT(*) as total_drivers,
+            COUNT(CASE WHEN d.current_status = 'available'
+                        AND CAST(GETDATE() AS TIME) BETWEEN d.shift_start AND d.shift_end
+                       THEN 1 END) as available_drivers
+        FROM operations.drivers d
+        INNER JOIN security.users u ON d.user_id = u.user_id
+        WHERE u.status = 'active'
+    ) drv
+    CROSS JOIN (
+        SELECT
+            SUM(total_amount) as total_billed,
+            SUM(paid_amount) as total_paid,
+            SUM(total_amount - paid_amount) as outstanding
+        FROM billing.claims
+    ) rev;
+
+    SELECT claim_status, COUNT(*) as count
+    FROM billing.claims
+    GROUP BY claim_status;
+
+    SELECT status, COUNT(*) as count
+    FROM operations.trips
+    GROUP BY status;
+"""
+
+def load_dashboard_snapshot():
+    """Run the batched dashboard query and build the response payload"""
+    with db_connection() as conn:
         cursor = conn.cursor()
-        
-        # Total trips
-        cursor.execute("""
-            SELECT COUNT(*) FROM operations.trips
-        """)
-        total_trips = cursor.fetchone()[0]
-        
-        # Trips today
-        cursor.execute("""
-            SELECT COUNT(*) FROM operations.trips
-            WHERE CAST(scheduled_pickup_time AS DATE) = CAST(GETDATE() AS DATE)
-        """)
-        trips_today = cursor.fetchone()[0]
-        
-        # Total patients
-        cursor.execute("""
-            SELECT COUNT(*) FROM medical.patients
-            WHERE status = 'active'
-        """)
-        total_patients = cursor.fetchone()[0]
-        
-        # Total drivers
-        cursor.execute("""
-            SELECT COUNT(*) FROM operations.drivers d
-            INNER JOIN security.users u ON d.user_id = u.user_id
-            WHERE u.status = 'active'
-        """)
-        total_drivers = cursor.fetchone()[0]
-        
-        # Available drivers now
-        cursor.execute("""
-            SELECT COUNT(*) FROM operations.drivers d
-            INNER JOIN security.users u ON d.user_id = u.user_id
-            WHERE d.current_status = 'available'
-              AND u.status = 'active'
-              AND CAST(GETDATE() AS TIME) BETWEEN d.shift_start AND d.shift_end
-        """)
-        available_drivers = cursor.fetchone()[0]
-        
-        # Revenue metrics
-        cursor.execute("""
-            SELECT 
-                SUM(total_amount) as total_billed,
-                SUM(paid_amount) as total_paid,
-                SUM(total_amount - paid_amount) as outstanding
-            FROM billing.claims
-        """)
-        revenue = cursor.fetchone()
-        
-        # Claims by status
-        cursor.execute("""
-            SELECT 
-                claim_status,
-                COUNT(*) as count
-            FROM billing.claims
-            GROUP BY claim_status
-        """)
+        cursor.execute(DASHBOARD_METRICS_SQL)
+
+        overview = cursor.fetchone()
+
+        cursor.nextset()
         claims_by_status = {}
         for row in cursor.fetchall():
             claims_by_status[row[0]] = row[1]
-        
-        # Trips by status
-        cursor.execute("""
-            SELECT 
-                status,
-                COUNT(*) as count
-            FROM operations.trips
-            GROUP BY status
-        """)
+
+        cursor.nextset()
         trips_by_status = {}
         for row in cursor.fetchall():
             trips_by_status[row[0]] = row[1]
-        
+
         cursor.close()
-        conn.close()
-        
-        return jsonify({
-            'success': True,
-            'overview': {
-                'total_trips': total_trips,
-                'trips_today': trips_today,
-                'total_patients': total_patients,
-                'total_drivers': total_drivers,
-                'available_drivers': available_drivers
-            },
-            'revenue': {
-                'total_billed': float(revenue[0]) if revenue[0] else 0.0,
-                'total_paid': float(revenue[1]) if revenue[1] else 0.0,
-                'outstanding': float(revenue[2]) if revenue[2] else 0.0
-            },
-            'claims_by_status': claims_by_status,
-            'trips_by_status': trips_by_status
-        })
+
+    return {
+        'success': True,
+        'overview': {
+            'total_trips': overview[0],
+            'trips_today': overview[1],
+            'total_patients': overview[2],
+            'total_drivers': overview[3],
+            'available_drivers': overview[4]
+        },
+        'revenue': {
+            'total_billed': float(overview[5]) if overview[5] else 0.0,
+            'total_paid': float(overview[6]) if overview[6] else 0.0,
+            'outstanding': float(overview[7]) if overview[7] else 0.0
+        },
+        'claims_by_status': claims_by_status,
+        'trips_by_status': trips_by_status,
+        'generated_at': datetime.now().isoformat()
+    }
+
+@analytics_bp.route('/api/analytics/dashboard', methods=['GET'])
+def get_dashboard_metrics():
+    """Get overview dashboard metrics (served from the shared snapshot)"""
+    try:
+        if request.args.get('refresh') == '1':
+            dashboard_cache.invalidate('dashboard')
+
+        snapshot = dashboard_cache.get('dashboard', load_dashboard_snapshot)
+        age = dashboard_cache.age('dashboard') or 0.0
+
+        response = jsonify(dict(snapshot, snapshot_age_seconds=round(age, 1)))
+        response.headers['Cache-Control'] = f'private, max-age={int(DASHBOARD_SNAPSHOT_TTL)}'
+        return response
         
     except Exception as e:
         return jsonify({
@@ -429,68 +417,113 @@ def get_patient_analytics():
             'error': str(e)
         }), 500
 
+EXPORT_BATCH_SIZE = int(os.environ.get('ANALYTICS_EXPORT_BATCH_SIZE', 1000))
+
+EXPORT_REPORTS = {
+    'trips': {
+        'header': ['Trip Number', 'Scheduled Time', 'Patient Name', 'Pickup Address',
+                   'Dropoff Address', 'Status', 'Driver'],
+        'sql': """
+            SELECT 
+                t.trip_number,
+                t.scheduled_pickup_time,
+                p.first_name + ' ' + p.last_name as patient_name,
+                t.pickup_address,
+                t.destination_address,
+                t.status,
+                ISNULL(d.first_name + ' ' + d.last_name, 'Unassigned') as driver_name
+            FROM operations.trips t
+            INNER JOIN medical.patients p ON t.patient_id = p.patient_id
+            LEFT JOIN operations.drivers dr ON t.driver_id = dr.driver_id
+            LEFT JOIN security.users d ON dr.user_id = d.user_id
+            WHERE t.scheduled_pickup_time >= DATEADD(day, -?, GETDATE())
+            ORDER BY t.scheduled_pickup_time DESC
+        """
+    },
+    'revenue': {
+        'header': ['Claim Number', 'Service Date', 'Patient Name', 'Insurance',
+                   'Amount Billed', 'Amount Paid', 'Status'],
+        'sql': """
+            SELECT 
+                c.claim_number,
+                c.service_date,
+                p.first_name + ' ' + p.last_name as patient_name,
+                pi.insurance_company,
+                c.total_amount,
+                c.paid_amount,
+                c.claim_status
+            FROM billing.claims c
+            INNER JOIN medical.patients p ON c.patient_id = p.patient_id
+            INNER JOIN medical.patient_insurance pi ON c.insurance_id = pi.insurance_id
+            WHERE c.service_date >= DATEADD(day, -?, GETDATE())
+            ORDER BY c.service_date DESC
+        """
+    }
+}
+
+def stream_csv_rows(conn, cursor, header, compress=False, batch_size=EXPORT_BATCH_SIZE):
+    """Yield CSV chunks one fetchmany() batch at a time, optionally gzip-compressed"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def drain():
+        chunk = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate(0)
+        return compressor.compress(chunk) if compressor else chunk
+
+    try:
+        writer.writerow(header)
+        yield drain()
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.writerows(rows)
+            chunk = drain()
+            if chunk:
+                yield chunk
+
+        if compressor:
+            yield compressor.flush()
+    finally:
+        cursor.close()
+        conn.close()
+
 @analytics_bp.route('/api/analytics/export/csv', methods=['GET'])
 def export_csv():
-    """Export analytics data as CSV"""
+    """Export analytics data as CSV, streamed in batches (add gzip=1 for a .csv.gz)"""
     try:
         report_type = request.args.get('type', 'trips')
         days = int(request.args.get('days', 30))
+        compress = request.args.get('gzip') in ('1', 'true')
+
+        report = EXPORT_REPORTS.get(report_type)
+        if not report:
+            return jsonify({
+                'success': False,
+                'error': f'Unknown report type: {report_type}'
+            }), 400
         
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        if report_type == 'trips':
-            cursor.execute("""
-                SELECT 
-                    t.trip_number,
-                    t.scheduled_pickup_time,
-                    p.first_name + ' ' + p.last_name as patient_name,
-                    t.pickup_address,
-                    t.destination_address,
-                    t.status,
-                    ISNULL(d.first_name + ' ' + d.last_name, 'Unassigned') as driver_name
-                FROM operations.trips t
-                INNER JOIN medical.patients p ON t.patient_id = p.patient_id
-                LEFT JOIN operations.drivers dr ON t.driver_id = dr.driver_id
-                LEFT JOIN security.users d ON dr.user_id = d.user_id
-                WHERE t.scheduled_pickup_time >= DATEADD(day, -?, GETDATE())
-                ORDER BY t.scheduled_pickup_time DESC
-            """, (days,))
-            
-            # Build CSV
-            csv_data = "Trip Number,Scheduled Time,Patient Name,Pickup Address,Dropoff Address,Status,Driver\n"
-            for row in cursor.fetchall():
-                csv_data += f'"{row[0]}","{row[1]}","{row[2]}","{row[3]}","{row[4]}","{row[5]}","{row[6]}"\n'
-            
-        elif report_type == 'revenue':
-            cursor.execute("""
-                SELECT 
-                    c.claim_number,
-                    c.service_date,
-                    p.first_name + ' ' + p.last_name as patient_name,
-                    pi.insurance_company,
-                    c.total_amount,
-                    c.paid_amount,
-                    c.claim_status
-                FROM billing.claims c
-                INNER JOIN medical.patients p ON c.patient_id = p.patient_id
-                INNER JOIN medical.patient_insurance pi ON c.insurance_id = pi.insurance_id
-                WHERE c.service_date >= DATEADD(day, -?, GETDATE())
-                ORDER BY c.service_date DESC
-            """, (days,))
-            
-            csv_data = "Claim Number,Service Date,Patient Name,Insurance,Amount Billed,Amount Paid,Status\n"
-            for row in cursor.fetchall():
-                csv_data += f'"{row[0]}","{row[1]}","{row[2]}","{row[3]}",{row[4]},{row[5]},"{row[6]}"\n'
-        
-        cursor.close()
-        conn.close()
-        
-        return csv_data, 200, {
-            'Content-Type': 'text/csv',
-            'Content-Disposition': f'attachment; filename={report_type}_report.csv'
+        cursor.execute(report['sql'], (days,))
+
+        filename = f'{report_type}_report.csv.gz' if compress else f'{report_type}_report.csv'
+        headers = {
+            'Content-Disposition': f'attachment; filename={filename}',
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'
         }
         
+        return Response(
+            stream_with_context(stream_csv_rows(conn, cursor, report['header'], compress)),
+            mimetype='application/gzip' if compress else 'text/csv',
+            headers=headers
+        )
+        
     except Exception as e:
         return jsonify({
             'success': False,
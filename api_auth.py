@@ -0,0 +1,376 @@
+"""
+API key authentication and per-key rate limiting.
+
+Keys are issued by onboard_tenant.py into organizations.api_keys
+(credigraph-prod) as key_prefix + SHA-256 key_hash.  A request presents the
+raw key in X-API-Key (or Authorization: Bearer ...):
+
+  * the key's SHA-256 digest is looked up in an in-process LRU of verified
+    keys; only a miss goes to the database (by key_prefix, then a constant-
+    time hash comparison), so a warm request costs a hash and a dict lookup
+  * cache entries expire after API_KEY_CACHE_TTL seconds, and a background
+    thread rechecks every cached key against the database every
+    API_KEY_REVALIDATE_SECONDS so revoked keys and deactivated tenants stop
+    working within that window
+  * unknown keys are remembered briefly in a separate, smaller LRU so a
+    client retrying a bad key does not query the database each time
+  * rate_limit_per_hour is enforced with a token bucket per key held in the
+    node-local store, so all gunicorn workers on a host share one bucket;
+    taking a token is a single SQLite upsert
+
+API_AUTH_MODE: off | optional (default; requests without a key pass, bad
+keys are rejected) | required (every path under API_AUTH_PATHS needs a key).
+"""
+
+import hashlib
+import hmac
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pyodbc
+from flask import g, jsonify, request
+
+from database import ConnectionPool
+from local_store import get_store
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+API_AUTH_MODE = os.environ.get('API_AUTH_MODE', 'optional')
+API_AUTH_PATHS = tuple(p for p in os.environ.get('API_AUTH_PATHS', '/api/').split(',') if p)
+API_AUTH_EXEMPT_PATHS = tuple(p for p in os.environ.get('API_AUTH_EXEMPT_PATHS', '').split(',') if p)
+API_AUTH_STORE = os.environ.get('API_AUTH_STORE', 'api_auth')
+API_AUTH_POOL_SIZE = int(os.environ.get('API_AUTH_POOL_SIZE', 2))
+API_KEY_CACHE_SIZE = int(os.environ.get('API_KEY_CACHE_SIZE', 1024))
+API_KEY_CACHE_TTL = float(os.environ.get('API_KEY_CACHE_TTL', 300))
+API_KEY_NEGATIVE_CACHE_SIZE = int(os.environ.get('API_KEY_NEGATIVE_CACHE_SIZE', 256))
+API_KEY_NEGATIVE_TTL = float(os.environ.get('API_KEY_NEGATIVE_TTL', 30))
+API_KEY_REVALIDATE_SECONDS = float(os.environ.get('API_KEY_REVALIDATE_SECONDS', 30))
+
+KEY_PREFIX_LENGTH = 12
+MAX_KEY_LENGTH = 128
+
+BUCKET_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS buckets (
+        key_id      TEXT PRIMARY KEY,
+        tokens      REAL NOT NULL,
+        updated_at  REAL NOT NULL
+    );
+"""
+
+# One statement, so taking a token is atomic across workers.  No row comes
+# back when the bucket is empty.
+TAKE_TOKEN_SQL = """
+    INSERT INTO buckets (key_id, tokens, updated_at) VALUES (:key_id, :capacity - 1, :now)
+    ON CONFLICT (key_id) DO UPDATE SET
+        tokens = MIN(:capacity, tokens + MAX(0, :now - updated_at) * :rate) - 1,
+        updated_at = :now
+    WHERE MIN(:capacity, tokens + MAX(0, :now - updated_at) * :rate) >= 1
+    RETURNING tokens
+"""
+
+
+# ── KEY DATABASE ──────────────────────────────────────────────────────────────
+def build_keys_connection_string():
+    """credigraph-prod, where onboard_tenant.py writes tenants and API keys"""
+    server = os.environ.get('CREDIGRAPH_SERVER',
+                            os.environ.get('DB_SERVER', 'partnership-sql-server-v2.database.windows.net'))
+    database = os.environ.get('CREDIGRAPH_DATABASE', 'credigraph-prod')
+    username = os.environ.get('CREDIGRAPH_USERNAME', os.environ.get('DB_USERNAME', 'sqladmin'))
+    password = os.environ.get('CREDIGRAPH_PASSWORD', os.environ.get('DB_PASSWORD', ''))
+
+    return (
+        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
+        f"SERVER={server};"
+        f"DATABASE={database};"
+        f"UID={username};"
+        f"PWD={password};"
+        f"Encrypt=yes;"
+        f"TrustServerCertificate=no;"
+        f"Connection Timeout=30;"
+    )
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_keys_pool():
+    """This worker's small pool of credigraph connections (pid-aware, like database.get_pool)"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            connection_string = build_keys_connection_string()
+            _pool = ConnectionPool(
+                connect=lambda: pyodbc.connect(connection_string),
+                max_size=API_AUTH_POOL_SIZE,
+            )
+            _pool_pid = pid
+    return _pool
+
+
+def _key_from_row(row):
+    return {
+        'key_id': str(row[0]),
+        'tenant_id': str(row[1]),
+        'key_name': row[2],
+        'permissions': frozenset(p.strip() for p in (row[3] or '').split(',') if p.strip()),
+        'rate_limit_per_hour': int(row[4]) if row[4] else 0
+    }
+
+
+def lookup_key(key_prefix, key_hash):
+    """The active key with this prefix and hash, or None"""
+    with get_keys_pool().acquire() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT k.key_id, k.tenant_id, k.key_name, k.permissions, k.rate_limit_per_hour, k.key_hash
+            FROM organizations.api_keys k
+            INNER JOIN organizations.tenants t ON t.tenant_id = k.tenant_id
+            WHERE k.key_prefix = ? AND k.is_active = 1 AND t.is_active = 1
+        """, key_prefix)
+        rows = cursor.fetchall()
+        cursor.close()
+
+    # Prefixes are short enough to collide, so every candidate is compared
+    for row in rows:
+        if hmac.compare_digest((row[5] or '').lower(), key_hash):
+            return _key_from_row(row)
+    return None
+
+
+def fetch_active_keys(key_ids):
+    """Current settings of whichever of `key_ids` are still active, by key_id"""
+    with get_keys_pool().acquire() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT k.key_id, k.tenant_id, k.key_name, k.permissions, k.rate_limit_per_hour
+            FROM organizations.api_keys k
+            INNER JOIN organizations.tenants t ON t.tenant_id = k.tenant_id
+            INNER JOIN OPENJSON(?) WITH (key_id NVARCHAR(50) '$') j ON k.key_id = j.key_id
+            WHERE k.is_active = 1 AND t.is_active = 1
+        """, json.dumps(list(key_ids)))
+        active = {str(row[0]).lower(): _key_from_row(row) for row in cursor.fetchall()}
+        cursor.close()
+    return active
+
+
+# ── VERIFIED KEY CACHE ────────────────────────────────────────────────────────
+class ApiKeyCache:
+    """LRU of verified keys by SHA-256 digest, with a background revocation check"""
+
+    def __init__(self, lookup=lookup_key, fetch_active=fetch_active_keys, size=API_KEY_CACHE_SIZE,
+                 ttl=API_KEY_CACHE_TTL, negative_size=API_KEY_NEGATIVE_CACHE_SIZE,
+                 negative_ttl=API_KEY_NEGATIVE_TTL, revalidate_seconds=API_KEY_REVALIDATE_SECONDS):
+        self._lookup = lookup
+        self._fetch_active = fetch_active
+        self.size = size
+        self.ttl = ttl
+        self.negative_size = negative_size
+        self.negative_ttl = negative_ttl
+        self.revalidate_seconds = revalidate_seconds
+
+        self._lock = threading.Lock()
+        self._verified = OrderedDict()   # digest -> (key, expires_at)
+        self._rejected = OrderedDict()   # digest -> expires_at
+        self._stopping = threading.Event()
+        self._started_pid = None
+        self._stats = {'hits': 0, 'misses': 0, 'rejected_hits': 0, 'revoked': 0, 'revalidations': 0}
+
+    def verify(self, raw_key):
+        """The key's record if raw_key is a valid active key, else None"""
+        if not raw_key or len(raw_key) <= KEY_PREFIX_LENGTH or len(raw_key) > MAX_KEY_LENGTH:
+            return None
+
+        digest = hashlib.sha256(raw_key.encode()).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._verified.get(digest)
+            if entry is not None and entry[1] > now:
+                self._verified.move_to_end(digest)
+                self._stats['hits'] += 1
+                return entry[0]
+            rejected_until = self._rejected.get(digest)
+            if rejected_until is not None and rejected_until > now:
+                self._stats['rejected_hits'] += 1
+                return None
+            self._stats['misses'] += 1
+
+        key = self._lookup(raw_key[:KEY_PREFIX_LENGTH], digest)
+
+        with self._lock:
+            if key is not None:
+                self._verified[digest] = (key, now + self.ttl)
+                self._verified.move_to_end(digest)
+                self._rejected.pop(digest, None)
+                while len(self._verified) > self.size:
+                    self._verified.popitem(last=False)
+            else:
+                self._rejected[digest] = now + self.negative_ttl
+                self._rejected.move_to_end(digest)
+                while len(self._rejected) > self.negative_size:
+                    self._rejected.popitem(last=False)
+        return key
+
+    def revalidate(self):
+        """Drop cached keys that were revoked and pick up changed limits or permissions"""
+        with self._lock:
+            key_ids = {entry[0]['key_id'].lower() for entry in self._verified.values()}
+        if not key_ids:
+            return 0
+
+        active = self._fetch_active(key_ids)
+
+        revoked = 0
+        with self._lock:
+            for digest, (key, expires_at) in list(self._verified.items()):
+                current = active.get(key['key_id'].lower())
+                if current is None:
+                    del self._verified[digest]
+                    revoked += 1
+                elif current != key:
+                    self._verified[digest] = (current, expires_at)
+            self._stats['revoked'] += revoked
+            self._stats['revalidations'] += 1
+        return revoked
+
+    def invalidate(self):
+        with self._lock:
+            self._verified.clear()
+            self._rejected.clear()
+
+    def _run(self):
+        while not self._stopping.wait(self.revalidate_seconds):
+            try:
+                self.revalidate()
+            except Exception as e:
+                print(f"API key revalidation error: {str(e)}")
+
+    def start(self):
+        pid = os.getpid()
+        if self._started_pid == pid or self.revalidate_seconds <= 0:
+            return
+        self._stopping.clear()
+        threading.Thread(target=self._run, name='api-key-revalidate', daemon=True).start()
+        self._started_pid = pid
+
+    def stop(self):
+        self._stopping.set()
+        self._started_pid = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, cached=len(self._verified), rejected_cached=len(self._rejected))
+
+
+# ── RATE LIMITING ─────────────────────────────────────────────────────────────
+class RateLimiter:
+    """Token bucket per key (capacity = hourly limit), shared through the node-local store"""
+
+    def __init__(self, store=API_AUTH_STORE):
+        self.store = store
+
+    def _db(self):
+        return get_store(self.store, BUCKET_SCHEMA)
+
+    def take(self, key_id, limit_per_hour):
+        """(allowed, remaining, retry_after_seconds) for one request by key_id"""
+        if not limit_per_hour or limit_per_hour <= 0:
+            return True, None, 0
+
+        rate = limit_per_hour / 3600.0
+        now = time.time()
+        db = self._db()
+        row = db.execute(TAKE_TOKEN_SQL, {
+            'key_id': key_id, 'capacity': float(limit_per_hour), 'rate': rate, 'now': now
+        }).fetchone()
+        if row is not None:
+            return True, int(row['tokens']), 0
+
+        current = db.execute('SELECT tokens, updated_at FROM buckets WHERE key_id = ?', (key_id,)).fetchone()
+        tokens = min(limit_per_hour, current['tokens'] + max(0.0, now - current['updated_at']) * rate)
+        return False, 0, max(1, math.ceil((1 - tokens) / rate))
+
+    def reset(self, key_id=None):
+        db = self._db()
+        if key_id is None:
+            db.execute('DELETE FROM buckets')
+        else:
+            db.execute('DELETE FROM buckets WHERE key_id = ?', (key_id,))
+
+
+key_cache = ApiKeyCache()
+rate_limiter = RateLimiter()
+
+
+# ── MIDDLEWARE ────────────────────────────────────────────────────────────────
+def extract_api_key(req):
+    key = req.headers.get('X-API-Key')
+    if key:
+        return key.strip()
+    authorization = req.headers.get('Authorization', '')
+    if authorization[:7].lower() == 'bearer ':
+        return authorization[7:].strip()
+    return None
+
+
+def _is_protected(path):
+    return path.startswith(API_AUTH_PATHS) and not (API_AUTH_EXEMPT_PATHS and path.startswith(API_AUTH_EXEMPT_PATHS))
+
+
+def authenticate_request():
+    """before_request hook: resolves g.api_key and applies the key's rate limit"""
+    g.api_key = None
+    if API_AUTH_MODE == 'off' or request.method == 'OPTIONS' or not _is_protected(request.path):
+        return None
+
+    raw_key = extract_api_key(request)
+    if not raw_key:
+        if API_AUTH_MODE == 'required':
+            return jsonify({'success': False, 'error': 'API key required'}), 401
+        return None
+
+    try:
+        key = key_cache.verify(raw_key)
+    except Exception as e:
+        print(f"API key lookup error: {str(e)}")
+        return jsonify({'success': False, 'error': 'Authentication temporarily unavailable'}), 503
+
+    if key is None:
+        return jsonify({'success': False, 'error': 'Invalid API key'}), 401
+
+    needed = 'read' if request.method in ('GET', 'HEAD') else 'write'
+    if needed not in key['permissions']:
+        return jsonify({'success': False, 'error': f'API key lacks {needed} permission'}), 403
+
+    allowed, remaining, retry_after = rate_limiter.take(key['key_id'], key['rate_limit_per_hour'])
+    g.api_key = key
+    g.api_rate_limit = (key['rate_limit_per_hour'], remaining)
+    if not allowed:
+        response = jsonify({'success': False, 'error': 'Rate limit exceeded', 'retry_after': retry_after})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+    return None
+
+
+def add_rate_limit_headers(response):
+    rate = g.get('api_rate_limit')
+    if rate and rate[1] is not None:
+        response.headers['X-RateLimit-Limit'] = str(rate[0])
+        response.headers['X-RateLimit-Remaining'] = str(rate[1])
+    return response
+
+
+def init_app(app):
+    """Register the authentication hooks and start the revocation check"""
+    app.before_request(authenticate_request)
+    app.after_request(add_rate_limit_headers)
+    if API_AUTH_MODE != 'off':
+        key_cache.start()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Maintained billing aggregates behind /api/billing/stats.
+
+billing.claim_aggregates holds claim count, billed and paid amounts per
+(claim_status, payer_type, service_date).  Every code path that creates or
+changes claims wraps the change in `claims_changing(cursor, claim_ids)`,
+which removes those claims' contribution before the change and adds it back
+after, in the same transaction.  Reading the stats is then a scan of the
+aggregate rows, whose number depends on days of service, not on claims.
+
+reconcile() recomputes the table from billing.claims and reports any drift;
+it runs every BILLING_AGGREGATES_RECONCILE_SECONDS in one worker (an
+application lock keeps the other workers out), from POST
+/api/billing/stats/reconcile, or from the CLI:
+
+    python3 billing_aggregates.py --reconcile
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import date, datetime
+
+from database import db_connection
+
+BILLING_AGGREGATES_RECONCILE_SECONDS = float(os.environ.get('BILLING_AGGREGATES_RECONCILE_SECONDS', 3600))
+AGGREGATE_ID_CHUNK = 1000
+
+# Same mapping as billing_system.payer_type_for(), in T-SQL
+PAYER_TYPE_SQL = """
+    CASE
+        WHEN LOWER(pi.insurance_company) LIKE '%medi-cal%' OR LOWER(pi.insurance_company) LIKE '%medicaid%' THEN 'medi-cal'
+        WHEN LOWER(pi.insurance_company) LIKE '%medicare%' THEN 'medicare'
+        ELSE 'commercial'
+    END
+"""
+
+SCHEMA_SQL = """
+    IF OBJECT_ID('billing.claim_aggregates') IS NULL
+    BEGIN
+        CREATE TABLE billing.claim_aggregates (
+            claim_status  NVARCHAR(50) NOT NULL,
+            payer_type    NVARCHAR(20) NOT NULL,
+            service_date  DATE NOT NULL,
+            claim_count   INT NOT NULL,
+            total_amount  DECIMAL(14, 2) NOT NULL,
+            paid_amount   DECIMAL(14, 2) NOT NULL,
+            updated_at    DATETIME NOT NULL DEFAULT GETDATE(),
+            CONSTRAINT PK_claim_aggregates PRIMARY KEY (claim_status, payer_type, service_date)
+        );
+        SELECT 1;
+    END
+    ELSE
+        SELECT 0;
+"""
+
+# Contribution of a set of claims, grouped to the aggregate grain
+CONTRIBUTION_SQL = f"""
+    SELECT c.claim_status,
+           {PAYER_TYPE_SQL} AS payer_type,
+           COALESCE(CAST(c.service_date AS DATE), '1900-01-01') AS service_date,
+           COUNT(*) AS claim_count,
+           COALESCE(SUM(c.total_amount), 0) AS total_amount,
+           COALESCE(SUM(c.paid_amount), 0) AS paid_amount
+    FROM billing.claims c {{lock}}
+    LEFT JOIN medical.patient_insurance pi ON c.insurance_id = pi.insurance_id
+    {{filter}}
+    GROUP BY c.claim_status, {PAYER_TYPE_SQL}, COALESCE(CAST(c.service_date AS DATE), '1900-01-01')
+"""
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def _scalar(cursor):
+    """First column of the first row set of a batch, skipping row-count-only results
+
+    (SET NOCOUNT ON would do the same, but it sticks to the pooled connection.)
+    """
+    while cursor.description is None:
+        if not cursor.nextset():
+            return None
+    return cursor.fetchone()[0]
+
+
+def ensure_aggregates_table():
+    """Create billing.claim_aggregates on first use, once per process
+
+    Runs on its own connection so it never commits a caller's transaction.  A
+    newly created table is filled by a reconcile in the background; deltas
+    applied meanwhile are superseded by it.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SCHEMA_SQL)
+            created = _scalar(cursor)
+            conn.commit()
+            cursor.close()
+        _schema_ready = True
+    if created:
+        reconciler.run_now()
+
+
+def _apply(cursor, claim_ids, sign):
+    """Add (sign=1) or remove (sign=-1) the current contribution of claim_ids"""
+    ensure_aggregates_table()
+    claim_ids = [str(claim_id) for claim_id in claim_ids if claim_id is not None]
+    for start in range(0, len(claim_ids), AGGREGATE_ID_CHUNK):
+        ids = json.dumps(claim_ids[start:start + AGGREGATE_ID_CHUNK])
+        contribution = CONTRIBUTION_SQL.format(
+            # UPDLOCK holds the claims until commit, so a concurrent change waits for our re-count
+            lock='WITH (UPDLOCK)',
+            filter="INNER JOIN OPENJSON(?) WITH (claim_id NVARCHAR(50) '$') j ON c.claim_id = j.claim_id"
+        )
+        cursor.execute(f"""
+            MERGE billing.claim_aggregates WITH (HOLDLOCK) AS a
+            USING ({contribution}) AS d
+                ON a.claim_status = d.claim_status
+               AND a.payer_type = d.payer_type
+               AND a.service_date = d.service_date
+            WHEN MATCHED THEN UPDATE SET
+                claim_count = a.claim_count + ? * d.claim_count,
+                total_amount = a.total_amount + ? * d.total_amount,
+                paid_amount = a.paid_amount + ? * d.paid_amount,
+                updated_at = GETDATE()
+            WHEN NOT MATCHED BY TARGET THEN
+                INSERT (claim_status, payer_type, service_date, claim_count, total_amount, paid_amount)
+                VALUES (d.claim_status, d.payer_type, d.service_date,
+                        ? * d.claim_count, ? * d.total_amount, ? * d.paid_amount);
+        """, (ids, sign, sign, sign, sign, sign, sign))
+
+
+def add_claims(cursor, claim_ids):
+    _apply(cursor, claim_ids, 1)
+
+
+def remove_claims(cursor, claim_ids):
+    _apply(cursor, claim_ids, -1)
+
+
+class claims_changing:
+    """`with claims_changing(cursor, claim_ids):` re-counts those claims around an update"""
+
+    def __init__(self, cursor, claim_ids):
+        self.cursor = cursor
+        self.claim_ids = list(claim_ids)
+
+    def __enter__(self):
+        remove_claims(self.cursor, self.claim_ids)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # On error the caller rolls back, which undoes the removal as well
+        if exc_type is None:
+            add_claims(self.cursor, self.claim_ids)
+        return False
+
+
+# ── READS ─────────────────────────────────────────────────────────────────────
+def aging_bucket(days):
+    if days <= 30:
+        return '0-30'
+    if days <= 60:
+        return '31-60'
+    if days <= 90:
+        return '61-90'
+    return '90+'
+
+
+def read_stats(cursor, today=None):
+    """stats_by_status, aging_report, by_payer_type and by_service_month from the aggregates"""
+    ensure_aggregates_table()
+    today = today or date.today()
+    cursor.execute("""
+        SELECT claim_status, payer_type, service_date, claim_count, total_amount, paid_amount
+        FROM billing.claim_aggregates
+        WHERE claim_count <> 0
+    """)
+
+    by_status = {}
+    aging = {}
+    by_payer = {}
+    by_month = {}
+    for status, payer_type, service_date, count, total, paid in cursor.fetchall():
+        total = float(total or 0)
+        paid = float(paid or 0)
+
+        bucket = by_status.setdefault(status, {'count': 0, 'total_amount': 0.0, 'paid_amount': 0.0})
+        bucket['count'] += count
+        bucket['total_amount'] += total
+        bucket['paid_amount'] += paid
+
+        bucket = by_payer.setdefault(payer_type, {'count': 0, 'total_amount': 0.0, 'paid_amount': 0.0})
+        bucket['count'] += count
+        bucket['total_amount'] += total
+        bucket['paid_amount'] += paid
+
+        if isinstance(service_date, datetime):
+            service_date = service_date.date()
+        if isinstance(service_date, str):
+            service_date = datetime.strptime(service_date[:10], '%Y-%m-%d').date()
+
+        bucket = by_month.setdefault(service_date.strftime('%Y-%m'), {'count': 0, 'total_amount': 0.0, 'paid_amount': 0.0})
+        bucket['count'] += count
+        bucket['total_amount'] += total
+        bucket['paid_amount'] += paid
+
+        if status not in ('paid', 'denied'):
+            bucket = aging.setdefault(aging_bucket((today - service_date).days), {'count': 0, 'outstanding': 0.0})
+            bucket['count'] += count
+            bucket['outstanding'] += total - paid
+
+    def rounded(groups):
+        for values in groups.values():
+            for key, value in values.items():
+                if isinstance(value, float):
+                    values[key] = round(value, 2)
+        return groups
+
+    return {
+        'stats_by_status': rounded(by_status),
+        'aging_report': rounded(aging),
+        'by_payer_type': rounded(by_payer),
+        'by_service_month': rounded(dict(sorted(by_month.items())))
+    }
+
+
+# ── RECONCILE ─────────────────────────────────────────────────────────────────
+def _rebuild(cursor):
+    """Replace the aggregates with a fresh computation; returns the number of drifted rows"""
+    # Lock the aggregates first: transactions that already applied a delta finish (and
+    # their claim changes become visible) before the recount; later ones wait for it
+    cursor.execute(f"""
+        IF OBJECT_ID('tempdb..#fresh_aggregates') IS NOT NULL DROP TABLE #fresh_aggregates;
+
+        DECLARE @locked INT;
+        SELECT @locked = COUNT(*) FROM billing.claim_aggregates WITH (TABLOCKX, HOLDLOCK);
+
+        SELECT * INTO #fresh_aggregates FROM ({CONTRIBUTION_SQL.format(lock='', filter='')}) fresh;
+
+        SELECT COUNT(*)
+        FROM #fresh_aggregates f
+        FULL OUTER JOIN billing.claim_aggregates a
+            ON a.claim_status = f.claim_status
+           AND a.payer_type = f.payer_type
+           AND a.service_date = f.service_date
+        WHERE COALESCE(a.claim_count, 0) <> COALESCE(f.claim_count, 0)
+           OR COALESCE(a.total_amount, 0) <> COALESCE(f.total_amount, 0)
+           OR COALESCE(a.paid_amount, 0) <> COALESCE(f.paid_amount, 0);
+    """)
+    drift = _scalar(cursor)
+
+    cursor.execute("""
+        DELETE FROM billing.claim_aggregates;
+
+        INSERT INTO billing.claim_aggregates (claim_status, payer_type, service_date, claim_count, total_amount, paid_amount)
+        SELECT claim_status, payer_type, service_date, claim_count, total_amount, paid_amount
+        FROM #fresh_aggregates;
+
+        DROP TABLE #fresh_aggregates;
+    """)
+    return drift
+
+
+def reconcile(conn):
+    """Recompute the aggregates from billing.claims; returns a report, or None if another worker holds the lock"""
+    started = time.monotonic()
+    cursor = conn.cursor()
+    try:
+        ensure_aggregates_table()
+
+        cursor.execute("""
+            DECLARE @result INT;
+            EXEC @result = sp_getapplock @Resource = 'billing_claim_aggregates_reconcile',
+                                         @LockMode = 'Exclusive', @LockOwner = 'Transaction',
+                                         @LockTimeout = 0;
+            SELECT @result;
+        """)
+        if _scalar(cursor) < 0:
+            conn.rollback()
+            return None
+
+        drift = _rebuild(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    if drift:
+        print(f"Billing aggregates reconciled: {drift} rows had drifted")
+    return {
+        'drifted_rows': drift,
+        'duration_ms': round((time.monotonic() - started) * 1000, 1)
+    }
+
+
+class Reconciler:
+    """Background thread that reconciles the aggregates periodically (fork-aware)"""
+
+    def __init__(self, interval=BILLING_AGGREGATES_RECONCILE_SECONDS):
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._started_pid = None
+        self._thread = None
+        self.last_report = None
+
+    def reconcile_once(self):
+        try:
+            with db_connection() as conn:
+                report = reconcile(conn)
+            if report is not None:
+                self.last_report = dict(report, finished_at=datetime.now().isoformat())
+        except Exception as e:
+            print(f"Billing aggregates reconcile error: {str(e)}")
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.reconcile_once()
+
+    def run_now(self):
+        """Reconcile once in a background thread"""
+        threading.Thread(target=self.reconcile_once, name='billing-aggregates-rebuild', daemon=True).start()
+
+    def start(self):
+        pid = os.getpid()
+        if self._started_pid == pid or self.interval <= 0:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='billing-aggregates-reconcile', daemon=True)
+        self._thread.start()
+        self._started_pid = pid
+
+    def stop(self):
+        self._stopping.set()
+        self._started_pid = None
+
+
+reconciler = Reconciler()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain billing.claim_aggregates')
+    parser.add_argument('--reconcile', action='store_true', help='Recompute the aggregates from billing.claims')
+    args = parser.parse_args()
+
+    with db_connection() as conn:
+        if args.reconcile:
+            report = reconcile(conn)
+            if report is None:
+                print("Another reconcile is running; nothing done")
+            else:
+                print(f"Drifted rows : {report['drifted_rows']}")
+                print(f"Duration     : {report['duration_ms']} ms")
+        else:
+            cursor = conn.cursor()
+            print(json.dumps(read_stats(cursor), indent=2))
+            cursor.close()
+
+
+if __name__ == '__main__':
+    main()
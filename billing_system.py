@@ -1,30 +1,14 @@
 from flask import Blueprint, request, jsonify
-import pyodbc
 from datetime import datetime, date
-import os
 import random
 
-billing_bp = Blueprint('billing', __name__)
+from billing_aggregates import add_claims, claims_changing, read_stats, reconcile
+from database import get_db_connection
+from distance_engine import get_distance_engine
+from idempotency import idempotent
+from rate_table import get_rate_table
 
-def get_db_connection():
-    """Get database connection"""
-    server = os.environ.get('DB_SERVER', 'partnership-sql-server-v2.database.windows.net')
-    database = os.environ.get('DB_DATABASE', 'golden-valley-transit-prod')
-    username = os.environ.get('DB_USERNAME', 'sqladmin')
-    password = os.environ.get('DB_PASSWORD', 'GoldenValley2025')
-    
-    connection_string = (
-        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-        f"SERVER={server};"
-        f"DATABASE={database};"
-        f"UID={username};"
-        f"PWD={password};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=no;"
-        f"Connection Timeout=30;"
-    )
-    
-    return pyodbc.connect(connection_string)
+billing_bp = Blueprint('billing', __name__)
 
 def generate_claim_number():
     """Generate unique claim number"""
@@ -32,40 +16,62 @@ def generate_claim_number():
     random_num = random.randint(1000, 9999)
     return f"CLM-{date_str}-{random_num}"
 
+# Claims whose addresses the distance engine cannot place (e.g. outside the Kern
+# County gazetteer) are still created, as 'pending' with 0 miles, for review
+MILEAGE_REVIEW_STATUS = 'pending'
+MILEAGE_REVIEW_NOTE = 'Mileage could not be determined from the trip addresses; review mileage before export'
+MAX_MANUAL_MILEAGE = 1000
+
+def parse_manual_mileage(value):
+    """Mileage override from a request (None if absent); raises ValueError if invalid"""
+    if value is None or value == '':
+        return None
+    try:
+        miles = round(float(value), 2)
+    except (TypeError, ValueError):
+        raise ValueError('mileage must be a number')
+    if not 0 <= miles <= MAX_MANUAL_MILEAGE:
+        raise ValueError(f'mileage must be between 0 and {MAX_MANUAL_MILEAGE}')
+    return miles
+
 def calculate_mileage(pickup_address, dropoff_address):
-    """Calculate mileage between addresses (mock - integrate with Google Maps API later)"""
-    # TODO: Replace with actual Google Maps Distance Matrix API call
-    # For now, return estimated mileage based on address distance
-    return round(random.uniform(3.0, 15.0), 2)
+    """Billable miles between addresses from the offline distance engine, or None if not geocodable"""
+    return get_distance_engine().miles(pickup_address, dropoff_address)
+
+def get_rate_schedule(cursor, payer_type, service_type, service_date=None):
+    """Get the rate schedule in effect on service_date (default today) for payer type and service"""
+    rate_table = get_rate_table()
+    rate_table.ensure_fresh(cursor)
+    return rate_table.lookup(payer_type, service_type, service_date)
 
-def get_rate_schedule(cursor, payer_type, service_type):
-    """Get current rate schedule for payer type and service"""
-    cursor.execute("""
-        SELECT base_rate, per_mile_rate, wait_time_rate, 
-               after_hours_surcharge, weekend_surcharge
-        FROM billing.rate_schedules
-        WHERE payer_type = ? 
-          AND service_type = ?
-          AND is_active = 1
-          AND effective_date <= GETDATE()
-          AND (expiration_date IS NULL OR expiration_date >= GETDATE())
-        ORDER BY effective_date DESC
-    """, (payer_type.lower(), service_type.lower()))
+def payer_type_for(insurance_company):
+    """Map an insurance company name to the payer_type used by rate schedules"""
+    insurance_company = (insurance_company or '').lower()
+    if 'medi-cal' in insurance_company or 'medicaid' in insurance_company:
+        return 'medi-cal'
+    elif 'medicare' in insurance_company:
+        return 'medicare'
+    return 'commercial'
+
+def price_trip(rates, mileage, service_date):
+    """Return (base_charge, mileage_charge, total_amount) for one trip"""
+    base_charge = rates['base_rate']
+    mileage_charge = mileage * rates['per_mile_rate']
+    total_amount = base_charge + mileage_charge
+    
+    # Apply surcharges if applicable
+    if service_date.weekday() >= 5:  # Weekend
+        total_amount += rates['weekend_surcharge']
     
-    result = cursor.fetchone()
-    if result:
-        return {
-            'base_rate': float(result[0]),
-            'per_mile_rate': float(result[1]),
-            'wait_time_rate': float(result[2]),
-            'after_hours_surcharge': float(result[3]) if result[3] else 0.0,
-            'weekend_surcharge': float(result[4]) if result[4] else 0.0
-        }
-    return None
+    return base_charge, mileage_charge, total_amount
 
 @billing_bp.route('/api/billing/generate-claim', methods=['POST'])
+@idempotent('billing.generate-claim')
 def generate_claim():
-    """Auto-generate claim from completed trip"""
+    """Auto-generate claim from completed trip
+    
+    Optional "mileage" overrides the distance engine (e.g. out-of-area trips).
+    """
     try:
         data = request.json
         trip_id = data.get('trip_id')
@@ -76,6 +82,11 @@ def generate_claim():
                 'error': 'trip_id is required'
             }), 400
         
+        try:
+            manual_mileage = parse_manual_mileage(data.get('mileage'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
         conn = get_db_connection()
         cursor = conn.cursor()
         
@@ -128,19 +139,15 @@ def generate_claim():
             }), 400
         
         # Determine payer type from insurance company
-        insurance_company = trip[8].lower()
-        if 'medi-cal' in insurance_company or 'medicaid' in insurance_company:
-            payer_type = 'medi-cal'
-        elif 'medicare' in insurance_company:
-            payer_type = 'medicare'
-        else:
-            payer_type = 'commercial'
+        payer_type = payer_type_for(trip[8])
         
         # For now, assume wheelchair service (can be enhanced to detect from trip details)
         service_type = 'wheelchair'
         
-        # Get rate schedule
-        rates = get_rate_schedule(cursor, payer_type, service_type)
+        service_date = trip[4].date() if trip[4] else date.today()
+        
+        # Get rate schedule in effect on the day of service
+        rates = get_rate_schedule(cursor, payer_type, service_type, service_date)
         
         if not rates:
             cursor.close()
@@ -150,18 +157,21 @@ def generate_claim():
                 'error': f'No rate schedule found for {payer_type} - {service_type}'
             }), 400
         
-        # Calculate mileage
-        mileage = calculate_mileage(trip[2], trip[3])
+        # Calculate mileage; a trip the engine can't place is billed for review rather than refused
+        mileage = manual_mileage if manual_mileage is not None else calculate_mileage(trip[2], trip[3])
+        mileage_review = mileage is None
+        if mileage_review:
+            mileage = 0.0
+        claim_status = MILEAGE_REVIEW_STATUS if mileage_review else 'draft'
+        if mileage_review:
+            history_note = MILEAGE_REVIEW_NOTE
+        elif manual_mileage is not None:
+            history_note = f'Claim auto-generated from completed trip (mileage entered manually: {mileage})'
+        else:
+            history_note = 'Claim auto-generated from completed trip'
         
         # Calculate costs
-        base_charge = rates['base_rate']
-        mileage_charge = mileage * rates['per_mile_rate']
-        total_amount = base_charge + mileage_charge
-        
-        # Apply surcharges if applicable
-        service_date = trip[4].date() if trip[4] else date.today()
-        if service_date.weekday() >= 5:  # Weekend
-            total_amount += rates['weekend_surcharge']
+        base_charge, mileage_charge, total_amount = price_trip(rates, mileage, service_date)
         
         # Generate claim number
         claim_number = generate_claim_number()
@@ -173,10 +183,10 @@ def generate_claim():
                 service_date, claim_status, total_amount, 
                 patient_responsibility, created_at
             ) OUTPUT INSERTED.claim_id
-            VALUES (?, ?, ?, ?, ?, 'draft', ?, ?, GETDATE())
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, GETDATE())
         """, (
             claim_number, trip_id, trip[1], trip[7],
-            service_date, float(total_amount), float(trip[10]) if trip[10] else 0.00
+            service_date, claim_status, float(total_amount), float(trip[10]) if trip[10] else 0.00
         ))
         
         claim_id = cursor.fetchone()[0]
@@ -202,8 +212,10 @@ def generate_claim():
         cursor.execute("""
             INSERT INTO billing.claim_status_history (
                 claim_id, from_status, to_status, notes
-            ) VALUES (?, NULL, 'draft', 'Claim auto-generated from completed trip')
-        """, (claim_id,))
+            ) VALUES (?, NULL, ?, ?)
+        """, (claim_id, claim_status, history_note))
+        
+        add_claims(cursor, [claim_id])
         
         conn.commit()
         cursor.close()
@@ -213,6 +225,8 @@ def generate_claim():
             'success': True,
             'claim_id': str(claim_id),
             'claim_number': claim_number,
+            'claim_status': claim_status,
+            'mileage_review': mileage_review,
             'total_amount': float(total_amount),
             'breakdown': {
                 'base_charge': float(base_charge),
@@ -364,6 +378,7 @@ def get_pending_claims():
         }), 500
 
 @billing_bp.route('/api/billing/submit-claim', methods=['POST'])
+@idempotent('billing.submit-claim')
 def submit_claim():
     """Mark claim as submitted (ready for EDI 837 export)"""
     try:
@@ -380,12 +395,13 @@ def submit_claim():
         cursor = conn.cursor()
         
         # Update claim status
-        cursor.execute("""
-            UPDATE billing.claims
-            SET claim_status = 'submitted',
-                submission_date = GETDATE()
-            WHERE claim_id = ?
-        """, (claim_id,))
+        with claims_changing(cursor, [claim_id]):
+            cursor.execute("""
+                UPDATE billing.claims
+                SET claim_status = 'submitted',
+                    submission_date = GETDATE()
+                WHERE claim_id = ?
+            """, (claim_id,))
         
         # Add status history
         cursor.execute("""
@@ -410,6 +426,7 @@ def submit_claim():
         }), 500
 
 @billing_bp.route('/api/billing/post-payment', methods=['POST'])
+@idempotent('billing.post-payment')
 def post_payment():
     """Post payment to a claim"""
     try:
@@ -448,16 +465,17 @@ def post_payment():
         ))
         
         # Update claim paid amount
-        cursor.execute("""
-            UPDATE billing.claims
-            SET paid_amount = paid_amount + ?,
-                payment_date = ?,
-                claim_status = CASE 
-                    WHEN (paid_amount + ?) >= total_amount THEN 'paid'
-                    ELSE 'partially_paid'
-                END
-            WHERE claim_id = ?
-        """, (payment_amount, data['payment_date'], payment_amount, claim_id))
+        with claims_changing(cursor, [claim_id]):
+            cursor.execute("""
+                UPDATE billing.claims
+                SET paid_amount = paid_amount + ?,
+                    payment_date = ?,
+                    claim_status = CASE 
+                        WHEN (paid_amount + ?) >= total_amount THEN 'paid'
+                        ELSE 'partially_paid'
+                    END
+                WHERE claim_id = ?
+            """, (payment_amount, data['payment_date'], payment_amount, claim_id))
         
         # Add status history
         cursor.execute("""
@@ -484,66 +502,65 @@ def post_payment():
 
 @billing_bp.route('/api/billing/stats', methods=['GET'])
 def get_billing_stats():
-    """Get billing statistics"""
+    """Get billing statistics from the maintained aggregates (no scan of billing.claims)"""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Get counts by status
-        cursor.execute("""
-            SELECT 
-                claim_status,
-                COUNT(*) as count,
-                SUM(total_amount) as total_amount,
-                SUM(paid_amount) as paid_amount
-            FROM billing.claims
-            GROUP BY claim_status
-        """)
+        stats = read_stats(cursor)
         
-        stats = {}
-        for row in cursor.fetchall():
-            stats[row[0]] = {
-                'count': row[1],
-                'total_amount': float(row[2]) if row[2] else 0.0,
-                'paid_amount': float(row[3]) if row[3] else 0.0
-            }
+        cursor.close()
+        conn.close()
         
-        # Get aging report
-        cursor.execute("""
-            SELECT 
-                CASE 
-                    WHEN DATEDIFF(day, service_date, GETDATE()) <= 30 THEN '0-30'
-                    WHEN DATEDIFF(day, service_date, GETDATE()) <= 60 THEN '31-60'
-                    WHEN DATEDIFF(day, service_date, GETDATE()) <= 90 THEN '61-90'
-                    ELSE '90+'
-                END as age_bucket,
-                COUNT(*) as count,
-                SUM(total_amount - paid_amount) as outstanding
-            FROM billing.claims
-            WHERE claim_status NOT IN ('paid', 'denied')
-            GROUP BY 
-                CASE 
-                    WHEN DATEDIFF(day, service_date, GETDATE()) <= 30 THEN '0-30'
-                    WHEN DATEDIFF(day, service_date, GETDATE()) <= 60 THEN '31-60'
-                    WHEN DATEDIFF(day, service_date, GETDATE()) <= 90 THEN '61-90'
-                    ELSE '90+'
-                END
-        """)
+        return jsonify(dict(stats, success=True))
         
-        aging = {}
-        for row in cursor.fetchall():
-            aging[row[0]] = {
-                'count': row[1],
-                'outstanding': float(row[2]) if row[2] else 0.0
-            }
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@billing_bp.route('/api/billing/stats/reconcile', methods=['POST'])
+def reconcile_billing_stats():
+    """Recompute the billing aggregates from billing.claims and report drift"""
+    try:
+        conn = get_db_connection()
+        report = reconcile(conn)
+        conn.close()
+        
+        if report is None:
+            return jsonify({
+                'success': False,
+                'error': 'A reconcile is already running'
+            }), 409
+        
+        return jsonify({
+            'success': True,
+            'report': report
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@billing_bp.route('/api/billing/rates/reload', methods=['POST'])
+def reload_rates():
+    """Reload the in-memory rate table after rate schedules were edited"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        rate_table = get_rate_table()
+        rate_table.reload(cursor)
         
         cursor.close()
         conn.close()
         
         return jsonify({
             'success': True,
-            'stats_by_status': stats,
-            'aging_report': aging
+            'rates': rate_table.stats()
         })
         
     except Exception as e:
@@ -1,41 +1,23 @@
 from flask import Blueprint, request, jsonify
-import pyodbc
-from datetime import datetime
+from datetime import datetime, timedelta
+from werkzeug.security import check_password_hash
+import base64
+import hashlib
+import json
+import os
 import random
 import string
-import os
 
-# Try to import SendGrid - if not available, emails won't send but app will work
-try:
-    from sendgrid import SendGridAPIClient
-    from sendgrid.helpers.mail import Mail
-    SENDGRID_AVAILABLE = True
-except ImportError:
-    SENDGRID_AVAILABLE = False
-    print("SendGrid not installed - email functionality disabled")
+from database import get_db_connection, db_connection
+from driver_availability import get_availability_index, DRIVER_TRIP_BLOCK_MINUTES
+from driver_locator import get_driver_locator
+from email_outbox import enqueue_email
+from idempotency import idempotent
+from live_updates import publish_all, trip_event
+from snapshot_cache import SnapshotCache
 
 booking_bp = Blueprint('booking', __name__)
 
-def get_db_connection():
-    """Get database connection using environment variables"""
-    server = os.environ.get('DB_SERVER', 'partnership-sql-server-v2.database.windows.net')
-    database = os.environ.get('DB_DATABASE', 'golden-valley-transit-prod')
-    username = os.environ.get('DB_USERNAME', 'sqladmin')
-    password = os.environ.get('DB_PASSWORD', 'GoldenValley2025')
-    
-    connection_string = (
-        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-        f"SERVER={server};"
-        f"DATABASE={database};"
-        f"UID={username};"
-        f"PWD={password};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=no;"
-        f"Connection Timeout=30;"
-    )
-    
-    return pyodbc.connect(connection_string)
-
 def generate_mrn():
     """Generate MRN (Medical Record Number)"""
     return f"GVT{random.randint(100000, 999999)}"
@@ -68,43 +50,105 @@ def check_existing_patient(cursor, phone):
     """, (phone,))
     return cursor.fetchone()
 
-def find_available_driver(cursor, pickup_time):
-    """Find best available driver based on schedule and availability"""
-    try:
-        if isinstance(pickup_time, str):
-            time_obj = datetime.strptime(pickup_time, '%Y-%m-%d %H:%M')
-        else:
-            time_obj = pickup_time
-        pickup_time_only = time_obj.strftime('%H:%M:%S')
-    except:
-        pickup_time_only = pickup_time
+def find_available_driver(cursor, pickup_time, pickup_address=None):
+    """Find best available driver based on schedule, availability and existing assignments.
     
-    cursor.execute("""
-        SELECT TOP 1 
-            d.driver_id,
-            u.first_name + ' ' + u.last_name as driver_name,
-            d.performance_rating
-        FROM operations.drivers d
-        INNER JOIN security.users u ON d.user_id = u.user_id
-        WHERE d.current_status = 'available'
-          AND u.status = 'active'
-          AND CAST(? AS TIME) BETWEEN d.shift_start AND d.shift_end
-        ORDER BY 
-            d.performance_rating DESC,
-            d.total_trips_completed DESC
-    """, (pickup_time_only,))
+    For near-term pickups the nearest drivers are scored on ETA, rating and load.
+    """
+    index = get_availability_index()
+    index.ensure_fresh(cursor)
     
-    return cursor.fetchone()
+    ranked = get_driver_locator().rank(index, pickup_address, pickup_time)
+    driver = ranked[0]['driver'] if ranked else index.find(pickup_time)
+    if not driver:
+        return None
+    return (driver.driver_id, driver.name, driver.rating)
 
-def assign_driver_to_trip(cursor, trip_id, driver_id):
-    """Assign driver to trip"""
+def assign_driver_to_trip(cursor, trip_id, driver_id, pickup_time=None, events=None, index_changes=None):
+    """Assign driver to trip unless it would overlap a trip they already have.
+    
+    Returns True if the assignment was made.  A 'trip.assigned' live update is
+    appended to `events` and the availability index change to `index_changes`,
+    for the caller to publish and apply once it has committed.
+    """
     cursor.execute("""
-        UPDATE operations.trips 
+        UPDATE t
         SET driver_id = ?,
             status = 'assigned',
             updated_at = GETDATE()
-        WHERE trip_id = ?
-    """, (driver_id, trip_id))
+        OUTPUT INSERTED.patient_id, INSERTED.pickup_address, INSERTED.scheduled_pickup_time
+        FROM operations.trips t
+        WHERE t.trip_id = ?
+          AND NOT EXISTS (
+              SELECT 1 FROM operations.trips o WITH (UPDLOCK, HOLDLOCK)
+              WHERE o.driver_id = ?
+                AND o.trip_id <> t.trip_id
+                AND o.status NOT IN ('completed', 'cancelled', 'no_show')
+                AND o.scheduled_pickup_time > DATEADD(minute, -?, t.scheduled_pickup_time)
+                AND o.scheduled_pickup_time < DATEADD(minute, ?, t.scheduled_pickup_time)
+          )
+    """, (driver_id, trip_id, driver_id, DRIVER_TRIP_BLOCK_MINUTES, DRIVER_TRIP_BLOCK_MINUTES))
+    
+    row = cursor.fetchone()
+    assigned = row is not None
+    if assigned and events is not None:
+        events.append(trip_event('trip.assigned', trip_id, patient_id=row[0], driver_id=driver_id,
+                                 pickup_address=row[1], pickup_time=row[2], status='assigned'))
+    if assigned and pickup_time is not None and index_changes is not None:
+        index_changes.append(('assign', trip_id, driver_id, pickup_time))
+    return assigned
+
+def dispatch_trip(cursor, trip_id, pickup_time, attempts=3, events=None, pickup_address=None,
+                  index_changes=None):
+    """Reserve the best free driver in the availability index and assign them.
+    
+    With a pickup address, near-term trips go to the best-scored nearby driver
+    (see driver_locator); otherwise the best-rated free one.
+    
+    If the database rejects the assignment (another worker booked that driver
+    first) the index is reloaded and the next best driver is tried.
+    The reservation holds the driver until the caller applies `index_changes`
+    after commit, or invalidates the index if it rolls back.  If the assignment
+    itself raises, the reservation is released before the error propagates.
+    Returns (driver_id, driver_name) or None.
+    """
+    index = get_availability_index()
+    for _ in range(attempts):
+        index.ensure_fresh(cursor)
+        driver = get_driver_locator().reserve(index, pickup_address, pickup_time, trip_id)
+        if not driver:
+            return None
+        try:
+            assigned = assign_driver_to_trip(cursor, trip_id, driver.driver_id, pickup_time,
+                                             events, index_changes)
+        except Exception:
+            # Don't leave the driver blocked by a reservation that was never written
+            index.unassign(trip_id)
+            index.invalidate()
+            raise
+        if assigned:
+            return (driver.driver_id, driver.name)
+        index.unassign(trip_id)
+        index.invalidate()
+    return None
+
+def insurance_terms(insurance_company):
+    """Default coverage terms for a newly entered policy: (effective, expiration, copay, prior_auth)"""
+    effective_date = datetime.now().date()
+    expiration_date = effective_date + timedelta(days=365)
+    
+    insurance_company_lower = insurance_company.lower()
+    if 'medi-cal' in insurance_company_lower or 'medicaid' in insurance_company_lower:
+        prior_auth = False
+        copay = 0.00
+    elif 'medicare' in insurance_company_lower:
+        prior_auth = False
+        copay = 0.00
+    else:
+        prior_auth = True
+        copay = 15.00
+    
+    return effective_date, expiration_date, copay, prior_auth
 
 def validate_business_hours(appointment_time):
     """Validate appointment is within business hours (6 AM - 10 PM)"""
@@ -119,76 +163,64 @@ def validate_business_hours(appointment_time):
     except:
         return False
 
+def render_welcome_email(patient_name, username, temp_password):
+    """Render the subject and HTML body of the new-patient welcome email"""
+    # Use patient name or default
+    display_name = patient_name if patient_name and patient_name.strip() else "Valued Patient"
+    
+    subject = 'Welcome to Golden Valley Transit!'
+    html_content = f'''
+        <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
+            <div style="text-align: center; margin-bottom: 30px;">
+                <h1 style="color: #667eea; margin: 0;">Golden Valley Transit</h1>
+                <p style="color: #718096;">Caring Medical Transportation for the Central Valley</p>
+            </div>
+            
+            <h2 style="color: #2d3748;">Welcome, {display_name}!</h2>
+            <p style="color: #4a5568;">Your patient account has been created successfully.</p>
+            
+            <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 25px; border-radius: 12px; margin: 25px 0; color: white;">
+                <h3 style="margin-top: 0; color: white;">Your Login Credentials</h3>
+                <p style="margin: 10px 0;"><strong>Username:</strong> {username}</p>
+                <p style="margin: 10px 0;"><strong>Temporary Password:</strong> {temp_password}</p>
+            </div>
+            
+            <div style="text-align: center; margin: 30px 0;">
+                <a href="https://gvt-dashboard.azurewebsites.net/patient-portal" 
+                   style="background: #667eea; color: white; padding: 14px 28px; 
+                          text-decoration: none; border-radius: 8px; display: inline-block;
+                          font-weight: bold;">
+                    Access Your Patient Portal
+                </a>
+            </div>
+            
+            <p style="color: #718096; text-align: center;">
+                Questions? Call us at (661) 555-0100
+            </p>
+        </div>
+    '''
+    return subject, html_content
+
 def send_welcome_email(email, patient_name, username, temp_password):
-    """Send welcome email to new patient using SendGrid"""
-    if not SENDGRID_AVAILABLE:
-        print("SendGrid not available - skipping email")
+    """Queue the welcome email for background delivery (see email_outbox)"""
+    if not email:
+        print("No email address provided")
         return False
     
     try:
-        api_key = os.environ.get('SENDGRID_API_KEY')
-        from_email = os.environ.get('SENDGRID_FROM_EMAIL', 'info@goldenvalleytransit.com')
-        
-        if not api_key:
-            print("SendGrid API key not configured")
-            return False
-        
-        if not email:
-            print("No email address provided")
-            return False
-        
-        # Use patient name or default
-        display_name = patient_name if patient_name and patient_name.strip() else "Valued Patient"
-        
-        message = Mail(
-            from_email=from_email,
-            to_emails=email,
-            subject='Welcome to Golden Valley Transit!',
-            html_content=f'''
-                <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
-                    <div style="text-align: center; margin-bottom: 30px;">
-                        <h1 style="color: #667eea; margin: 0;">Golden Valley Transit</h1>
-                        <p style="color: #718096;">Caring Medical Transportation for the Central Valley</p>
-                    </div>
-                    
-                    <h2 style="color: #2d3748;">Welcome, {display_name}!</h2>
-                    <p style="color: #4a5568;">Your patient account has been created successfully.</p>
-                    
-                    <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 25px; border-radius: 12px; margin: 25px 0; color: white;">
-                        <h3 style="margin-top: 0; color: white;">Your Login Credentials</h3>
-                        <p style="margin: 10px 0;"><strong>Username:</strong> {username}</p>
-                        <p style="margin: 10px 0;"><strong>Temporary Password:</strong> {temp_password}</p>
-                    </div>
-                    
-                    <div style="text-align: center; margin: 30px 0;">
-                        <a href="https://gvt-dashboard.azurewebsites.net/patient-portal" 
-                           style="background: #667eea; color: white; padding: 14px 28px; 
-                                  text-decoration: none; border-radius: 8px; display: inline-block;
-                                  font-weight: bold;">
-                            Access Your Patient Portal
-                        </a>
-                    </div>
-                    
-                    <p style="color: #718096; text-align: center;">
-                        Questions? Call us at (661) 555-0100
-                    </p>
-                </div>
-            '''
-        )
-        
-        sg = SendGridAPIClient(api_key)
-        response = sg.send(message)
-        print(f"Welcome email sent to {email}: Status {response.status_code}")
+        subject, html_content = render_welcome_email(patient_name, username, temp_password)
+        enqueue_email('welcome', email, subject, html_content)
         return True
-        
     except Exception as e:
-        print(f"Failed to send welcome email: {str(e)}")
+        print(f"Failed to queue welcome email: {str(e)}")
         return False
 
 
 @booking_bp.route('/api/booking/create', methods=['POST'])
+@idempotent('booking.create')
 def create_booking():
     """Create new trip booking with automatic patient registration"""
+    index_changes = []
     try:
         data = request.json
         
@@ -251,20 +283,7 @@ def create_booking():
             is_new_patient = True
 
         if data.get('insurance_company') and data.get('policy_number'):
-            from datetime import timedelta
-            effective_date = datetime.now().date()
-            expiration_date = effective_date + timedelta(days=365)
-            
-            insurance_company_lower = data['insurance_company'].lower()
-            if 'medi-cal' in insurance_company_lower or 'medicaid' in insurance_company_lower:
-                prior_auth = False
-                copay = 0.00
-            elif 'medicare' in insurance_company_lower:
-                prior_auth = False
-                copay = 0.00
-            else:
-                prior_auth = True
-                copay = 15.00
+            effective_date, expiration_date, copay, prior_auth = insurance_terms(data['insurance_company'])
             
             cursor.execute("""
                 INSERT INTO medical.patient_insurance (
@@ -305,19 +324,24 @@ def create_booking():
         
         trip_id = cursor.fetchone()[0]
         
-        driver_info = find_available_driver(cursor, appointment_datetime)
+        events = [trip_event('trip.created', trip_id, patient_id=patient_id,
+                             pickup_address=data['pickup_address'], pickup_time=appointment_datetime,
+                             status='scheduled', trip_number=trip_number,
+                             dropoff_address=data['dropoff_address'])]
+        driver_info = dispatch_trip(cursor, trip_id, appointment_datetime, events=events,
+                                    pickup_address=data['pickup_address'], index_changes=index_changes)
         driver_assigned = False
         driver_name = None
         
         if driver_info:
-            driver_id = driver_info[0]
             driver_name = driver_info[1]
-            assign_driver_to_trip(cursor, trip_id, driver_id)
             driver_assigned = True
         
         conn.commit()
         cursor.close()
         conn.close()
+        get_availability_index().apply(index_changes)
+        publish_all(events)
         
         response_data = {
             'success': True,
@@ -336,20 +360,167 @@ def create_booking():
             response_data['portal_url'] = 'https://gvt-dashboard.azurewebsites.net/patient-portal'
             
             if data.get('email'):
-                email_sent = send_welcome_email(
+                email_queued = send_welcome_email(
                     data['email'], 
                     data['patient_name'], 
                     username, 
                     temp_password
                 )
-                response_data['email_sent'] = email_sent
+                response_data['email_sent'] = email_queued
+                response_data['email_queued'] = email_queued
             else:
                 response_data['email_sent'] = False
+                response_data['email_queued'] = False
         
         return jsonify(response_data), 201
         
     except Exception as e:
         print(f"Booking error: {str(e)}")
+        if index_changes:
+            # The assigned driver was never committed; free them now and reload on next use
+            index = get_availability_index()
+            for change in index_changes:
+                index.unassign(change[1])
+            index.invalidate()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+TRIP_STATUSES = ('scheduled', 'assigned', 'en_route', 'arrived', 'in_progress',
+                 'completed', 'cancelled', 'no_show')
+
+@booking_bp.route('/api/trips/<trip_id>/status', methods=['POST'])
+def update_trip_status(trip_id):
+    """Update a trip's status (driver app / dispatcher) and push it to live clients"""
+    try:
+        data = request.json or {}
+        status = (data.get('status') or '').strip().lower().replace('-', '_')
+        if status not in TRIP_STATUSES:
+            return jsonify({
+                'success': False,
+                'error': f"status must be one of: {', '.join(TRIP_STATUSES)}"
+            }), 400
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE operations.trips
+            SET status = ?,
+                updated_at = GETDATE()
+            OUTPUT INSERTED.patient_id, INSERTED.driver_id, INSERTED.pickup_address,
+                   INSERTED.scheduled_pickup_time, DELETED.status
+            WHERE trip_id = ?
+        """, (status, trip_id))
+        row = cursor.fetchone()
+        if row is None:
+            conn.rollback()
+            cursor.close()
+            conn.close()
+            return jsonify({'success': False, 'error': 'Trip not found'}), 404
+
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+        # A completed, cancelled or no-show trip no longer blocks the driver's schedule
+        get_availability_index().trip_status_changed(trip_id, status)
+
+        publish_all([trip_event('trip.status', trip_id, patient_id=row[0], driver_id=row[1],
+                                pickup_address=row[2], pickup_time=row[3], status=status,
+                                previous_status=row[4])])
+
+        return jsonify({
+            'success': True,
+            'trip_id': trip_id,
+            'status': status,
+            'previous_status': row[4]
+        })
+
+    except Exception as e:
+        print(f"Trip status error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+DRIVER_STATUSES = ('available', 'break', 'busy', 'offline')
+
+@booking_bp.route('/api/drivers/<driver_id>/status', methods=['POST'])
+def update_driver_status(driver_id):
+    """Update a driver's availability (driver app / dispatcher); only 'available' drivers are dispatched"""
+    try:
+        data = request.json or {}
+        status = (data.get('status') or '').strip().lower()
+        if status not in DRIVER_STATUSES:
+            return jsonify({
+                'success': False,
+                'error': f"status must be one of: {', '.join(DRIVER_STATUSES)}"
+            }), 400
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE operations.drivers
+            SET current_status = ?
+            OUTPUT DELETED.current_status
+            WHERE driver_id = ?
+        """, (status, driver_id))
+        row = cursor.fetchone()
+        if row is None:
+            conn.rollback()
+            cursor.close()
+            conn.close()
+            return jsonify({'success': False, 'error': 'Driver not found'}), 404
+
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+        get_availability_index().driver_status_changed(driver_id, status)
+
+        return jsonify({
+            'success': True,
+            'driver_id': driver_id,
+            'status': status,
+            'previous_status': row[0]
+        })
+
+    except Exception as e:
+        print(f"Driver status error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@booking_bp.route('/api/dispatch/nearest-drivers', methods=['GET'])
+def nearest_drivers():
+    """Nearest free drivers for a pickup, scored for dispatch (?pickup_address=...&pickup_time=...&k=5)"""
+    try:
+        pickup_address = request.args.get('pickup_address', '').strip()
+        pickup_time = request.args.get('pickup_time') or datetime.now()
+        k = min(max(request.args.get('k', 5, type=int), 1), 50)
+        if not pickup_address:
+            return jsonify({'success': False, 'error': 'pickup_address is required'}), 400
+
+        index = get_availability_index()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            index.ensure_fresh(cursor)
+            cursor.close()
+
+        ranked = get_driver_locator().rank(index, pickup_address, pickup_time, k=k) or []
+        return jsonify({
+            'success': True,
+            'drivers': [{
+                'driver_id': str(c['driver'].driver_id),
+                'driver_name': c['driver'].name,
+                'rating': c['driver'].rating,
+                'miles': c['miles'],
+                'eta_minutes': c['eta_minutes'],
+                'trips_that_day': c['load'],
+                'score': c['score']
+            } for c in ranked]
+        })
+
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        print(f"Nearest drivers error: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
@@ -418,22 +589,24 @@ def send_welcome_email_alt():
         except Exception as db_error:
             print(f"Database error (non-fatal): {str(db_error)}")
         
-        # Send welcome email
+        # Queue welcome email (delivered in the background by the outbox workers)
         patient_name = full_name if full_name else "Valued Patient"
-        email_sent = send_welcome_email(email, patient_name, username, temp_password)
+        email_queued = send_welcome_email(email, patient_name, username, temp_password)
         
-        if email_sent:
+        if email_queued:
             return jsonify({
                 'success': True,
-                'message': 'Welcome email sent successfully',
-                'username': username
+                'message': 'Welcome email queued for delivery',
+                'username': username,
+                'email_queued': True
             })
         else:
             return jsonify({
                 'success': True,
-                'message': 'Account created but email could not be sent',
+                'message': 'Account created but email could not be queued',
                 'username': username,
-                'email_sent': False
+                'email_sent': False,
+                'email_queued': False
             })
             
     except Exception as e:
@@ -485,67 +658,204 @@ def patient_login():
         return jsonify({'success': False, 'error': 'Login failed'}), 500
 
 
+@booking_bp.route('/api/driver/login', methods=['POST'])
+def driver_login():
+    """Driver app login; returns the operations.drivers id the app reports GPS and status under
+    
+    Only accounts with a hashed password (werkzeug format) can sign in; a
+    password_hash column still holding plaintext never matches.
+    """
+    try:
+        data = request.json or {}
+        username = data.get('username', '').strip()
+        password = data.get('password', '').strip()
+        
+        if not username or not password:
+            return jsonify({'success': False, 'error': 'Username and password required'}), 400
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT u.user_id, u.first_name, u.last_name, u.password_hash, d.driver_id
+            FROM security.users u
+            INNER JOIN operations.drivers d ON u.user_id = d.user_id
+            WHERE u.username = ? AND u.status = 'active'
+        """, (username,))
+        
+        user = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        
+        # check_password_hash compares digests in constant time
+        if not user or not check_password_hash(user[3] or '', password):
+            return jsonify({'success': False, 'error': 'Invalid username or password'}), 401
+        
+        return jsonify({
+            'success': True,
+            'driver_id': str(user[4]),
+            'driver_name': f"{user[1]} {user[2]}"
+        })
+        
+    except Exception as e:
+        print(f"Driver login error: {str(e)}")
+        return jsonify({'success': False, 'error': 'Login failed'}), 500
+
+
+PATIENT_TRIPS_UPCOMING_LIMIT = 25
+PATIENT_TRIPS_HISTORY_LIMIT = 10
+PATIENT_TRIPS_MAX_LIMIT = 100
+
+# History rows may have no pickup time; they sort (and page) as this sentinel
+NO_PICKUP_TIME = datetime(1900, 1, 1)
+HISTORY_PICKUP_TIME = "COALESCE(t.scheduled_pickup_time, '19000101')"
+
+def encode_cursor(scheduled_pickup_time, trip_id):
+    """Opaque keyset cursor for (scheduled_pickup_time, trip_id); a NULL time encodes as NO_PICKUP_TIME"""
+    raw = json.dumps([(scheduled_pickup_time or NO_PICKUP_TIME).isoformat(), str(trip_id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Inverse of encode_cursor; raises ValueError on a malformed cursor"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        pickup_time, trip_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(pickup_time), trip_id
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def parse_limit(value, default):
+    try:
+        return max(1, min(PATIENT_TRIPS_MAX_LIMIT, int(value)))
+    except (TypeError, ValueError):
+        return default
+
 @booking_bp.route('/api/patient/<patient_id>/trips', methods=['GET'])
 def get_patient_trips(patient_id):
-    """Get patient's upcoming and past trips"""
+    """Get patient's upcoming and past trips (one query, keyset-paginated, ETag-validated)
+    
+    Query params:
+      section          upcoming | history | all (default all)
+      upcoming_limit   page size for upcoming trips (default 25)
+      history_limit    page size for trip history (default 10)
+      upcoming_after   cursor from next_cursor.upcoming
+      history_before   cursor from next_cursor.history
+    """
     try:
+        section = request.args.get('section', 'all')
+        if section not in ('all', 'upcoming', 'history'):
+            return jsonify({'success': False, 'error': 'section must be upcoming, history or all'}), 400
+        
+        upcoming_limit = parse_limit(request.args.get('upcoming_limit'), PATIENT_TRIPS_UPCOMING_LIMIT)
+        history_limit = parse_limit(request.args.get('history_limit'), PATIENT_TRIPS_HISTORY_LIMIT)
+        
+        try:
+            upcoming_after = decode_cursor(request.args['upcoming_after']) if request.args.get('upcoming_after') else None
+            history_before = decode_cursor(request.args['history_before']) if request.args.get('history_before') else None
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        # Each section fetches one extra row to tell whether another page exists
+        parts = []
+        params = []
+        if section in ('all', 'upcoming'):
+            keyset, keyset_params = '', []
+            if upcoming_after:
+                keyset = """
+                      AND (t.scheduled_pickup_time > ?
+                           OR (t.scheduled_pickup_time = ? AND t.trip_id > ?))"""
+                keyset_params = [upcoming_after[0], upcoming_after[0], upcoming_after[1]]
+            parts.append(f"""
+                SELECT * FROM (
+                    SELECT TOP (?) 'upcoming' as section,
+                           ROW_NUMBER() OVER (ORDER BY t.scheduled_pickup_time ASC, t.trip_id ASC) as seq,
+                           t.trip_id, t.trip_number, t.pickup_address, t.destination_address,
+                           t.scheduled_pickup_time, t.status
+                    FROM operations.trips t
+                    WHERE t.patient_id = ? 
+                      AND t.scheduled_pickup_time >= GETDATE()
+                      AND t.status NOT IN ('completed', 'cancelled'){keyset}
+                    ORDER BY t.scheduled_pickup_time ASC, t.trip_id ASC
+                ) upcoming""")
+            params += [upcoming_limit + 1, patient_id] + keyset_params
+        
+        if section in ('all', 'history'):
+            keyset, keyset_params = '', []
+            if history_before:
+                keyset = f"""
+                      AND ({HISTORY_PICKUP_TIME} < ?
+                           OR ({HISTORY_PICKUP_TIME} = ? AND t.trip_id < ?))"""
+                keyset_params = [history_before[0], history_before[0], history_before[1]]
+            parts.append(f"""
+                SELECT * FROM (
+                    SELECT TOP (?) 'history' as section,
+                           ROW_NUMBER() OVER (ORDER BY {HISTORY_PICKUP_TIME} DESC, t.trip_id DESC) as seq,
+                           t.trip_id, t.trip_number, t.pickup_address, t.destination_address,
+                           t.scheduled_pickup_time, t.status
+                    FROM operations.trips t
+                    WHERE t.patient_id = ? 
+                      AND (t.scheduled_pickup_time < GETDATE() OR t.status IN ('completed', 'cancelled')){keyset}
+                    ORDER BY {HISTORY_PICKUP_TIME} DESC, t.trip_id DESC
+                ) history""")
+            params += [history_limit + 1, patient_id] + keyset_params
+        
         conn = get_db_connection()
         cursor = conn.cursor()
+        cursor.execute("\n                UNION ALL".join(parts), params)
+        rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
         
-        # Get upcoming trips
-        cursor.execute("""
-            SELECT t.trip_id, t.trip_number, t.pickup_address, t.destination_address,
-                   t.scheduled_pickup_time, t.status,
-                   'Pending Assignment' as driver_name
-            FROM operations.trips t
-            
-            WHERE t.patient_id = ? 
-              AND t.scheduled_pickup_time >= GETDATE()
-              AND t.status NOT IN ('completed', 'cancelled')
-            ORDER BY t.scheduled_pickup_time ASC
-        """, (patient_id,))
+        sections = {'upcoming': [], 'history': []}
+        for row in rows:
+            sections[row[0]].append(row)
+        # UNION ALL does not preserve each branch's ORDER BY; seq does
+        for section_rows in sections.values():
+            section_rows.sort(key=lambda r: r[1])
+        
+        next_cursor = {'upcoming': None, 'history': None}
+        for name, limit in (('upcoming', upcoming_limit), ('history', history_limit)):
+            if len(sections[name]) > limit:
+                sections[name] = sections[name][:limit]
+                last = sections[name][-1]
+                next_cursor[name] = encode_cursor(last[6], last[2])
         
         upcoming = []
-        for row in cursor.fetchall():
+        for row in sections['upcoming']:
             upcoming.append({
-                'trip_id': str(row[0]),
-                'trip_number': row[1],
-                'pickup_address': row[2],
-                'destination_address': row[3],
-                'scheduled_pickup_time': row[4].isoformat() if row[4] else None,
-                'status': row[5],
-                'driver_name': row[6]
+                'trip_id': str(row[2]),
+                'trip_number': row[3],
+                'pickup_address': row[4],
+                'destination_address': row[5],
+                'scheduled_pickup_time': row[6].isoformat() if row[6] else None,
+                'status': row[7],
+                'driver_name': 'Pending Assignment'
             })
         
-        # Get trip history
-        cursor.execute("""
-            SELECT TOP 10 t.trip_id, t.trip_number, t.pickup_address, t.destination_address,
-                   t.scheduled_pickup_time, t.status
-            FROM operations.trips t
-            WHERE t.patient_id = ? 
-              AND (t.scheduled_pickup_time < GETDATE() OR t.status IN ('completed', 'cancelled'))
-            ORDER BY t.scheduled_pickup_time DESC
-        """, (patient_id,))
-        
         history = []
-        for row in cursor.fetchall():
+        for row in sections['history']:
             history.append({
-                'trip_id': str(row[0]),
-                'trip_number': row[1],
-                'pickup_address': row[2],
-                'destination_address': row[3],
-                'scheduled_pickup_time': row[4].isoformat() if row[4] else None,
-                'status': row[5]
+                'trip_id': str(row[2]),
+                'trip_number': row[3],
+                'pickup_address': row[4],
+                'destination_address': row[5],
+                'scheduled_pickup_time': row[6].isoformat() if row[6] else None,
+                'status': row[7]
             })
         
-        cursor.close()
-        conn.close()
-        
-        return jsonify({
+        payload = {
             'success': True,
-            'upcoming': upcoming,
-            'history': history
-        })
+            'next_cursor': next_cursor
+        }
+        if section in ('all', 'upcoming'):
+            payload['upcoming'] = upcoming
+        if section in ('all', 'history'):
+            payload['history'] = history
+        
+        response = jsonify(payload)
+        response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
         
     except Exception as e:
         print(f"Get trips error: {str(e)}")
@@ -554,54 +864,160 @@ def get_patient_trips(patient_id):
 # ADMIN USER MANAGEMENT API ENDPOINTS
 # ============================================
 
+ADMIN_USERS_PAGE_SIZE = 50
+ADMIN_USERS_MAX_PAGE_SIZE = 200
+
+ADMIN_USERS_SORTS = {
+    'created_at': 'p.created_at',
+    'first_name': 'p.first_name',
+    'last_name': 'p.last_name',
+    'email': 'p.email',
+    'status': 'u.status',
+    'trip_count': 'trip_count'
+}
+
+admin_stats_cache = SnapshotCache(
+    ttl=float(os.environ.get('ADMIN_USER_STATS_TTL', 60)),
+    name='admin-user-stats'
+)
+
+def load_admin_user_stats():
+    """The four user-management header stats in one round trip"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM medical.patients) as total_patients,
+                (SELECT COUNT(*) FROM security.users
+                  WHERE user_type = 'patient' AND status = 'active') as active_accounts,
+                (SELECT COUNT(*) FROM medical.patients
+                  WHERE created_at >= DATEADD(month, -1, GETDATE())) as new_this_month,
+                (SELECT COUNT(*) FROM operations.trips) as total_trips
+        """)
+        row = cursor.fetchone()
+        cursor.close()
+    return {
+        'total_patients': row[0],
+        'active_accounts': row[1],
+        'new_this_month': row[2],
+        'total_trips': row[3]
+    }
+
+def escape_like(value):
+    return value.replace('[', '[[]').replace('%', '[%]').replace('_', '[_]')
+
 @booking_bp.route('/api/admin/users', methods=['GET'])
 def get_admin_users():
-    """Get all patient accounts with stats"""
+    """Get one page of patient accounts with trip counts, plus cached stats
+    
+    Query params: page (1-based), page_size, q (search), status, sort, order (asc|desc)
+    """
     try:
+        try:
+            page = max(1, int(request.args.get('page', 1)))
+            page_size = max(1, min(ADMIN_USERS_MAX_PAGE_SIZE, int(request.args.get('page_size', ADMIN_USERS_PAGE_SIZE))))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'page and page_size must be integers'}), 400
+        
+        sort = request.args.get('sort', 'created_at')
+        if sort not in ADMIN_USERS_SORTS:
+            return jsonify({'success': False, 'error': f'Unsupported sort: {sort}'}), 400
+        order = 'ASC' if request.args.get('order', 'desc').lower() == 'asc' else 'DESC'
+        
+        filters = []
+        params = []
+        search = request.args.get('q', '').strip()
+        if search:
+            pattern = f"%{escape_like(search)}%"
+            filters.append("""(p.first_name LIKE ? OR p.last_name LIKE ? OR p.email LIKE ?
+                     OR p.phone LIKE ? OR u.username LIKE ?)""")
+            params += [pattern] * 5
+        status = request.args.get('status', '').strip()
+        if status:
+            filters.append("u.status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(filters)}" if filters else ''
+        
+        # Trip counts come from one grouped aggregate. Unless the page is sorted
+        # by trip count they are counted per page row with OUTER APPLY, so the
+        # paged search in the CTE is only evaluated once.
+        if sort == 'trip_count':
+            sql = f"""
+                SELECT 
+                    p.patient_id, p.first_name, p.last_name, p.email, p.phone, p.created_at,
+                    u.user_id, u.username, u.status,
+                    ISNULL(tc.trip_count, 0) as trip_count,
+                    COUNT(*) OVER () as total_count
+                FROM medical.patients p
+                LEFT JOIN security.users u ON u.user_id = p.user_id
+                LEFT JOIN (
+                    SELECT patient_id, COUNT(*) as trip_count
+                    FROM operations.trips
+                    GROUP BY patient_id
+                ) tc ON tc.patient_id = p.patient_id
+                {where}
+                ORDER BY trip_count {order}, p.patient_id
+                OFFSET ? ROWS FETCH NEXT ? ROWS ONLY
+            """
+        else:
+            sql = f"""
+                WITH page AS (
+                    SELECT 
+                        p.patient_id, p.first_name, p.last_name, p.email, p.phone, p.created_at,
+                        u.user_id, u.username, u.status,
+                        COUNT(*) OVER () as total_count
+                    FROM medical.patients p
+                    LEFT JOIN security.users u ON u.user_id = p.user_id
+                    {where}
+                    ORDER BY {ADMIN_USERS_SORTS[sort]} {order}, p.patient_id
+                    OFFSET ? ROWS FETCH NEXT ? ROWS ONLY
+                )
+                SELECT 
+                    page.patient_id, page.first_name, page.last_name, page.email, page.phone, page.created_at,
+                    page.user_id, page.username, page.status,
+                    ISNULL(tc.trip_count, 0) as trip_count,
+                    page.total_count
+                FROM page
+                OUTER APPLY (
+                    SELECT COUNT(*) as trip_count
+                    FROM operations.trips t
+                    WHERE t.patient_id = page.patient_id
+                ) tc
+                ORDER BY page.{sort} {order}, page.patient_id
+            """
+        params += [(page - 1) * page_size, page_size]
+        
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                p.patient_id, p.first_name, p.last_name, p.email, p.phone, p.created_at,
-                u.user_id, u.username, u.status,
-                (SELECT COUNT(*) FROM operations.trips t WHERE t.patient_id = p.patient_id) as trip_count
-            FROM medical.patients p
-            LEFT JOIN security.users u ON u.email = p.email AND u.user_type = 'patient'
-            ORDER BY p.created_at DESC
-        """)
+        cursor.execute(sql, params)
         
         columns = [column[0] for column in cursor.description]
         users = []
+        total_count = 0
         for row in cursor.fetchall():
             user_dict = dict(zip(columns, row))
+            total_count = user_dict.pop('total_count')
             if user_dict.get('created_at'):
                 user_dict['created_at'] = user_dict['created_at'].isoformat() if hasattr(user_dict['created_at'], 'isoformat') else str(user_dict['created_at'])
             users.append(user_dict)
         
-        cursor.execute("SELECT COUNT(*) FROM medical.patients")
-        total_patients = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM security.users WHERE user_type = 'patient' AND status = 'active'")
-        active_accounts = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM medical.patients WHERE created_at >= DATEADD(month, -1, GETDATE())")
-        new_this_month = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM operations.trips")
-        total_trips = cursor.fetchone()[0]
-        
+        cursor.close()
         conn.close()
         
+        if not users and page > 1:
+            # Past the last page there is no row to carry the window count
+            total_count = None
+        
         return jsonify({
             'success': True,
             'users': users,
-            'stats': {
-                'total_patients': total_patients,
-                'active_accounts': active_accounts,
-                'new_this_month': new_this_month,
-                'total_trips': total_trips
-            }
+            'pagination': {
+                'page': page,
+                'page_size': page_size,
+                'total': total_count,
+                'total_pages': -(-total_count // page_size) if total_count is not None else None
+            },
+            'stats': admin_stats_cache.get('stats', load_admin_user_stats)
         })
     except Exception as e:
         print(f"Error fetching admin users: {e}")
@@ -643,6 +1059,7 @@ def update_user_status(user_id):
         cursor.execute("UPDATE security.users SET status = ? WHERE user_id = ?", (new_status, user_id))
         conn.commit()
         conn.close()
+        admin_stats_cache.invalidate()
         
         return jsonify({'success': True})
     except Exception as e:
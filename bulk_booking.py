@@ -0,0 +1,495 @@
+"""
+Bulk booking import for facility and broker trip manifests.
+
+POST /api/booking/bulk accepts either a JSON array of trips (or {"trips": [...]})
+or a CSV upload (multipart field "file", or a text/csv body) with the same
+columns as /api/booking/create:
+
+    patient_name, phone, pickup_address, dropoff_address,
+    appointment_date, appointment_time, email, date_of_birth,
+    insurance_company, policy_number
+
+Pipeline:
+  1. every row is validated up front; invalid rows are reported, not imported
+  2. existing patients are resolved by phone with one OPENJSON lookup
+  3. each chunk of BULK_BOOKING_CHUNK_SIZE rows is written in one transaction:
+     new users/patients, insurance and trips are staged with fast_executemany
+     into temp tables and inserted set-based (MERGE ... OUTPUT maps the new
+     ids back to rows)
+  4. drivers are assigned in one pass over the availability index, written
+     with a single guarded UPDATE
+
+?validate_only=1 runs step 1 (and the patient lookup) without writing.
+"""
+
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime
+
+from flask import Blueprint, request, jsonify
+
+from database import get_db_connection
+from booking_routes import (
+    generate_mrn, generate_username, generate_password, generate_trip_number,
+    insurance_terms, send_welcome_email
+)
+from driver_availability import get_availability_index, DRIVER_TRIP_BLOCK_MINUTES
+from live_updates import publish_all, trip_event
+
+bulk_booking_bp = Blueprint('bulk_booking', __name__)
+
+BULK_BOOKING_CHUNK_SIZE = int(os.environ.get('BULK_BOOKING_CHUNK_SIZE', 500))
+BULK_BOOKING_MAX_ROWS = int(os.environ.get('BULK_BOOKING_MAX_ROWS', 5000))
+
+REQUIRED_FIELDS = ['patient_name', 'phone', 'pickup_address',
+                   'dropoff_address', 'appointment_date', 'appointment_time']
+
+
+# ── PARSING & VALIDATION ──────────────────────────────────────────────────────
+def read_manifest():
+    """Return the uploaded rows as a list of dicts (JSON array or CSV)"""
+    upload = request.files.get('file')
+    if upload is not None:
+        text = upload.read().decode('utf-8-sig')
+        return list(csv.DictReader(io.StringIO(text)))
+
+    if request.mimetype == 'text/csv':
+        return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('trips')
+    if not isinstance(data, list):
+        raise ValueError('Expected a JSON array of trips or a CSV upload')
+    return data
+
+
+def validate_row(row):
+    """Return (clean_row, error) for one manifest row"""
+    if not isinstance(row, dict):
+        return None, 'Row must be an object'
+
+    clean = {k: (str(v).strip() if v is not None else '') for k, v in row.items()}
+    for field in REQUIRED_FIELDS:
+        if not clean.get(field):
+            return None, f'Missing required field: {field}'
+
+    try:
+        pickup = datetime.strptime(f"{clean['appointment_date']} {clean['appointment_time']}", '%Y-%m-%d %H:%M')
+    except ValueError:
+        return None, 'appointment_date/appointment_time must be YYYY-MM-DD and HH:MM'
+
+    if not 6 <= pickup.hour < 22:
+        return None, 'Appointments must be between 6:00 AM and 10:00 PM'
+
+    clean['pickup_time'] = pickup
+    return clean, None
+
+
+# ── DATABASE STEPS ────────────────────────────────────────────────────────────
+def lookup_patients_by_phone(cursor, phones):
+    """One set-based lookup: phone -> (patient_id, user_id) for existing patients"""
+    if not phones:
+        return {}
+    cursor.execute("""
+        SELECT p.phone, p.patient_id, p.user_id
+        FROM medical.patients p
+        INNER JOIN OPENJSON(?) WITH (phone NVARCHAR(50) '$') j ON p.phone = j.phone
+    """, (json.dumps(sorted(phones)),))
+
+    found = {}
+    for phone, patient_id, user_id in cursor.fetchall():
+        found.setdefault(phone, (patient_id, user_id))
+    return found
+
+
+def create_patients(cursor, new_patients):
+    """Insert users and patients for rows whose phone is not on file.
+
+    new_patients: list of dicts (one per distinct phone).
+    Returns phone -> (patient_id, user_id).
+    """
+    # Temp tables are typed from the real tables; the CROSS JOIN stops
+    # SELECT INTO from copying IDENTITY properties onto the staging columns.
+    cursor.execute("""
+        IF OBJECT_ID('tempdb..#bulk_patients') IS NOT NULL DROP TABLE #bulk_patients;
+        IF OBJECT_ID('tempdb..#bulk_user_ids') IS NOT NULL DROP TABLE #bulk_user_ids;
+
+        SELECT TOP 0 CAST(0 AS INT) AS row_key,
+               u.username, u.password_hash, u.email, u.phone, u.first_name, u.last_name,
+               p.mrn, p.date_of_birth
+        INTO #bulk_patients
+        FROM security.users u CROSS JOIN medical.patients p;
+
+        SELECT TOP 0 CAST(0 AS INT) AS row_key, u.user_id
+        INTO #bulk_user_ids
+        FROM security.users u CROSS JOIN (SELECT 1 AS one) x;
+    """)
+
+    cursor.fast_executemany = True
+    cursor.executemany("""
+        INSERT INTO #bulk_patients (row_key, username, password_hash, email, phone,
+                                    first_name, last_name, mrn, date_of_birth)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (i, p['username'], p['temp_password'], p['email'], p['phone'],
+         p['first_name'], p['last_name'], p['mrn'], p['date_of_birth'])
+        for i, p in enumerate(new_patients)
+    ])
+    cursor.fast_executemany = False
+
+    cursor.execute("""
+        MERGE INTO security.users AS target
+        USING #bulk_patients AS s ON 1 = 0
+        WHEN NOT MATCHED THEN
+            INSERT (username, password_hash, email, phone,
+                    first_name, last_name, user_type, status, created_at)
+            VALUES (s.username, s.password_hash, s.email, s.phone,
+                    s.first_name, s.last_name, 'patient', 'active', GETDATE())
+        OUTPUT s.row_key, INSERTED.user_id INTO #bulk_user_ids (row_key, user_id);
+    """)
+
+    cursor.execute("""
+        MERGE INTO medical.patients AS target
+        USING (
+            SELECT s.*, i.user_id
+            FROM #bulk_patients s
+            INNER JOIN #bulk_user_ids i ON i.row_key = s.row_key
+        ) AS s ON 1 = 0
+        WHEN NOT MATCHED THEN
+            INSERT (user_id, mrn, first_name, last_name, date_of_birth, phone, email,
+                    status, created_at)
+            VALUES (s.user_id, s.mrn, s.first_name, s.last_name, s.date_of_birth, s.phone, s.email,
+                    'active', GETDATE())
+        OUTPUT s.row_key, INSERTED.patient_id, INSERTED.user_id;
+    """)
+
+    created = {}
+    for row_key, patient_id, user_id in cursor.fetchall():
+        created[new_patients[row_key]['phone']] = (patient_id, user_id)
+
+    cursor.execute("DROP TABLE #bulk_patients; DROP TABLE #bulk_user_ids;")
+    return created
+
+
+def insert_insurance(cursor, policies):
+    """Insert (patient_id, company, policy) rows that are not already on file"""
+    if not policies:
+        return
+    rows = []
+    for patient_id, company, policy_number in policies:
+        effective_date, expiration_date, copay, prior_auth = insurance_terms(company)
+        rows.append((patient_id, company, policy_number, effective_date, expiration_date,
+                     copay, prior_auth, patient_id, policy_number))
+
+    cursor.fast_executemany = True
+    cursor.executemany("""
+        INSERT INTO medical.patient_insurance (
+            patient_id, insurance_company, policy_number,
+            effective_date, expiration_date,
+            copay_amount, prior_authorization_required,
+            status, created_at
+        )
+        SELECT ?, ?, ?, ?, ?, ?, ?, 'active', GETDATE()
+        WHERE NOT EXISTS (
+            SELECT 1 FROM medical.patient_insurance
+            WHERE patient_id = ? AND policy_number = ? AND status = 'active'
+        )
+    """, rows)
+    cursor.fast_executemany = False
+
+
+def insert_trips(cursor, trips):
+    """Stage trips with fast_executemany and insert them set-based.
+
+    trips: list of (row_index, trip_number, patient_id, pickup, dropoff, pickup_time).
+    Returns row_index -> trip_id.
+    """
+    cursor.execute("""
+        IF OBJECT_ID('tempdb..#bulk_trips') IS NOT NULL DROP TABLE #bulk_trips;
+
+        SELECT TOP 0 CAST(0 AS INT) AS row_index,
+               trip_number, patient_id, pickup_address, destination_address, scheduled_pickup_time
+        INTO #bulk_trips
+        FROM operations.trips;
+    """)
+
+    cursor.fast_executemany = True
+    cursor.executemany("""
+        INSERT INTO #bulk_trips (row_index, trip_number, patient_id, pickup_address,
+                                 destination_address, scheduled_pickup_time)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, trips)
+    cursor.fast_executemany = False
+
+    cursor.execute("""
+        MERGE INTO operations.trips AS target
+        USING #bulk_trips AS s ON 1 = 0
+        WHEN NOT MATCHED THEN
+            INSERT (trip_number, patient_id, pickup_address, destination_address,
+                    scheduled_pickup_time, trip_type, status,
+                    booking_source, created_at)
+            VALUES (s.trip_number, s.patient_id, s.pickup_address, s.destination_address,
+                    s.scheduled_pickup_time, 'routine', 'scheduled', 'bulk', GETDATE())
+        OUTPUT s.row_index, INSERTED.trip_id;
+    """)
+    trip_ids = {row_index: trip_id for row_index, trip_id in cursor.fetchall()}
+
+    cursor.execute("DROP TABLE #bulk_trips;")
+    return trip_ids
+
+
+def assign_drivers(cursor, trips):
+    """One batch pass: reserve drivers in the availability index, then write all
+    assignments with a single UPDATE that re-checks overlaps in SQL.
+
+    trips: list of (trip_id, pickup_time).  Returns trip_id -> (driver_id, driver_name).
+    """
+    index = get_availability_index()
+    index.ensure_fresh(cursor)
+
+    reserved = {}
+    for trip_id, pickup_time in sorted(trips, key=lambda t: t[1]):
+        driver = index.reserve(pickup_time, trip_id)
+        if driver:
+            reserved[trip_id] = (driver.driver_id, driver.name)
+
+    if not reserved:
+        return {}
+
+    cursor.execute("""
+        IF OBJECT_ID('tempdb..#bulk_assign') IS NOT NULL DROP TABLE #bulk_assign;
+
+        SELECT TOP 0 t.trip_id, t.driver_id
+        INTO #bulk_assign
+        FROM operations.trips t CROSS JOIN (SELECT 1 AS one) x;
+    """)
+
+    cursor.fast_executemany = True
+    cursor.executemany("INSERT INTO #bulk_assign (trip_id, driver_id) VALUES (?, ?)",
+                       [(trip_id, driver[0]) for trip_id, driver in reserved.items()])
+    cursor.fast_executemany = False
+
+    cursor.execute("""
+        UPDATE t
+        SET driver_id = a.driver_id,
+            status = 'assigned',
+            updated_at = GETDATE()
+        OUTPUT INSERTED.trip_id
+        FROM operations.trips t
+        INNER JOIN #bulk_assign a ON a.trip_id = t.trip_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM operations.trips o WITH (UPDLOCK, HOLDLOCK)
+            WHERE o.driver_id = a.driver_id
+              AND o.trip_id <> t.trip_id
+              AND o.status NOT IN ('completed', 'cancelled', 'no_show')
+              AND o.scheduled_pickup_time > DATEADD(minute, -?, t.scheduled_pickup_time)
+              AND o.scheduled_pickup_time < DATEADD(minute, ?, t.scheduled_pickup_time)
+        )
+    """, (DRIVER_TRIP_BLOCK_MINUTES, DRIVER_TRIP_BLOCK_MINUTES))
+    assigned_ids = {str(row[0]) for row in cursor.fetchall()}
+
+    cursor.execute("DROP TABLE #bulk_assign;")
+
+    assigned = {}
+    for trip_id, driver in reserved.items():
+        if str(trip_id) in assigned_ids:
+            assigned[trip_id] = driver
+        else:
+            index.unassign(trip_id)
+    if len(assigned) < len(reserved):
+        index.invalidate()
+    return assigned
+
+
+# ── IMPORT ────────────────────────────────────────────────────────────────────
+def import_bookings(conn, rows, chunk_size=BULK_BOOKING_CHUNK_SIZE, validate_only=False):
+    """Validate and import manifest rows; returns (results, summary)"""
+    started = time.monotonic()
+    results = [{'row': i + 1} for i in range(len(rows))]
+
+    valid = []
+    for i, row in enumerate(rows):
+        clean, error = validate_row(row)
+        if error:
+            results[i].update({'success': False, 'error': error})
+        else:
+            valid.append((i, clean))
+
+    cursor = conn.cursor()
+    patients = lookup_patients_by_phone(cursor, {r['phone'] for _, r in valid})
+
+    if validate_only:
+        for i, row in valid:
+            results[i].update({'success': True, 'valid': True, 'existing_patient': row['phone'] in patients})
+        cursor.close()
+        return results, _summary(results, started, validate_only=True)
+
+    used_trip_numbers = set()
+    used_usernames = set()
+    created_trips = []
+    new_patient_credentials = {}
+
+    for start in range(0, len(valid), chunk_size):
+        chunk = valid[start:start + chunk_size]
+        chunk_new = {}
+        try:
+            for _, row in chunk:
+                if row['phone'] in patients or row['phone'] in chunk_new:
+                    continue
+                name_parts = row['patient_name'].split()
+                username = generate_username(row['patient_name'])
+                while username in used_usernames:
+                    username = generate_username(row['patient_name'])
+                used_usernames.add(username)
+                chunk_new[row['phone']] = {
+                    'phone': row['phone'],
+                    'email': row.get('email', ''),
+                    'patient_name': row['patient_name'],
+                    'first_name': name_parts[0] if name_parts else '',
+                    'last_name': ' '.join(name_parts[1:]) if len(name_parts) > 1 else '',
+                    'username': username,
+                    'temp_password': generate_password(),
+                    'mrn': generate_mrn(),
+                    'date_of_birth': row.get('date_of_birth') or '1900-01-01'
+                }
+
+            created = create_patients(cursor, list(chunk_new.values())) if chunk_new else {}
+            chunk_patients = dict(patients, **created)
+
+            policies = {
+                (chunk_patients[row['phone']][0], row['insurance_company'], row['policy_number'])
+                for _, row in chunk
+                if row.get('insurance_company') and row.get('policy_number')
+            }
+            insert_insurance(cursor, sorted(policies, key=str))
+
+            staged = []
+            for i, row in chunk:
+                trip_number = generate_trip_number()
+                while trip_number in used_trip_numbers:
+                    trip_number = generate_trip_number()
+                used_trip_numbers.add(trip_number)
+                staged.append((i, trip_number, chunk_patients[row['phone']][0],
+                               row['pickup_address'], row['dropoff_address'], row['pickup_time']))
+            trip_ids = insert_trips(cursor, staged)
+
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Bulk booking chunk error: {str(e)}")
+            for i, _ in chunk:
+                results[i].update({'success': False, 'error': f'Chunk failed: {str(e)}'})
+            continue
+
+        patients.update(created)
+        for phone, creds in chunk_new.items():
+            new_patient_credentials[phone] = creds
+
+        chunk_rows = dict(chunk)
+        publish_all([
+            trip_event('trip.created', trip_ids[i], patient_id=patient_id, pickup_address=pickup,
+                       pickup_time=pickup_time, status='scheduled', trip_number=trip_number,
+                       dropoff_address=dropoff)
+            for i, trip_number, patient_id, pickup, dropoff, pickup_time in staged if i in trip_ids
+        ])
+        for i, trip_number, patient_id, _, _, pickup_time in staged:
+            trip_id = trip_ids.get(i)
+            phone = chunk_rows[i]['phone']
+            results[i].update({
+                'success': trip_id is not None,
+                'trip_id': str(trip_id) if trip_id is not None else None,
+                'trip_number': trip_number,
+                'patient_id': str(patient_id),
+                'new_patient': phone in chunk_new,
+                'driver_assigned': False,
+                'driver_name': 'Pending dispatcher assignment'
+            })
+            if trip_id is None:
+                results[i]['error'] = 'Trip was not inserted'
+            if phone in chunk_new:
+                results[i]['username'] = chunk_new[phone]['username']
+                results[i]['temporary_password'] = chunk_new[phone]['temp_password']
+            if trip_id is not None:
+                created_trips.append((trip_id, pickup_time, i, patient_id, chunk_rows[i]['pickup_address']))
+
+    if created_trips:
+        try:
+            assigned = assign_drivers(cursor, [(trip_id, pickup) for trip_id, pickup, _, _, _ in created_trips])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            get_availability_index().invalidate()
+            print(f"Bulk driver assignment error: {str(e)}")
+            assigned = {}
+        events = []
+        for trip_id, pickup_time, i, patient_id, pickup_address in created_trips:
+            if trip_id in assigned:
+                results[i]['driver_assigned'] = True
+                results[i]['driver_name'] = assigned[trip_id][1]
+                events.append(trip_event('trip.assigned', trip_id, patient_id=patient_id,
+                                         driver_id=assigned[trip_id][0], pickup_address=pickup_address,
+                                         pickup_time=pickup_time, status='assigned'))
+        publish_all(events)
+
+    cursor.close()
+
+    # Welcome emails go through the outbox, so this adds no network I/O
+    for creds in new_patient_credentials.values():
+        if creds['email']:
+            send_welcome_email(creds['email'], creds['patient_name'], creds['username'], creds['temp_password'])
+
+    return results, _summary(results, started, new_patients=len(new_patient_credentials))
+
+
+def _summary(results, started, validate_only=False, new_patients=0):
+    succeeded = sum(1 for r in results if r.get('success'))
+    summary = {
+        'total_rows': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'duration_ms': round((time.monotonic() - started) * 1000, 1)
+    }
+    if validate_only:
+        summary['validate_only'] = True
+    else:
+        summary['new_patients'] = new_patients
+        summary['drivers_assigned'] = sum(1 for r in results if r.get('driver_assigned'))
+    return summary
+
+
+@bulk_booking_bp.route('/api/booking/bulk', methods=['POST'])
+def bulk_create_bookings():
+    """Import a manifest of trips (JSON array or CSV) in chunked transactions"""
+    try:
+        try:
+            rows = read_manifest()
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        if not rows:
+            return jsonify({'success': False, 'error': 'Manifest contains no rows'}), 400
+        if len(rows) > BULK_BOOKING_MAX_ROWS:
+            return jsonify({
+                'success': False,
+                'error': f'Manifest has {len(rows)} rows; the limit is {BULK_BOOKING_MAX_ROWS}'
+            }), 413
+
+        validate_only = request.args.get('validate_only') in ('1', 'true')
+
+        conn = get_db_connection()
+        results, summary = import_bookings(conn, rows, validate_only=validate_only)
+        conn.close()
+
+        return jsonify({
+            'success': summary['failed'] == 0,
+            'summary': summary,
+            'results': results
+        })
+
+    except Exception as e:
+        print(f"Bulk booking error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Batch claim generation for completed trips.
+
+Replaces thousands of /api/billing/generate-claim calls at end of day with
+one job:
+
+  1. one set-based query selects every completed trip in the date range
+     that has no claim yet, with the patient's primary active insurance
+  2. every trip is priced in memory from the rate table, using the rates
+     in effect on its service date, with mileage for the whole batch from
+     one distance engine call; trips it cannot place get a 'pending' claim
+     at 0 miles, flagged for mileage review
+  3. claims are written per chunk of CLAIM_BATCH_CHUNK_SIZE in one
+     transaction: claims through a staged MERGE (which skips trips that
+     gained a claim meanwhile), then claim_line_items and
+     claim_status_history with fast_executemany
+
+Endpoint:  POST /api/billing/generate-claims-batch
+           {"start_date": "2025-06-01", "end_date": "2025-06-30", "dry_run": true}
+CLI:       python3 claim_batch.py --start 2025-06-01 --end 2025-06-30 [--dry-run]
+"""
+
+import argparse
+import os
+import random
+import time
+from datetime import datetime, date, timedelta
+
+from flask import Blueprint, request, jsonify
+
+from database import get_db_connection, db_connection
+from billing_aggregates import add_claims
+from billing_system import MILEAGE_REVIEW_NOTE, MILEAGE_REVIEW_STATUS, payer_type_for, price_trip
+from distance_engine import get_distance_engine
+from rate_table import get_rate_table
+
+claim_batch_bp = Blueprint('claim_batch', __name__)
+
+CLAIM_BATCH_CHUNK_SIZE = int(os.environ.get('CLAIM_BATCH_CHUNK_SIZE', 500))
+
+# Same assumption as generate_claim(): every trip bills as wheelchair service
+SERVICE_TYPE = 'wheelchair'
+
+
+def select_unclaimed_trips(cursor, start_date, end_date):
+    """Completed trips in [start_date, end_date] without a claim, one row per trip"""
+    cursor.execute("""
+        SELECT
+            t.trip_id, t.patient_id, t.pickup_address, t.destination_address,
+            t.scheduled_pickup_time,
+            pi.insurance_id, pi.insurance_company, pi.copay_amount
+        FROM operations.trips t
+        LEFT JOIN medical.patient_insurance pi ON t.patient_id = pi.patient_id
+            AND pi.is_primary = 1 AND pi.status = 'active'
+        WHERE t.status = 'completed'
+          AND t.scheduled_pickup_time >= ?
+          AND t.scheduled_pickup_time < ?
+          AND NOT EXISTS (SELECT 1 FROM billing.claims c WHERE c.trip_id = t.trip_id)
+        ORDER BY t.scheduled_pickup_time, t.trip_id
+    """, (start_date, end_date + timedelta(days=1)))
+
+    trips = {}
+    for row in cursor.fetchall():
+        trips.setdefault(str(row[0]), row)
+    return list(trips.values())
+
+
+def allocate_claim_numbers(cursor, count):
+    """`count` claim numbers in the usual CLM-YYYYMMDD-NNNN format, unique for today"""
+    date_str = datetime.now().strftime('%Y%m%d')
+    prefix = f"CLM-{date_str}-"
+    cursor.execute("SELECT claim_number FROM billing.claims WHERE claim_number LIKE ?", (prefix + '%',))
+    used = {row[0][len(prefix):] for row in cursor.fetchall()}
+
+    numbers = []
+    low, high = 1000, 10000
+    while len(numbers) < count:
+        free = [n for n in range(low, high) if str(n) not in used]
+        take = random.sample(free, min(len(free), count - len(numbers)))
+        numbers.extend(f"{prefix}{n}" for n in take)
+        # Four digits exhausted: widen the range rather than collide
+        low, high = high, high * 10
+    return numbers
+
+
+def price_trips(trips, rate_lookup):
+    """Price trips in memory; returns (priced, skipped) lists"""
+    # All of the batch's mileage in one call to the distance engine
+    mileages = get_distance_engine().batch_miles([(trip[2], trip[3]) for trip in trips])
+
+    priced = []
+    skipped = []
+    for trip, mileage in zip(trips, mileages):
+        trip_id, patient_id, pickup, dropoff, pickup_time, insurance_id, company, copay = trip
+        if not insurance_id:
+            skipped.append({'trip_id': str(trip_id), 'reason': 'No active insurance found for patient'})
+            continue
+
+        payer_type = payer_type_for(company)
+        service_date = pickup_time.date() if pickup_time else date.today()
+        rates = rate_lookup(payer_type, SERVICE_TYPE, service_date)
+        if not rates:
+            skipped.append({'trip_id': str(trip_id),
+                            'reason': f'No rate schedule found for {payer_type} - {SERVICE_TYPE}'})
+            continue
+
+        # Out-of-area addresses still get a claim, held as pending for mileage review
+        mileage_review = mileage is None
+        if mileage_review:
+            mileage = 0.0
+
+        base_charge, mileage_charge, total_amount = price_trip(rates, mileage, service_date)
+        priced.append({
+            'trip_id': trip_id,
+            'patient_id': patient_id,
+            'insurance_id': insurance_id,
+            'insurance_company': company,
+            'payer_type': payer_type,
+            'service_date': service_date,
+            'mileage': float(mileage),
+            'per_mile_rate': float(rates['per_mile_rate']),
+            'base_charge': float(base_charge),
+            'mileage_charge': float(mileage_charge),
+            'total_amount': float(total_amount),
+            'patient_responsibility': float(copay) if copay else 0.00,
+            'claim_status': MILEAGE_REVIEW_STATUS if mileage_review else 'draft',
+            'mileage_review': mileage_review
+        })
+    return priced, skipped
+
+
+def write_claims(cursor, claims):
+    """Insert one chunk of priced claims set-based; returns trip_id -> claim_id for the ones created"""
+    cursor.execute("""
+        IF OBJECT_ID('tempdb..#batch_claims') IS NOT NULL DROP TABLE #batch_claims;
+
+        SELECT TOP 0 claim_number, trip_id, patient_id, insurance_id,
+               service_date, claim_status, total_amount, patient_responsibility
+        INTO #batch_claims
+        FROM billing.claims;
+    """)
+
+    cursor.fast_executemany = True
+    cursor.executemany("""
+        INSERT INTO #batch_claims (claim_number, trip_id, patient_id, insurance_id,
+                                   service_date, claim_status, total_amount, patient_responsibility)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (c['claim_number'], c['trip_id'], c['patient_id'], c['insurance_id'],
+         c['service_date'], c['claim_status'], c['total_amount'], c['patient_responsibility'])
+        for c in claims
+    ])
+    cursor.fast_executemany = False
+
+    # HOLDLOCK makes the "no claim for this trip yet" check and the insert atomic
+    cursor.execute("""
+        MERGE INTO billing.claims WITH (HOLDLOCK) AS target
+        USING #batch_claims AS s ON target.trip_id = s.trip_id
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT (claim_number, trip_id, patient_id, insurance_id,
+                    service_date, claim_status, total_amount,
+                    patient_responsibility, created_at)
+            VALUES (s.claim_number, s.trip_id, s.patient_id, s.insurance_id,
+                    s.service_date, s.claim_status, s.total_amount,
+                    s.patient_responsibility, GETDATE())
+        OUTPUT s.trip_id, INSERTED.claim_id;
+    """)
+    created = {str(trip_id): claim_id for trip_id, claim_id in cursor.fetchall()}
+    cursor.execute("DROP TABLE #batch_claims;")
+
+    line_items = []
+    history = []
+    for c in claims:
+        claim_id = created.get(str(c['trip_id']))
+        if claim_id is None:
+            continue
+        line_items.append((claim_id, 1, 'A0130', 'Non-emergency wheelchair van transport',
+                           1, c['base_charge'], c['base_charge']))
+        line_items.append((claim_id, 2, 'S0215', 'Mileage',
+                           c['mileage'], c['per_mile_rate'], c['mileage_charge']))
+        history.append((claim_id, c['claim_status'],
+                        MILEAGE_REVIEW_NOTE if c['mileage_review'] else 'Claim auto-generated by batch run'))
+
+    if line_items:
+        cursor.fast_executemany = True
+        cursor.executemany("""
+            INSERT INTO billing.claim_line_items (
+                claim_id, line_number, service_code, service_description,
+                quantity, unit_price, line_total
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, line_items)
+        cursor.executemany("""
+            INSERT INTO billing.claim_status_history (
+                claim_id, from_status, to_status, notes
+            ) VALUES (?, NULL, ?, ?)
+        """, history)
+        cursor.fast_executemany = False
+
+    add_claims(cursor, list(created.values()))
+    return created
+
+
+def run_claim_batch(conn, start_date, end_date, dry_run=False, chunk_size=CLAIM_BATCH_CHUNK_SIZE):
+    """Generate claims for every unclaimed completed trip in the range; returns a summary report"""
+    started = time.monotonic()
+    cursor = conn.cursor()
+
+    trips = select_unclaimed_trips(cursor, start_date, end_date)
+    # One freshness check up front; every trip is then priced without touching the database
+    rate_table = get_rate_table()
+    rate_table.ensure_fresh(cursor)
+    priced, skipped = price_trips(trips, rate_table.lookup)
+
+    created_count = 0
+    already_claimed = 0
+    failed_chunks = []
+    created_claims = []
+
+    if not dry_run and priced:
+        numbers = allocate_claim_numbers(cursor, len(priced))
+        for claim, number in zip(priced, numbers):
+            claim['claim_number'] = number
+
+        for start in range(0, len(priced), chunk_size):
+            chunk = priced[start:start + chunk_size]
+            try:
+                created = write_claims(cursor, chunk)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Claim batch chunk error: {str(e)}")
+                failed_chunks.append({'first_trip_id': str(chunk[0]['trip_id']), 'size': len(chunk), 'error': str(e)})
+                continue
+
+            created_count += len(created)
+            already_claimed += len(chunk) - len(created)
+            for claim in chunk:
+                claim_id = created.get(str(claim['trip_id']))
+                if claim_id is not None:
+                    claim['claim_id'] = claim_id
+                    created_claims.append(claim)
+
+    cursor.close()
+
+    by_payer = {}
+    for claim in (priced if dry_run else created_claims):
+        bucket = by_payer.setdefault(claim['payer_type'], {'count': 0, 'total_amount': 0.0})
+        bucket['count'] += 1
+        bucket['total_amount'] = round(bucket['total_amount'] + claim['total_amount'], 2)
+
+    return {
+        'dry_run': dry_run,
+        'start_date': str(start_date),
+        'end_date': str(end_date),
+        'trips_considered': len(trips),
+        'priced': len(priced),
+        'claims_created': created_count,
+        'mileage_review': sum(1 for c in (priced if dry_run else created_claims) if c['mileage_review']),
+        'already_claimed': already_claimed,
+        'skipped': skipped,
+        'failed_chunks': failed_chunks,
+        'total_billed': round(sum(b['total_amount'] for b in by_payer.values()), 2),
+        'by_payer_type': by_payer,
+        'duration_ms': round((time.monotonic() - started) * 1000, 1)
+    }
+
+
+def parse_date(value, field):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} must be YYYY-MM-DD')
+
+
+@claim_batch_bp.route('/api/billing/generate-claims-batch', methods=['POST'])
+def generate_claims_batch():
+    """Generate claims for all completed, unclaimed trips in a date range"""
+    try:
+        data = request.json or {}
+
+        try:
+            start_date = parse_date(data.get('start_date'), 'start_date')
+            end_date = parse_date(data['end_date'], 'end_date') if data.get('end_date') else date.today()
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        if end_date < start_date:
+            return jsonify({'success': False, 'error': 'end_date is before start_date'}), 400
+
+        conn = get_db_connection()
+        report = run_claim_batch(conn, start_date, end_date, dry_run=bool(data.get('dry_run')))
+        conn.close()
+
+        return jsonify({
+            'success': not report['failed_chunks'],
+            'report': report
+        })
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate claims for completed trips in bulk')
+    parser.add_argument('--start', required=True, help='First service date (YYYY-MM-DD)')
+    parser.add_argument('--end', default=None, help='Last service date (YYYY-MM-DD, default today)')
+    parser.add_argument('--dry-run', action='store_true', help='Price trips without writing claims')
+    args = parser.parse_args()
+
+    start_date = parse_date(args.start, '--start')
+    end_date = parse_date(args.end, '--end') if args.end else date.today()
+
+    with db_connection() as conn:
+        report = run_claim_batch(conn, start_date, end_date, dry_run=args.dry_run)
+
+    print(f"Trips considered : {report['trips_considered']}")
+    print(f"Priced           : {report['priced']}")
+    print(f"Claims created   : {report['claims_created']}{' (dry run)' if args.dry_run else ''}")
+    print(f"Already claimed  : {report['already_claimed']}")
+    print(f"Mileage review   : {report['mileage_review']} (pending, addresses outside the gazetteer)")
+    print(f"Skipped          : {len(report['skipped'])}")
+    print(f"Failed chunks    : {len(report['failed_chunks'])}")
+    print(f"Total billed     : ${report['total_billed']:,.2f}")
+    for payer_type, bucket in sorted(report['by_payer_type'].items()):
+        print(f"  {payer_type:<12}: {bucket['count']:>6} claims  ${bucket['total_amount']:,.2f}")
+    print(f"Duration         : {report['duration_ms']} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,72 @@
 #!/usr/bin/env python3
-from flask import Flask, send_file, jsonify, send_from_directory, redirect, request
+from flask import Flask, jsonify, redirect, request
 from flask_cors import CORS
 import os
 
 # Import booking routes
 from booking_routes import booking_bp
+from bulk_booking import bulk_booking_bp
 from insurance_verification import insurance_bp
+from eligibility import eligibility_bp
 from billing_system import billing_bp
+from claim_batch import claim_batch_bp
+from edi_837 import edi_bp
+from era_835 import era_bp
 from analytics_system import analytics_bp
 from core_routes import core_bp
+from live_updates import live_updates_bp
+from telemetry import telemetry_bp
+from route_optimizer import route_optimizer_bp
+import api_auth
+import billing_aggregates
+import database
+import email_outbox
+import metrics
+import static_pages
+import telemetry
 
 app = Flask(__name__)
 CORS(app)
+metrics.init_app(app)
+database.init_app(app)
+api_auth.init_app(app)
+email_outbox.get_outbox().start()
+billing_aggregates.reconciler.start()
+telemetry.get_ingestor().start()
+
+# HTML pages are read and precompressed once per worker
+STATIC_PAGE_FILES = [
+    'src/new_dashboard_landing.html',
+    'new_customer_registration.html',
+    'patient_login.html',
+    'patient_dashboard.html',
+    'driver_dashboard.html',
+    'dispatch_operations_center.html',
+    'insurance_admin_dashboard.html',
+    'analytics_dashboard.html',
+    'billing_dashboard.html',
+    'user_management.html',
+    'nemtsystem_backend.html',
+    'partnership_demo.html',
+    'nemtsystem_demo.html',
+    'credentialing_module.html',
+]
+static_pages.pages.preload(STATIC_PAGE_FILES)
 
 # Register booking blueprint
 app.register_blueprint(booking_bp)
+app.register_blueprint(bulk_booking_bp)
 app.register_blueprint(insurance_bp)
+app.register_blueprint(eligibility_bp)
 app.register_blueprint(billing_bp)
+app.register_blueprint(claim_batch_bp)
+app.register_blueprint(edi_bp)
+app.register_blueprint(era_bp)
 app.register_blueprint(analytics_bp)
 app.register_blueprint(core_bp)
+app.register_blueprint(live_updates_bp)
+app.register_blueprint(telemetry_bp)
+app.register_blueprint(route_optimizer_bp)
 
 # Route mapping
 
@@ -29,72 +77,99 @@ def redirect_credentialing_subdomain():
 
 @app.route('/')
 def index():
-    return send_file('src/new_dashboard_landing.html')
+    return static_pages.serve('src/new_dashboard_landing.html')
 
 @app.route('/dashboard')
 def dashboard():
-    return send_file('src/new_dashboard_landing.html')
+    return static_pages.serve('src/new_dashboard_landing.html')
 
 @app.route('/new-customer-registration')
 def new_customer():
-    return send_file('new_customer_registration.html')
+    return static_pages.serve('new_customer_registration.html')
 
 @app.route('/patient-portal')
 def patient_login():
-    return send_file('patient_login.html')
+    return static_pages.serve('patient_login.html')
 
 @app.route('/patient-dashboard')
 def patient_portal():
-    return send_file('patient_dashboard.html')
+    return static_pages.serve('patient_dashboard.html')
 
 @app.route('/driver-dashboard')
 def driver_dashboard():
-    return send_file('driver_dashboard.html')
+    return static_pages.serve('driver_dashboard.html')
 
 @app.route('/dispatcher-center')
 def dispatcher():
-    return send_file('dispatch_operations_center.html')
+    return static_pages.serve('dispatch_operations_center.html')
 
 @app.route('/insurance-admin')
 def insurance():
-    return send_file('insurance_admin_dashboard.html')
+    return static_pages.serve('insurance_admin_dashboard.html')
 
 @app.route('/analytics-dashboard')
 def analytics_dashboard():
-    return send_file('analytics_dashboard.html')
+    return static_pages.serve('analytics_dashboard.html')
 
 @app.route('/billing-dashboard')
 def billing_dashboard():
-    return send_file('billing_dashboard.html')
+    return static_pages.serve('billing_dashboard.html')
 
 @app.route('/billing')
 def billing():
-    return send_file('billing_dashboard.html')
+    return static_pages.serve('billing_dashboard.html')
 
 @app.route('/user-management')
 def user_management():
-    return send_from_directory('.', 'user_management.html')
+    return static_pages.serve('user_management.html')
 
 @app.route('/nemtsystem-backend')
 def nemtsystem_backend():
-    return send_file('nemtsystem_backend.html')
+    return static_pages.serve('nemtsystem_backend.html')
 
 @app.route('/partnership-demo')
 def partnership_demo():
-    return send_file('partnership_demo.html')
+    return static_pages.serve('partnership_demo.html')
 
 @app.route('/demo')
 def demo():
-    return send_file('nemtsystem_demo.html')
+    return static_pages.serve('nemtsystem_demo.html')
 
 
 @app.route("/health")
 def health_check():
     return {"status": "healthy", "service": "gvt-dashboard"}, 200
 
+@app.route("/health/db")
+def db_pool_health():
+    return jsonify({"status": "healthy", "pool": database.pool_metrics()})
+
+@app.route("/health/outbox")
+def email_outbox_health():
+    return jsonify({"status": "healthy", "outbox": email_outbox.get_outbox().stats()})
+
+@app.route("/health/auth")
+def api_auth_health():
+    return jsonify({"status": "healthy", "key_cache": api_auth.key_cache.stats()})
+
+@app.route("/metrics")
+def prometheus_metrics():
+    token = os.environ.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({"success": False, "error": "Forbidden"}), 403
+    return app.response_class(metrics.render(metrics.collect_node()),
+                              mimetype='text/plain; version=0.0.4')
+
+@app.route("/internal/static-pages/reload", methods=["POST"])
+def reload_static_pages():
+    token = os.environ.get('STATIC_RELOAD_TOKEN')
+    if not token or request.headers.get('X-Reload-Token') != token:
+        return jsonify({"success": False, "error": "Forbidden"}), 403
+    return jsonify({"success": True, "reloaded": static_pages.pages.reload()})
+
 @app.route("/credentialing")
 def credentialing_module():
-    return send_file("credentialing_module.html")
+    return static_pages.serve("credentialing_module.html")
 
 @app.route("/health")
 def health():
@@ -0,0 +1,438 @@
+"""
+Shared data-access layer for the dashboard blueprints.
+
+Every blueprint used to open its own encrypted pyodbc connection per request
+(full TLS handshake to Azure SQL) and close it at the end.  This module keeps a
+bounded, thread-safe pool of connections per worker process instead:
+
+  * connections are health-checked on checkout when they have been idle for a
+    while, and recycled once they exceed the max idle age or max lifetime
+  * the pool is sized per gunicorn worker (DB_POOL_SIZE, or the server-wide
+    DB_MAX_CONNECTIONS budget divided across WEB_CONCURRENCY workers)
+  * connections are always rolled back before going back into the pool, so a
+    handler that errors out half way never leaks an open transaction
+  * checkout wait time, in-use/idle counts and created/recycled totals are
+    tracked and exposed through pool_metrics()
+
+Usage inside a request (connection is returned by conn.close() or, at the
+latest, when the app context tears down):
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    ...
+    conn.commit()
+    conn.close()
+
+Usage outside a request (jobs, scripts):
+
+    with db_connection() as conn:
+        ...
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import pyodbc
+
+import metrics
+
+try:
+    from flask import g, has_app_context
+except ImportError:  # scripts can use the pool without Flask installed
+    g = None
+
+    def has_app_context():
+        return False
+
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', 300))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))
+DB_POOL_HEALTH_CHECK_AFTER = float(os.environ.get('DB_POOL_HEALTH_CHECK_AFTER', 30))
+
+
+def build_connection_string():
+    """Build the ODBC connection string from environment variables"""
+    server = os.environ.get('DB_SERVER', 'partnership-sql-server-v2.database.windows.net')
+    database = os.environ.get('DB_DATABASE', 'golden-valley-transit-prod')
+    username = os.environ.get('DB_USERNAME', 'sqladmin')
+    password = os.environ.get('DB_PASSWORD', 'GoldenValley2025')
+
+    return (
+        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
+        f"SERVER={server};"
+        f"DATABASE={database};"
+        f"UID={username};"
+        f"PWD={password};"
+        f"Encrypt=yes;"
+        f"TrustServerCertificate=no;"
+        f"Connection Timeout=30;"
+    )
+
+
+def default_pool_size():
+    """Connections per worker process.
+
+    DB_POOL_SIZE wins if set; otherwise the server-wide DB_MAX_CONNECTIONS
+    budget is split evenly across the gunicorn workers (WEB_CONCURRENCY).
+    """
+    explicit = os.environ.get('DB_POOL_SIZE')
+    if explicit:
+        return max(1, int(explicit))
+
+    total = int(os.environ.get('DB_MAX_CONNECTIONS', 30))
+    workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+    return max(2, total // max(1, workers))
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within the pool timeout"""
+
+
+class PooledConnection:
+    """Connection handed out by the pool.
+
+    Behaves like a pyodbc connection, except close() returns it to the pool.
+    close() is idempotent so handlers that close explicitly and the request
+    teardown hook can both call it safely.
+    """
+
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+        self._returned = False
+
+    def cursor(self):
+        return metrics.instrument_cursor(self._raw.cursor())
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def close(self):
+        if not self._returned:
+            self._returned = True
+            self._pool.release(self._raw, self._created_at)
+
+    def discard(self):
+        """Close the underlying connection instead of returning it (e.g. after a network error)"""
+        if not self._returned:
+            self._returned = True
+            self._pool.release(self._raw, self._created_at, discard=True)
+
+    @property
+    def closed(self):
+        return self._returned
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and isinstance(exc, pyodbc.OperationalError):
+            self.discard()
+        else:
+            self.close()
+        return False
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of pyodbc connections"""
+
+    def __init__(self, connect, max_size, timeout=DB_POOL_TIMEOUT,
+                 max_idle=DB_POOL_MAX_IDLE, max_lifetime=DB_POOL_MAX_LIFETIME,
+                 health_check_after=DB_POOL_HEALTH_CHECK_AFTER):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        # (raw connection, created_at, last_used); most recently used on the right
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'health_check_failures': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    # ── checkout / return ─────────────────────────────────────────────────────
+    def acquire(self, timeout=None):
+        """Check out a connection, waiting up to `timeout` seconds for one to free up"""
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        while True:
+            raw, created_at, last_used, create_new = self._reserve(deadline)
+
+            if create_new:
+                try:
+                    raw = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._size -= 1
+                        self._available.notify()
+                    raise
+                created_at = time.monotonic()
+                with self._lock:
+                    self._stats['created'] += 1
+            elif time.monotonic() - last_used > self.health_check_after and not self._is_healthy(raw):
+                self._drop(raw, health_check_failed=True)
+                continue
+
+            waited = time.monotonic() - started
+            metrics.POOL_WAIT_SECONDS.observe(waited)
+            with self._lock:
+                self._stats['checkouts'] += 1
+                self._stats['wait_time_total'] += waited
+                if waited > self._stats['wait_time_max']:
+                    self._stats['wait_time_max'] = waited
+
+            return PooledConnection(self, raw, created_at)
+
+    def _reserve(self, deadline):
+        """Pick an idle connection or reserve a slot for a new one (called without the lock)"""
+        expired = []
+        try:
+            with self._lock:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout('Connection pool is closed')
+
+                    now = time.monotonic()
+                    while self._idle:
+                        raw, created_at, last_used = self._idle.pop()
+                        if self._is_expired(created_at, last_used, now):
+                            expired.append(raw)
+                            self._size -= 1
+                            self._stats['recycled'] += 1
+                            continue
+                        return raw, created_at, last_used, False
+
+                    if self._size < self.max_size:
+                        self._size += 1
+                        return None, None, None, True
+
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            f'No database connection available within {self.timeout:.1f}s '
+                            f'(pool size {self.max_size})'
+                        )
+                    self._available.wait(remaining)
+        finally:
+            for raw in expired:
+                _close_quietly(raw)
+
+    def release(self, raw, created_at, discard=False):
+        """Return a connection to the pool, rolling back any open transaction"""
+        if not discard:
+            try:
+                raw.rollback()
+            except pyodbc.Error:
+                discard = True
+
+        now = time.monotonic()
+        with self._lock:
+            if discard or self._closed or now - created_at > self.max_lifetime:
+                self._size -= 1
+                self._stats['recycled'] += 1
+                close_it = True
+            else:
+                self._idle.append((raw, created_at, now))
+                close_it = False
+            stale = self._evict_stale(now)
+            self._available.notify()
+
+        if close_it:
+            _close_quietly(raw)
+        for conn in stale:
+            _close_quietly(conn)
+
+    def _evict_stale(self, now):
+        """Pop idle connections past their max age off the cold end (lock held)"""
+        stale = []
+        while self._idle:
+            raw, created_at, last_used = self._idle[0]
+            if not self._is_expired(created_at, last_used, now):
+                break
+            self._idle.popleft()
+            self._size -= 1
+            self._stats['recycled'] += 1
+            stale.append(raw)
+        return stale
+
+    def _is_expired(self, created_at, last_used, now):
+        return now - last_used > self.max_idle or now - created_at > self.max_lifetime
+
+    def _is_healthy(self, raw):
+        try:
+            cursor = raw.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            raw.rollback()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def _drop(self, raw, health_check_failed=False):
+        with self._lock:
+            self._size -= 1
+            self._stats['recycled'] += 1
+            if health_check_failed:
+                self._stats['health_check_failures'] += 1
+            self._available.notify()
+        _close_quietly(raw)
+
+    def close_all(self):
+        """Close every idle connection; checked-out ones are closed when returned"""
+        with self._lock:
+            self._closed = True
+            idle = [raw for raw, _, _ in self._idle]
+            self._size -= len(idle)
+            self._idle.clear()
+            self._available.notify_all()
+        for raw in idle:
+            _close_quietly(raw)
+
+    # ── metrics ───────────────────────────────────────────────────────────────
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            idle = len(self._idle)
+            size = self._size
+
+        checkouts = stats['checkouts']
+        return {
+            'max_size': self.max_size,
+            'size': size,
+            'in_use': size - idle,
+            'idle': idle,
+            'checkouts': checkouts,
+            'created': stats['created'],
+            'recycled': stats['recycled'],
+            'health_check_failures': stats['health_check_failures'],
+            'timeouts': stats['timeouts'],
+            'wait_time_total_ms': round(stats['wait_time_total'] * 1000, 3),
+            'wait_time_avg_ms': round(stats['wait_time_total'] * 1000 / checkouts, 3) if checkouts else 0.0,
+            'wait_time_max_ms': round(stats['wait_time_max'] * 1000, 3),
+        }
+
+
+def _close_quietly(raw):
+    try:
+        raw.close()
+    except Exception:
+        pass
+
+
+# ── PROCESS-WIDE POOL ─────────────────────────────────────────────────────────
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return this worker's pool, creating it lazily.
+
+    The pid check makes sure a pool created in the gunicorn master (with
+    --preload) is never shared with forked workers.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            connection_string = build_connection_string()
+            _pool = ConnectionPool(
+                connect=lambda: pyodbc.connect(connection_string),
+                max_size=default_pool_size(),
+            )
+            _pool_pid = pid
+    return _pool
+
+
+def get_db_connection():
+    """Check out a pooled connection.
+
+    Inside a Flask app context the connection is also tracked on `g`, so it
+    is returned (and rolled back) by the teardown hook even if the handler
+    raises before calling conn.close().
+    """
+    conn = get_pool().acquire()
+    if has_app_context():
+        if 'db_connections' not in g:
+            g.db_connections = []
+        g.db_connections.append(conn)
+    return conn
+
+
+@contextmanager
+def db_connection():
+    """Context manager for code outside a request; always returns the connection"""
+    conn = get_pool().acquire()
+    try:
+        yield conn
+    except pyodbc.OperationalError:
+        conn.discard()
+        raise
+    finally:
+        conn.close()
+
+
+def release_request_connections(exc=None):
+    """Teardown hook: return any connection a request handler left checked out"""
+    for conn in g.pop('db_connections', []):
+        conn.close()
+
+
+def pool_metrics():
+    """Metrics for this worker's pool (empty until the first checkout)"""
+    if _pool is None or _pool_pid != os.getpid():
+        return {}
+    metrics = _pool.metrics()
+    metrics['pid'] = _pool_pid
+    return metrics
+
+
+DB_POOL_CONNECTIONS = metrics.gauge('db_pool_connections', 'Pooled connections in this worker', ('state',))
+
+
+def _collect_pool_metrics():
+    current = pool_metrics()
+    if current:
+        DB_POOL_CONNECTIONS.set(current['in_use'], 'in_use')
+        DB_POOL_CONNECTIONS.set(current['idle'], 'idle')
+        DB_POOL_CONNECTIONS.set(current['max_size'], 'max')
+
+
+metrics.register_collector(_collect_pool_metrics)
+
+
+def init_app(app):
+    """Register the teardown hook on the Flask app"""
+    app.teardown_appcontext(release_request_connections)
@@ -0,0 +1,335 @@
+"""
+Offline trip distance engine.
+
+Replaces per-claim calls to a remote maps API.  Addresses are normalized
+(case, punctuation, street suffixes, ZIP+4) and geocoded locally:
+
+  1. exact address coordinates from the geocode cache (add_location())
+  2. ZIP centroid from the service-area gazetteer
+  3. city centroid from the gazetteer
+
+Trip miles are the great-circle distance times DISTANCE_ROAD_FACTOR, with a
+floor of DISTANCE_MIN_MILES for trips within one ZIP.  Results are memoized
+per (pickup, dropoff) pair in an in-process LRU and in the node-local
+'distance' store, so each pair is computed once per host.
+
+batch_miles() prices a whole list of pairs in one call: one memo lookup per
+chunk, one vectorized haversine pass (numpy when installed), one memo write.
+"""
+
+import csv
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from local_store import get_store, transaction
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+DISTANCE_GAZETTEER = os.environ.get(
+    'DISTANCE_GAZETTEER',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'kern_county_gazetteer.csv')
+)
+DISTANCE_STORE = os.environ.get('DISTANCE_STORE', 'distance')
+DISTANCE_ROAD_FACTOR = float(os.environ.get('DISTANCE_ROAD_FACTOR', 1.3))
+DISTANCE_MIN_MILES = float(os.environ.get('DISTANCE_MIN_MILES', 1.0))
+DISTANCE_MEMO_SIZE = int(os.environ.get('DISTANCE_MEMO_SIZE', 50000))
+
+EARTH_RADIUS_MILES = 3958.8
+
+# Max host parameters per SQLite statement is 999 on older builds
+MEMO_LOOKUP_CHUNK = 500
+
+DISTANCE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS geocodes (
+        address     TEXT PRIMARY KEY,
+        latitude    REAL NOT NULL,
+        longitude   REAL NOT NULL,
+        source      TEXT,
+        updated_at  REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS distance_memo (
+        pair        TEXT PRIMARY KEY,
+        miles       REAL NOT NULL,
+        version     TEXT NOT NULL,
+        created_at  REAL NOT NULL
+    );
+"""
+
+
+# ── ADDRESS NORMALIZATION ─────────────────────────────────────────────────────
+STREET_ABBREVIATIONS = {
+    'STREET': 'ST', 'AVENUE': 'AVE', 'AV': 'AVE', 'ROAD': 'RD', 'DRIVE': 'DR',
+    'BOULEVARD': 'BLVD', 'LANE': 'LN', 'COURT': 'CT', 'PLACE': 'PL',
+    'HIGHWAY': 'HWY', 'PARKWAY': 'PKWY', 'CIRCLE': 'CIR', 'TERRACE': 'TER',
+    'WAY': 'WAY', 'TRAIL': 'TRL', 'SUITE': 'STE', 'APARTMENT': 'APT',
+    'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W',
+}
+# Only abbreviated as the state, so city names like CALIFORNIA CITY survive
+STATE_ABBREVIATIONS = {'CALIFORNIA': 'CA', 'CALIF': 'CA'}
+
+ZIP_RE = re.compile(r'\b(\d{5})(?:-\d{4})?\s*$')
+STATE_RE = re.compile(r'\s*\bCA\s*$')
+
+
+def normalize_address(address):
+    """Canonical form used as cache key: '123 MAIN ST, BAKERSFIELD, CA 93301'"""
+    if not address:
+        return ''
+    text = address.upper().replace('#', ' # ')
+    components = []
+    for part in text.split(','):
+        words = re.sub(r'[^A-Z0-9# -]', ' ', part).split()
+        words = [STREET_ABBREVIATIONS.get(word, word) for word in words]
+        if words:
+            components.append(words)
+    if components:
+        # The state is the last word of the last component, ahead of any ZIP
+        last = components[-1]
+        at = len(last) - 1
+        while at > 0 and re.fullmatch(r'[\d-]+', last[at]):
+            at -= 1
+        last[at] = STATE_ABBREVIATIONS.get(last[at], last[at])
+    components = [' '.join(words) for words in components]
+    normalized = ', '.join(components)
+    # Drop ZIP+4 extensions so they share the ZIP's cache entries
+    return re.sub(r'\b(\d{5})[\s-]+\d{4}$', r'\1', normalized)
+
+
+def parse_address(normalized, known_cities=()):
+    """(zip, city) extracted from a normalized address; either may be None"""
+    zip_match = ZIP_RE.search(normalized)
+    zip_code = zip_match.group(1) if zip_match else None
+
+    rest = normalized[:zip_match.start()] if zip_match else normalized
+    rest = STATE_RE.sub('', rest.rstrip(', ')).rstrip(', ')
+
+    city = None
+    components = [c.strip() for c in rest.split(',')]
+    if len(components) > 1 and components[-1] in known_cities:
+        city = components[-1]
+    else:
+        # No comma before the city: match the longest known city the text ends with
+        for name in sorted(known_cities, key=len, reverse=True):
+            if rest == name or rest.endswith(' ' + name):
+                city = name
+                break
+    return zip_code, city
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    """Great-circle distance in miles between two points given in degrees"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+
+def haversine_many(coords):
+    """Great-circle miles for a list of (lat1, lon1, lat2, lon2) tuples"""
+    if not coords:
+        return []
+    if NUMPY_AVAILABLE:
+        lat1, lon1, lat2, lon2 = np.radians(np.asarray(coords, dtype=float)).T
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return (2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))).tolist()
+    return [haversine_miles(*c) for c in coords]
+
+
+# ── ENGINE ────────────────────────────────────────────────────────────────────
+class DistanceEngine:
+    """Geocodes addresses against the gazetteer and memoizes pair distances"""
+
+    def __init__(self, gazetteer_path=DISTANCE_GAZETTEER, store=DISTANCE_STORE,
+                 road_factor=DISTANCE_ROAD_FACTOR, min_miles=DISTANCE_MIN_MILES,
+                 memo_size=DISTANCE_MEMO_SIZE):
+        self.store = store
+        self.road_factor = road_factor
+        self.min_miles = min_miles
+        self.memo_size = memo_size
+
+        self._zips, self._cities, digest = self._load_gazetteer(gazetteer_path)
+        # Memo entries computed with other parameters or another gazetteer are misses
+        self.version = f'{road_factor}:{min_miles}:{digest}'
+
+        self._lock = threading.Lock()
+        self._memo = OrderedDict()
+        self._addresses = None
+        self._counters = {'lru_hits': 0, 'store_hits': 0, 'computed': 0, 'unresolved': 0}
+
+    @staticmethod
+    def _load_gazetteer(path):
+        zips = {}
+        cities = {}
+        try:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+            with open(path, newline='') as f:
+                for row in csv.DictReader(f):
+                    point = (float(row['latitude']), float(row['longitude']))
+                    if row['kind'] == 'zip':
+                        zips[row['key']] = point
+                    elif row['kind'] == 'city':
+                        # Keyed like parsed addresses, e.g. SOUTH LAKE -> S LAKE
+                        cities[normalize_address(row['key'])] = point
+        except FileNotFoundError:
+            print(f"Distance gazetteer not found: {path}")
+            digest = 'none'
+        return zips, cities, digest
+
+    def _db(self):
+        return get_store(self.store, DISTANCE_SCHEMA)
+
+    # ── geocoding ─────────────────────────────────────────────────────────────
+    def _address_cache(self):
+        if self._addresses is None:
+            rows = self._db().execute("SELECT address, latitude, longitude FROM geocodes").fetchall()
+            self._addresses = {row[0]: (row[1], row[2]) for row in rows}
+        return self._addresses
+
+    def add_location(self, address, latitude, longitude, source='manual'):
+        """Pin exact coordinates for an address (facilities, frequent pickups)"""
+        normalized = normalize_address(address)
+        self._db().execute("""
+            INSERT OR REPLACE INTO geocodes (address, latitude, longitude, source, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (normalized, float(latitude), float(longitude), source, time.time()))
+        self._address_cache()[normalized] = (float(latitude), float(longitude))
+        # Pairs involving this address were memoized from a coarser point
+        self._db().execute("DELETE FROM distance_memo WHERE pair LIKE ? OR pair LIKE ?",
+                           (normalized + ' | %', '% | ' + normalized))
+        with self._lock:
+            for key in [k for k in self._memo if normalized in k.split(' | ')]:
+                del self._memo[key]
+
+    def geocode_normalized(self, normalized):
+        """(latitude, longitude, precision) for a normalized address, or None"""
+        point = self._address_cache().get(normalized)
+        if point:
+            return point[0], point[1], 'address'
+        zip_code, city = parse_address(normalized, self._cities)
+        if zip_code in self._zips:
+            return self._zips[zip_code] + ('zip',)
+        if city in self._cities:
+            return self._cities[city] + ('city',)
+        return None
+
+    def geocode(self, address):
+        return self.geocode_normalized(normalize_address(address))
+
+    def region(self, address):
+        """Dispatch region of an address: its gazetteer city, else its ZIP, else None"""
+        zip_code, city = parse_address(normalize_address(address or ''), self._cities)
+        return city.lower() if city else zip_code
+
+    # ── distances ─────────────────────────────────────────────────────────────
+    @staticmethod
+    def pair_key(a, b):
+        """Order-independent memo key for two normalized addresses"""
+        return ' | '.join(sorted((a, b)))
+
+    def _road_miles(self, straight_line):
+        return round(max(self.min_miles, straight_line * self.road_factor), 2)
+
+    def _remember(self, key, miles):
+        self._memo[key] = miles
+        self._memo.move_to_end(key)
+        while len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+
+    def miles(self, pickup_address, dropoff_address):
+        """Billable miles between two addresses, or None if either cannot be geocoded"""
+        return self.batch_miles([(pickup_address, dropoff_address)])[0]
+
+    def batch_miles(self, pairs):
+        """Billable miles for each (pickup, dropoff) pair, None where unresolvable"""
+        keys = [self.pair_key(normalize_address(a), normalize_address(b)) for a, b in pairs]
+        results = {}
+
+        with self._lock:
+            for key in keys:
+                if key in self._memo:
+                    self._memo.move_to_end(key)
+                    results[key] = self._memo[key]
+                    self._counters['lru_hits'] += 1
+
+        missing = list({key for key in keys if key not in results})
+        db = self._db()
+        for start in range(0, len(missing), MEMO_LOOKUP_CHUNK):
+            chunk = missing[start:start + MEMO_LOOKUP_CHUNK]
+            rows = db.execute(f"""
+                SELECT pair, miles FROM distance_memo
+                WHERE version = ? AND pair IN ({','.join('?' * len(chunk))})
+            """, [self.version] + chunk).fetchall()
+            for row in rows:
+                results[row[0]] = row[1]
+        store_hits = [key for key in missing if key in results]
+
+        to_compute = []
+        coords = []
+        points = {}
+        for key in missing:
+            if key in results:
+                continue
+            a, b = key.split(' | ')
+            for address in (a, b):
+                if address not in points:
+                    points[address] = self.geocode_normalized(address)
+            if points[a] is None or points[b] is None:
+                results[key] = None
+                continue
+            to_compute.append(key)
+            coords.append(points[a][:2] + points[b][:2])
+
+        computed = {key: self._road_miles(d) for key, d in zip(to_compute, haversine_many(coords))}
+        results.update(computed)
+
+        if computed:
+            now = time.time()
+            with transaction(db):
+                db.executemany("""
+                    INSERT OR REPLACE INTO distance_memo (pair, miles, version, created_at)
+                    VALUES (?, ?, ?, ?)
+                """, [(key, miles, self.version, now) for key, miles in computed.items()])
+
+        with self._lock:
+            for key in store_hits:
+                self._remember(key, results[key])
+            for key, miles in computed.items():
+                self._remember(key, miles)
+            self._counters['store_hits'] += len(store_hits)
+            self._counters['computed'] += len(computed)
+            self._counters['unresolved'] += sum(1 for key in keys if results[key] is None)
+
+        return [results[key] for key in keys]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters,
+                        memo_entries=len(self._memo),
+                        gazetteer_zips=len(self._zips),
+                        gazetteer_cities=len(self._cities),
+                        numpy=NUMPY_AVAILABLE)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_distance_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = DistanceEngine()
+    return _engine
@@ -0,0 +1,352 @@
+"""
+In-process driver availability index.
+
+Answers "best free driver for a pickup at time T" without a database round
+trip.  For every driver we keep the daily shift window and the pickup times
+of trips already assigned to them; a driver is busy for DRIVER_TRIP_BLOCK_MINUTES
+either side of each assigned pickup, so a new trip can never overlap one they
+already have.
+
+Lookups go through per-day slot tables: each day is cut into
+DRIVER_INDEX_SLOT_MINUTES slots, and each slot holds the drivers whose shift
+touches it and who are not fully blocked in it, kept sorted by
+(performance_rating DESC, total_trips_completed DESC).  Finding a driver is a
+slot lookup plus an exact check of the first candidates; keeping the slots up
+to date on assignment is a bisect per touched slot.
+
+The index is per worker process.  It is reloaded from the database every
+DRIVER_INDEX_REFRESH_SECONDS, and assign_driver_to_trip() re-checks overlap in
+SQL, so a driver booked by another worker is never double-booked.
+
+Changes made inside a database transaction are recorded as (method, *args)
+tuples (see INDEX_CHANGES) and handed to apply() once it commits, the same
+way live events are published; reserve() is the one exception, as it holds
+the driver for the trip while the transaction runs.
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+
+DRIVER_INDEX_SLOT_MINUTES = int(os.environ.get('DRIVER_INDEX_SLOT_MINUTES', 15))
+DRIVER_TRIP_BLOCK_MINUTES = int(os.environ.get('DRIVER_TRIP_BLOCK_MINUTES', 90))
+DRIVER_INDEX_REFRESH_SECONDS = float(os.environ.get('DRIVER_INDEX_REFRESH_SECONDS', 300))
+
+MINUTES_PER_DAY = 24 * 60
+
+INACTIVE_TRIP_STATUSES = ('completed', 'cancelled', 'no_show')
+INDEX_CHANGES = ('assign', 'unassign', 'trip_status_changed', 'driver_status_changed')
+
+
+def parse_pickup_time(pickup_time):
+    """Accept the 'YYYY-MM-DD HH:MM' strings the booking form sends, or a datetime"""
+    if isinstance(pickup_time, datetime):
+        return pickup_time
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(pickup_time, fmt)
+        except (TypeError, ValueError):
+            continue
+    raise ValueError(f'Unrecognized pickup time: {pickup_time}')
+
+
+def _minutes(value):
+    """Minutes since midnight for a TIME column value (datetime.time or 'HH:MM[:SS]')"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        parts = [int(p) for p in value.split(':')[:2]]
+        return parts[0] * 60 + parts[1]
+    return value.hour * 60 + value.minute + value.second / 60.0
+
+
+class DriverRecord:
+    __slots__ = ('driver_id', 'name', 'rating', 'trips_completed',
+                 'shift_start', 'shift_end', 'status', 'busy', 'rank')
+
+    def __init__(self, driver_id, name, rating, trips_completed, shift_start, shift_end, status):
+        self.driver_id = driver_id
+        self.name = name
+        self.rating = float(rating or 0)
+        self.trips_completed = int(trips_completed or 0)
+        self.shift_start = _minutes(shift_start)
+        self.shift_end = _minutes(shift_end)
+        self.status = status
+        self.busy = []  # sorted [(pickup datetime, trip_id)]
+        self.rank = (-self.rating, -self.trips_completed, str(driver_id))
+
+    @property
+    def dispatchable(self):
+        return self.status == 'available' and self.shift_start is not None and self.shift_end is not None
+
+    def on_shift(self, minute_of_day):
+        """Same test as `CAST(? AS TIME) BETWEEN shift_start AND shift_end`, allowing overnight shifts"""
+        if self.shift_start <= self.shift_end:
+            return self.shift_start <= minute_of_day <= self.shift_end
+        return minute_of_day >= self.shift_start or minute_of_day <= self.shift_end
+
+    def shift_touches(self, slot_start, slot_end):
+        if self.shift_start <= self.shift_end:
+            return self.shift_start < slot_end and self.shift_end >= slot_start
+        return slot_end > self.shift_start or slot_start <= self.shift_end
+
+    def conflicts(self, pickup, block):
+        """True if an assigned pickup lies within `block` of `pickup`"""
+        i = bisect_left(self.busy, (pickup - block,))
+        while i < len(self.busy) and self.busy[i][0] < pickup + block:
+            if self.busy[i][0] > pickup - block:
+                return True
+            i += 1
+        return False
+
+    def trips_on(self, day):
+        """Number of assigned pickups on `day` (a date)"""
+        start = datetime.combine(day, datetime.min.time())
+        return bisect_left(self.busy, (start + timedelta(days=1),)) - bisect_left(self.busy, (start,))
+
+
+class DriverAvailabilityIndex:
+    """Shift and assignment intervals per driver, with rating-ordered slot tables per day"""
+
+    def __init__(self, slot_minutes=DRIVER_INDEX_SLOT_MINUTES,
+                 block_minutes=DRIVER_TRIP_BLOCK_MINUTES,
+                 refresh_seconds=DRIVER_INDEX_REFRESH_SECONDS):
+        self.slot_minutes = slot_minutes
+        self.slots_per_day = -(-MINUTES_PER_DAY // slot_minutes)
+        self.block = timedelta(minutes=block_minutes)
+        self.refresh_seconds = refresh_seconds
+
+        self._lock = threading.RLock()
+        self._drivers = {}    # driver_id -> DriverRecord
+        self._by_rank = {}    # rank key -> DriverRecord
+        self._by_key = {}     # str(driver_id).lower() -> DriverRecord
+        self._trips = {}      # trip_id -> (driver_id, pickup)
+        self._days = {}       # date -> [sorted rank keys per slot]
+        self._loaded_at = None
+
+    # ── loading ───────────────────────────────────────────────────────────────
+    def load(self, cursor):
+        """Rebuild the index from operations.drivers and the assigned, still-open trips"""
+        cursor.execute("""
+            SELECT d.driver_id,
+                   u.first_name + ' ' + u.last_name as driver_name,
+                   d.performance_rating,
+                   d.total_trips_completed,
+                   d.shift_start,
+                   d.shift_end,
+                   d.current_status
+            FROM operations.drivers d
+            INNER JOIN security.users u ON d.user_id = u.user_id
+            WHERE u.status = 'active'
+        """)
+        drivers = {}
+        for row in cursor.fetchall():
+            drivers[row[0]] = DriverRecord(row[0], row[1], row[2], row[3], row[4], row[5], row[6])
+
+        cursor.execute("""
+            SELECT trip_id, driver_id, scheduled_pickup_time
+            FROM operations.trips
+            WHERE driver_id IS NOT NULL
+              AND scheduled_pickup_time >= DATEADD(minute, -?, CAST(CAST(GETDATE() AS DATE) AS DATETIME))
+              AND status NOT IN ('completed', 'cancelled', 'no_show')
+        """, (int(self.block.total_seconds() // 60),))
+        trips = {}
+        for trip_id, driver_id, pickup in cursor.fetchall():
+            driver = drivers.get(driver_id)
+            if driver is None or pickup is None:
+                continue
+            insort(driver.busy, (pickup, str(trip_id)))
+            trips[str(trip_id)] = (driver_id, pickup)
+
+        with self._lock:
+            self._drivers = drivers
+            self._by_rank = {d.rank: d for d in drivers.values()}
+            self._by_key = {str(d.driver_id).lower(): d for d in drivers.values()}
+            self._trips = trips
+            self._days = {}
+            self._loaded_at = time.monotonic()
+
+    def ensure_fresh(self, cursor):
+        """Load on first use and whenever the refresh interval has passed"""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_seconds:
+            self.load(cursor)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    # ── per-day slot tables ──────────────────────────────────────────────────
+    def _slot_bounds(self, slot):
+        start = slot * self.slot_minutes
+        return start, min(MINUTES_PER_DAY, start + self.slot_minutes)
+
+    def _blocked_slots(self, driver, day):
+        """Slots of `day` that lie entirely inside one of the driver's blocked windows"""
+        blocked = set()
+        day_start = datetime.combine(day, datetime.min.time())
+        for pickup, _ in driver.busy:
+            lo = (pickup - self.block - day_start).total_seconds() / 60.0
+            hi = (pickup + self.block - day_start).total_seconds() / 60.0
+            if hi <= 0 or lo >= MINUTES_PER_DAY:
+                continue
+            first = max(0, int(-(-lo // self.slot_minutes)))
+            for slot in range(first, self.slots_per_day):
+                slot_start, slot_end = self._slot_bounds(slot)
+                if slot_end > hi:
+                    break
+                if slot_start > lo:
+                    blocked.add(slot)
+        return blocked
+
+    def _driver_slots(self, driver, day):
+        if not driver.dispatchable:
+            return []
+        blocked = self._blocked_slots(driver, day)
+        return [
+            slot for slot in range(self.slots_per_day)
+            if slot not in blocked and driver.shift_touches(*self._slot_bounds(slot))
+        ]
+
+    def _day(self, day):
+        slots = self._days.get(day)
+        if slots is None:
+            slots = [[] for _ in range(self.slots_per_day)]
+            for driver in self._drivers.values():
+                for slot in self._driver_slots(driver, day):
+                    slots[slot].append(driver.rank)
+            for entries in slots:
+                entries.sort()
+            self._days[day] = slots
+            self._evict_old_days()
+        return slots
+
+    def _evict_old_days(self):
+        cutoff = datetime.now().date() - timedelta(days=1)
+        for day in [d for d in self._days if d < cutoff]:
+            del self._days[day]
+
+    def _reindex_driver(self, driver, days=None):
+        """Recompute a driver's slot memberships on the materialized days"""
+        for day in (days if days is not None else list(self._days)):
+            slots = self._days.get(day)
+            if slots is None:
+                continue
+            keep = set(self._driver_slots(driver, day))
+            for slot, entries in enumerate(slots):
+                i = bisect_left(entries, driver.rank)
+                present = i < len(entries) and entries[i] == driver.rank
+                if present and slot not in keep:
+                    del entries[i]
+                elif not present and slot in keep:
+                    entries.insert(i, driver.rank)
+
+    def _affected_days(self, pickup):
+        return {(pickup - self.block).date(), pickup.date(), (pickup + self.block).date()}
+
+    # ── queries ───────────────────────────────────────────────────────────────
+    def find(self, pickup_time):
+        """Best-ranked driver who is available, on shift and free at pickup_time, or None"""
+        pickup = parse_pickup_time(pickup_time)
+        minute_of_day = pickup.hour * 60 + pickup.minute + pickup.second / 60.0
+        with self._lock:
+            slot = min(int(minute_of_day // self.slot_minutes), self.slots_per_day - 1)
+            for rank in self._day(pickup.date())[slot]:
+                driver = self._by_rank[rank]
+                if driver.on_shift(minute_of_day) and not driver.conflicts(pickup, self.block):
+                    return driver
+        return None
+
+    def drivers(self):
+        """Snapshot of all loaded DriverRecords"""
+        with self._lock:
+            return list(self._drivers.values())
+
+    def driver(self, driver_id):
+        """DriverRecord for an id as the database or a client spells it (GUID case-insensitive)"""
+        return self._by_key.get(str(driver_id).lower())
+
+    def is_free(self, driver, pickup_time):
+        """True if the driver is available, on shift and has no overlapping trip"""
+        pickup = parse_pickup_time(pickup_time)
+        minute_of_day = pickup.hour * 60 + pickup.minute + pickup.second / 60.0
+        with self._lock:
+            return (driver.dispatchable and driver.on_shift(minute_of_day)
+                    and not driver.conflicts(pickup, self.block))
+
+    def reserve(self, pickup_time, trip_id, driver_id=None):
+        """Atomically find the best free driver (or check `driver_id` is free) and mark them busy for this trip"""
+        with self._lock:
+            if driver_id is None:
+                driver = self.find(pickup_time)
+            else:
+                driver = self.driver(driver_id)
+                if driver is not None and not self.is_free(driver, pickup_time):
+                    driver = None
+            if driver is not None:
+                self.assign(trip_id, driver.driver_id, pickup_time)
+            return driver
+
+    # ── incremental updates ───────────────────────────────────────────────────
+    def assign(self, trip_id, driver_id, pickup_time):
+        """Record an assignment (replaces any previous assignment of the same trip)"""
+        pickup = parse_pickup_time(pickup_time)
+        trip_id = str(trip_id)
+        with self._lock:
+            self.unassign(trip_id)
+            driver = self._drivers.get(driver_id)
+            if driver is None:
+                return
+            insort(driver.busy, (pickup, trip_id))
+            self._trips[trip_id] = (driver_id, pickup)
+            self._reindex_driver(driver, self._affected_days(pickup))
+
+    def unassign(self, trip_id):
+        """Free the driver's time for a trip that was cancelled, completed or reassigned"""
+        trip_id = str(trip_id)
+        with self._lock:
+            entry = self._trips.pop(trip_id, None)
+            if entry is None:
+                return
+            driver_id, pickup = entry
+            driver = self._drivers.get(driver_id)
+            if driver is None:
+                return
+            driver.busy = [b for b in driver.busy if b[1] != trip_id]
+            self._reindex_driver(driver, self._affected_days(pickup))
+
+    def trip_status_changed(self, trip_id, status):
+        if status in INACTIVE_TRIP_STATUSES:
+            self.unassign(trip_id)
+
+    def driver_status_changed(self, driver_id, status):
+        with self._lock:
+            driver = self.driver(driver_id)
+            if driver is None or driver.status == status:
+                return
+            driver.status = status
+            self._reindex_driver(driver)
+
+    def apply(self, changes):
+        """Apply (method, *args) changes recorded during a transaction that has committed"""
+        for method, *args in changes:
+            if method in INDEX_CHANGES:
+                getattr(self, method)(*args)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'drivers': len(self._drivers),
+                'dispatchable': sum(1 for d in self._drivers.values() if d.dispatchable),
+                'assigned_trips': len(self._trips),
+                'materialized_days': len(self._days),
+                'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None
+            }
+
+
+_index = DriverAvailabilityIndex()
+
+
+def get_availability_index():
+    return _index
@@ -0,0 +1,264 @@
+"""
+Nearest-available-driver search for dispatch.
+
+Latest driver positions (from telemetry) are kept in a uniform grid of
+DISPATCH_GRID_MILES cells over an equirectangular projection centred on the
+service area, which is accurate to well under 1% at county scale.  A
+k-nearest query walks rings of cells outward from the pickup and stops once
+the next ring cannot hold anything closer than the k-th driver found; drivers
+are filtered on the way by the availability index (status, shift window,
+overlapping trips), so the k returned are the k nearest *available* ones.
+
+Positions are re-synced from the telemetry store every
+DISPATCH_POSITION_REFRESH_SECONDS; only drivers whose fix changed are moved,
+and drivers silent for DISPATCH_POSITION_MAX_AGE_SECONDS drop out of the grid.
+
+Candidates are ranked by dispatch_score(): estimated minutes to the pickup,
+a heavy penalty for arriving late, rating and the number of trips the driver
+already has that day.  A driver's current position only says something about
+pickups in the next DISPATCH_NEAR_TERM_MINUTES; later pickups, ungeocodable
+addresses and pickups with no located driver fall back to the availability
+index's rating order.
+"""
+
+import math
+import os
+import threading
+import time
+from datetime import datetime
+from heapq import heappush, heapreplace
+
+from distance_engine import DISTANCE_ROAD_FACTOR, get_distance_engine
+from driver_availability import parse_pickup_time
+import telemetry
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+DISPATCH_GRID_MILES = float(os.environ.get('DISPATCH_GRID_MILES', 2))
+DISPATCH_REF_LATITUDE = float(os.environ.get('DISPATCH_REF_LATITUDE', 35.37))
+DISPATCH_POSITION_REFRESH_SECONDS = float(os.environ.get('DISPATCH_POSITION_REFRESH_SECONDS', 5))
+DISPATCH_POSITION_MAX_AGE_SECONDS = float(os.environ.get('DISPATCH_POSITION_MAX_AGE_SECONDS', 600))
+DISPATCH_NEAR_TERM_MINUTES = float(os.environ.get('DISPATCH_NEAR_TERM_MINUTES', 180))
+DISPATCH_CANDIDATES = int(os.environ.get('DISPATCH_CANDIDATES', 10))
+DISPATCH_MAX_MILES = float(os.environ.get('DISPATCH_MAX_MILES', 60))
+DISPATCH_AVERAGE_MPH = float(os.environ.get('DISPATCH_AVERAGE_MPH', 30))
+DISPATCH_WEIGHT_ETA = float(os.environ.get('DISPATCH_WEIGHT_ETA', 1.0))          # per minute
+DISPATCH_WEIGHT_LATE = float(os.environ.get('DISPATCH_WEIGHT_LATE', 5.0))        # per minute late
+DISPATCH_WEIGHT_RATING = float(os.environ.get('DISPATCH_WEIGHT_RATING', 10.0))   # per point below 5
+DISPATCH_WEIGHT_LOAD = float(os.environ.get('DISPATCH_WEIGHT_LOAD', 5.0))        # per trip that day
+
+MILES_PER_DEGREE_LAT = 69.0
+
+
+def dispatch_score(miles, rating, load, minutes_until_pickup):
+    """(score, eta_minutes) for sending a driver `miles` away; lower is better"""
+    eta = miles * DISTANCE_ROAD_FACTOR / DISPATCH_AVERAGE_MPH * 60
+    late = max(0.0, eta - minutes_until_pickup)
+    score = (DISPATCH_WEIGHT_ETA * eta + DISPATCH_WEIGHT_LATE * late
+             + DISPATCH_WEIGHT_RATING * max(0.0, 5.0 - rating) + DISPATCH_WEIGHT_LOAD * load)
+    return score, eta
+
+
+class SpatialGrid:
+    """Points bucketed into square cells; supports moves and k-nearest queries"""
+
+    def __init__(self, cell_miles=DISPATCH_GRID_MILES, ref_latitude=DISPATCH_REF_LATITUDE):
+        self.cell_miles = cell_miles
+        self._x_scale = MILES_PER_DEGREE_LAT * math.cos(math.radians(ref_latitude))
+        self._points = {}   # key -> (x, y, cell)
+        self._cells = {}    # (cx, cy) -> set of keys
+        self._bounds = None  # (min cx, max cx, min cy, max cy) of occupied cells
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def _project(self, latitude, longitude):
+        return longitude * self._x_scale, latitude * MILES_PER_DEGREE_LAT
+
+    def _cell(self, x, y):
+        return math.floor(x / self.cell_miles), math.floor(y / self.cell_miles)
+
+    def update(self, key, latitude, longitude):
+        x, y = self._project(latitude, longitude)
+        cell = self._cell(x, y)
+        old = self._points.get(key)
+        if old is not None and old[2] != cell:
+            self._discard(key, old[2])
+        if old is None or old[2] != cell:
+            if cell not in self._cells:
+                self._cells[cell] = set()
+                self._bounds = None
+            self._cells[cell].add(key)
+        self._points[key] = (x, y, cell)
+
+    def remove(self, key):
+        old = self._points.pop(key, None)
+        if old is not None:
+            self._discard(key, old[2])
+
+    def _discard(self, key, cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del self._cells[cell]
+                self._bounds = None
+
+    def _occupied_bounds(self):
+        if self._bounds is None:
+            xs = [c[0] for c in self._cells]
+            ys = [c[1] for c in self._cells]
+            self._bounds = (min(xs), max(xs), min(ys), max(ys))
+        return self._bounds
+
+    def _ring(self, cx, cy, r):
+        if r == 0:
+            yield cx, cy
+            return
+        for dx in range(-r, r + 1):
+            yield cx + dx, cy - r
+            yield cx + dx, cy + r
+        for dy in range(-r + 1, r):
+            yield cx - r, cy + dy
+            yield cx + r, cy + dy
+
+    def nearest(self, latitude, longitude, k, accept=None, max_miles=None):
+        """Up to k (miles, key) pairs, nearest first, for keys passing `accept(key)`"""
+        if not self._points or k <= 0:
+            return []
+        x, y = self._project(latitude, longitude)
+        cx, cy = self._cell(x, y)
+        min_x, max_x, min_y, max_y = self._occupied_bounds()
+        # Beyond this ring every occupied cell has been visited
+        last_ring = max(abs(cx - min_x), abs(cx - max_x), abs(cy - min_y), abs(cy - max_y))
+        if max_miles is not None:
+            last_ring = min(last_ring, int(max_miles // self.cell_miles) + 1)
+        limit = max_miles * max_miles if max_miles is not None else float('inf')
+
+        heap = []  # (-distance², key): the k best so far, worst on top
+        for r in range(last_ring + 1):
+            if len(heap) == k and -heap[0][0] <= ((r - 1) * self.cell_miles) ** 2:
+                break
+            for cell in self._ring(cx, cy, r):
+                members = self._cells.get(cell)
+                if not members:
+                    continue
+                for key in members:
+                    px, py, _ = self._points[key]
+                    d2 = (px - x) ** 2 + (py - y) ** 2
+                    if d2 > limit or (len(heap) == k and d2 >= -heap[0][0]):
+                        continue
+                    if accept is not None and not accept(key):
+                        continue
+                    if len(heap) < k:
+                        heappush(heap, (-d2, key))
+                    else:
+                        heapreplace(heap, (-d2, key))
+        return sorted((math.sqrt(-d2), key) for d2, key in heap)
+
+
+class DriverLocator:
+    """Grid of latest driver positions, synced from telemetry, with dispatch ranking"""
+
+    def __init__(self, cell_miles=DISPATCH_GRID_MILES, refresh_seconds=DISPATCH_POSITION_REFRESH_SECONDS,
+                 max_age_seconds=DISPATCH_POSITION_MAX_AGE_SECONDS, fixes=None):
+        self.grid = SpatialGrid(cell_miles)
+        self.refresh_seconds = refresh_seconds
+        self.max_age_seconds = max_age_seconds
+        self._fixes = fixes or (lambda max_age: telemetry.get_ingestor().latest_fixes(max_age))
+        self._lock = threading.Lock()
+        self._seen = {}   # driver key -> recorded_at of the fix in the grid
+        self._synced_at = None
+
+    # ── positions ─────────────────────────────────────────────────────────────
+    def sync(self, force=False):
+        """Move drivers whose latest fix changed; drop the ones gone silent"""
+        if not force and self._synced_at is not None and time.monotonic() - self._synced_at < self.refresh_seconds:
+            return
+        fixes = self._fixes(self.max_age_seconds)
+        with self._lock:
+            current = set()
+            for driver_id, ping in fixes.items():
+                key = str(driver_id).lower()
+                current.add(key)
+                if self._seen.get(key) != ping[0]:
+                    self.grid.update(key, ping[1], ping[2])
+                    self._seen[key] = ping[0]
+            for key in [k for k in self._seen if k not in current]:
+                self.grid.remove(key)
+                del self._seen[key]
+            self._synced_at = time.monotonic()
+
+    def update(self, driver_id, latitude, longitude, recorded_at=None):
+        """Apply a fix directly (e.g. from a driver's own status report)"""
+        key = str(driver_id).lower()
+        with self._lock:
+            self.grid.update(key, latitude, longitude)
+            self._seen[key] = recorded_at if recorded_at is not None else time.time()
+
+    # ── queries ───────────────────────────────────────────────────────────────
+    def nearest_available(self, index, latitude, longitude, pickup_time, k=DISPATCH_CANDIDATES,
+                          max_miles=DISPATCH_MAX_MILES):
+        """[(DriverRecord, miles)] for the k nearest drivers free at pickup_time"""
+        pickup = parse_pickup_time(pickup_time)
+        self.sync()
+
+        def accept(key):
+            driver = index.driver(key)
+            return driver is not None and index.is_free(driver, pickup)
+
+        with self._lock:
+            found = self.grid.nearest(latitude, longitude, k, accept, max_miles)
+        return [(index.driver(key), miles) for miles, key in found]
+
+    def rank(self, index, pickup_address, pickup_time, k=DISPATCH_CANDIDATES, now=None):
+        """Scored candidates, best first, as dicts; None when position can't inform this pickup"""
+        if not pickup_address:
+            return None
+        pickup = parse_pickup_time(pickup_time)
+        minutes_until = ((pickup - (now or datetime.now())).total_seconds()) / 60
+        if minutes_until > DISPATCH_NEAR_TERM_MINUTES:
+            return None
+        point = get_distance_engine().geocode(pickup_address)
+        if point is None:
+            return None
+
+        candidates = []
+        for driver, miles in self.nearest_available(index, point[0], point[1], pickup, k):
+            load = driver.trips_on(pickup.date())
+            score, eta = dispatch_score(miles, driver.rating, load, minutes_until)
+            candidates.append({
+                'driver': driver,
+                'miles': round(miles, 2),
+                'eta_minutes': round(eta, 1),
+                'load': load,
+                'score': round(score, 2)
+            })
+        candidates.sort(key=lambda c: c['score'])
+        return candidates or None
+
+    def reserve(self, index, pickup_address, pickup_time, trip_id):
+        """Reserve the best-scored nearby driver, else the index's best-rated one"""
+        for candidate in self.rank(index, pickup_address, pickup_time) or ():
+            driver = index.reserve(pickup_time, trip_id, driver_id=candidate['driver'].driver_id)
+            if driver is not None:
+                return driver
+        return index.reserve(pickup_time, trip_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'located_drivers': len(self.grid),
+                'occupied_cells': len(self.grid._cells),
+                'cell_miles': self.grid.cell_miles,
+                'age_seconds': round(time.monotonic() - self._synced_at, 1) if self._synced_at else None
+            }
+
+
+_locator = DriverLocator()
+
+
+def get_driver_locator():
+    return _locator
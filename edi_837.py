@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Streaming EDI 837P (professional claim) export.
+
+One query returns every claim to export joined to its line items, ordered by
+payer, claim and line; rows are read with fetchmany() and segments are
+written as they are produced, so a month of claims never sits in memory.
+
+Claims in draft, pending or submitted status can be exported; paid, denied
+and partially paid claims cannot.  Envelopes are payer-sized: each payer
+gets its own ISA/IEA interchange with one GS/GE functional group, split into
+ST/SE transaction sets of at most EDI_MAX_CLAIMS_PER_TRANSACTION claims.
+Once the whole file has been produced, exported draft/pending claims are
+marked 'submitted' in bulk (submitted claims export without a status change).
+
+Endpoint:  POST /api/billing/edi/837
+           {"start_date": "2025-06-01", "end_date": "2025-06-30", "mark_submitted": true}
+CLI:       python3 edi_837.py --start 2025-06-01 --end 2025-06-30 --out june.837
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+from datetime import datetime, date, timedelta
+from itertools import groupby
+
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+
+from billing_aggregates import claims_changing
+from billing_system import payer_type_for
+from database import get_db_connection, db_connection
+
+edi_bp = Blueprint('edi_837', __name__)
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+EDI_SENDER_ID = os.environ.get('EDI_SENDER_ID', 'GOLDENVALLEY')
+EDI_RECEIVER_ID = os.environ.get('EDI_RECEIVER_ID', 'CLEARINGHOUSE')
+EDI_SUBMITTER_NAME = os.environ.get('EDI_SUBMITTER_NAME', 'GOLDEN VALLEY TRANSIT')
+EDI_SUBMITTER_PHONE = os.environ.get('EDI_SUBMITTER_PHONE', '6610000000')
+EDI_BILLING_NPI = os.environ.get('EDI_BILLING_NPI', '0000000000')
+EDI_BILLING_TIN = os.environ.get('EDI_BILLING_TIN', '000000000')
+EDI_BILLING_ADDRESS = os.environ.get('EDI_BILLING_ADDRESS', '')
+EDI_BILLING_CITY = os.environ.get('EDI_BILLING_CITY', 'BAKERSFIELD')
+EDI_BILLING_STATE = os.environ.get('EDI_BILLING_STATE', 'CA')
+EDI_BILLING_ZIP = os.environ.get('EDI_BILLING_ZIP', '93301')
+EDI_USAGE_INDICATOR = os.environ.get('EDI_USAGE_INDICATOR', 'T')  # T = test, P = production
+EDI_PAYER_IDS = json.loads(os.environ.get('EDI_PAYER_IDS', '{}'))  # insurance company -> payer id
+EDI_BATCH_SIZE = int(os.environ.get('EDI_BATCH_SIZE', 1000))
+EDI_MAX_CLAIMS_PER_TRANSACTION = int(os.environ.get('EDI_MAX_CLAIMS_PER_TRANSACTION', 5000))
+EDI_CHUNK_BYTES = 64 * 1024
+EDI_MARK_CHUNK = 1000
+EDI_CONTROL_NUMBER_START = int(os.environ.get('EDI_CONTROL_NUMBER_START', 1))  # first value of new sequences
+
+# Claims not yet paid or denied can be exported; only unsent ones are then marked
+# submitted ('submitted' claims, e.g. from /api/billing/submit-claim, export as-is)
+EXPORTABLE_STATUSES = ('draft', 'pending', 'submitted')
+MARKABLE_STATUSES = ('draft', 'pending')
+
+IMPLEMENTATION_GUIDE = '005010X222A1'
+
+# Claim filing indicator (SBR09) by payer_type
+FILING_INDICATORS = {'medi-cal': 'MC', 'medicare': 'MB', 'commercial': 'CI'}
+
+# ISA13 / GS06 come from database sequences so every host and restart shares them;
+# clearinghouses reject a reused interchange control number
+CONTROL_SEQUENCES = {'isa': 'billing.edi_isa_control_number', 'gs': 'billing.edi_gs_control_number'}
+SEQUENCE_SQL = """
+    IF OBJECT_ID('{name}', 'SO') IS NULL
+        CREATE SEQUENCE {name} AS INT START WITH {start} MINVALUE 1 MAXVALUE 999999999 CYCLE;
+"""
+_sequences_ready = False
+
+EXPORT_SQL = """
+    SELECT
+        c.claim_id, c.claim_number, c.service_date, c.total_amount,
+        pi.insurance_company, pi.policy_number,
+        p.first_name, p.last_name, p.date_of_birth,
+        li.line_number, li.service_code, li.quantity, li.line_total
+    FROM billing.claims c
+    INNER JOIN medical.patients p ON c.patient_id = p.patient_id
+    INNER JOIN medical.patient_insurance pi ON c.insurance_id = pi.insurance_id
+    INNER JOIN billing.claim_line_items li ON li.claim_id = c.claim_id
+    WHERE c.claim_status = ?
+      AND c.service_date >= ?
+      AND c.service_date < ?
+    ORDER BY pi.insurance_company, c.claim_id, li.line_number
+"""
+
+
+def next_control_number(name):
+    """Next value of an EDI control number sequence (a SEQUENCE in Azure SQL).
+
+    Uses its own pooled connection: the export's connection is busy streaming rows.
+    """
+    global _sequences_ready
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if not _sequences_ready:
+                for sequence in CONTROL_SEQUENCES.values():
+                    cursor.execute(SEQUENCE_SQL.format(name=sequence, start=EDI_CONTROL_NUMBER_START))
+                conn.commit()
+                _sequences_ready = True
+            cursor.execute(f"SELECT NEXT VALUE FOR {CONTROL_SEQUENCES[name]}")
+            value = cursor.fetchone()[0]
+            conn.commit()
+            return value
+        finally:
+            cursor.close()
+
+
+def clean(value, length=None):
+    """Element text with X12 delimiters stripped, upper-cased and optionally truncated"""
+    text = re.sub(r'[*~:^]', ' ', str(value if value is not None else '')).strip().upper()
+    return text[:length] if length else text
+
+
+def segment(*elements):
+    return '*'.join(elements).rstrip('*') + '~\n'
+
+
+def d8(value):
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.strftime('%Y%m%d') if value else ''
+
+
+def amount(value):
+    return f'{float(value or 0):.2f}'.rstrip('0').rstrip('.')
+
+
+def payer_id_for(insurance_company):
+    return EDI_PAYER_IDS.get(insurance_company) or clean(re.sub(r'[^A-Za-z0-9]', '', insurance_company or ''), 15)
+
+
+def fetch_rows(cursor, batch_size=EDI_BATCH_SIZE):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+# ── SEGMENT GENERATION ───────────────────────────────────────────────────────
+class TransactionSet:
+    """Tracks one ST/SE transaction set so SE can carry its segment count"""
+
+    def __init__(self, control_number, payer_name, payer_id):
+        self.control_number = f'{control_number:04d}'
+        self.segments = 0
+        self.claims = 0
+        self.hl = 0
+        self.payer_name = payer_name
+        self.payer_id = payer_id
+
+    def emit(self, *elements):
+        self.segments += 1
+        return segment(*elements)
+
+    def header(self, now):
+        out = [
+            self.emit('ST', '837', self.control_number, IMPLEMENTATION_GUIDE),
+            self.emit('BHT', '0019', '00', f'{EDI_SENDER_ID}{self.control_number}', now.strftime('%Y%m%d'), now.strftime('%H%M'), 'CH'),
+            self.emit('NM1', '41', '2', clean(EDI_SUBMITTER_NAME, 60), '', '', '', '', '46', clean(EDI_SENDER_ID)),
+            self.emit('PER', 'IC', 'BILLING', 'TE', clean(EDI_SUBMITTER_PHONE)),
+            self.emit('NM1', '40', '2', clean(self.payer_name, 60), '', '', '', '', '46', self.payer_id),
+        ]
+        self.hl = 1
+        out += [
+            self.emit('HL', '1', '', '20', '1'),
+            self.emit('NM1', '85', '2', clean(EDI_SUBMITTER_NAME, 60), '', '', '', '', 'XX', EDI_BILLING_NPI),
+            self.emit('N3', clean(EDI_BILLING_ADDRESS, 55) or 'UNKNOWN'),
+            self.emit('N4', clean(EDI_BILLING_CITY, 30), clean(EDI_BILLING_STATE, 2), clean(EDI_BILLING_ZIP, 15)),
+            self.emit('REF', 'EI', EDI_BILLING_TIN),
+        ]
+        return ''.join(out)
+
+    def claim(self, rows):
+        first = rows[0]
+        (_, claim_number, service_date, total_amount, company, policy_number,
+         first_name, last_name, date_of_birth) = first[:9]
+        self.hl += 1
+        self.claims += 1
+        out = [
+            self.emit('HL', str(self.hl), '1', '22', '0'),
+            self.emit('SBR', 'P', '18', '', '', '', '', '', '', FILING_INDICATORS[payer_type_for(company)]),
+            self.emit('NM1', 'IL', '1', clean(last_name, 60), clean(first_name, 35), '', '', '', 'MI', clean(policy_number, 80)),
+        ]
+        if date_of_birth:
+            out.append(self.emit('DMG', 'D8', d8(date_of_birth)))
+        out += [
+            self.emit('NM1', 'PR', '2', clean(self.payer_name, 60), '', '', '', '', 'PI', self.payer_id),
+            # Place of service 41 (ambulance - land), original claim, provider signature on file
+            self.emit('CLM', clean(claim_number, 38), amount(total_amount), '', '', '41:B:1', 'Y', 'A', 'Y', 'Y'),
+        ]
+        for index, row in enumerate(rows, start=1):
+            service_code, quantity, line_total = row[10], row[11], row[12]
+            out += [
+                self.emit('LX', str(index)),
+                self.emit('SV1', f'HC:{clean(service_code, 48)}', amount(line_total), 'UN', amount(quantity), '', '', '1'),
+                self.emit('DTP', '472', 'D8', d8(service_date)),
+            ]
+        return ''.join(out)
+
+    def trailer(self):
+        self.segments += 1
+        return segment('SE', str(self.segments), self.control_number)
+
+
+def generate_837(rows, exported, now=None, max_claims=EDI_MAX_CLAIMS_PER_TRANSACTION):
+    """Yield 837P text for rows ordered by payer, claim, line; appends exported claim ids to `exported`"""
+    now = now or datetime.now()
+    for company, payer_rows in groupby(rows, key=lambda row: row[4]):
+        payer_id = payer_id_for(company)
+        isa = next_control_number('isa')
+        gs = next_control_number('gs')
+
+        yield segment(
+            'ISA', '00', ' ' * 10, '00', ' ' * 10,
+            'ZZ', clean(EDI_SENDER_ID, 15).ljust(15), 'ZZ', clean(EDI_RECEIVER_ID, 15).ljust(15),
+            now.strftime('%y%m%d'), now.strftime('%H%M'), '^', '00501', f'{isa:09d}', '0', EDI_USAGE_INDICATOR, ':'
+        )
+        yield segment('GS', 'HC', clean(EDI_SENDER_ID), clean(EDI_RECEIVER_ID),
+                      now.strftime('%Y%m%d'), now.strftime('%H%M'), str(gs), 'X', IMPLEMENTATION_GUIDE)
+
+        transactions = 0
+        current = None
+        for claim_id, claim_rows in groupby(payer_rows, key=lambda row: row[0]):
+            if current is None or current.claims >= max_claims:
+                if current is not None:
+                    yield current.trailer()
+                transactions += 1
+                current = TransactionSet(transactions, company, payer_id)
+                yield current.header(now)
+            yield current.claim(list(claim_rows))
+            exported.append(claim_id)
+
+        yield current.trailer()
+        yield segment('GE', str(transactions), str(gs))
+        yield segment('IEA', '1', f'{isa:09d}')
+
+
+def buffered(chunks, size=EDI_CHUNK_BYTES):
+    """Coalesce small segment strings into ~size byte chunks for the response"""
+    parts = []
+    length = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(parts)
+            parts = []
+            length = 0
+    if parts:
+        yield ''.join(parts)
+
+
+def mark_claims_submitted(cursor, claim_ids, from_status, note):
+    """Move exported claims to 'submitted' with status history, set-based per chunk"""
+    if from_status not in MARKABLE_STATUSES:
+        raise ValueError(f'Claims in status {from_status!r} cannot be marked submitted')
+    for start in range(0, len(claim_ids), EDI_MARK_CHUNK):
+        chunk = claim_ids[start:start + EDI_MARK_CHUNK]
+        ids = json.dumps([str(claim_id) for claim_id in chunk])
+        with claims_changing(cursor, chunk):
+            cursor.execute("""
+                INSERT INTO billing.claim_status_history (claim_id, from_status, to_status, notes)
+                SELECT c.claim_id, c.claim_status, 'submitted', ?
+                FROM billing.claims c
+                INNER JOIN OPENJSON(?) WITH (claim_id NVARCHAR(50) '$') j ON c.claim_id = j.claim_id
+                WHERE c.claim_status = ?;
+
+                UPDATE c
+                SET claim_status = 'submitted',
+                    submission_date = GETDATE()
+                FROM billing.claims c
+                INNER JOIN OPENJSON(?) WITH (claim_id NVARCHAR(50) '$') j ON c.claim_id = j.claim_id
+                WHERE c.claim_status = ?;
+            """, (note, ids, from_status, ids, from_status))
+
+
+def stream_837(conn, cursor, status, mark_submitted):
+    """Stream the export, then mark what was exported once the last segment is out"""
+    exported = []
+    try:
+        yield from buffered(generate_837(fetch_rows(cursor), exported))
+
+        if mark_submitted and exported:
+            mark_claims_submitted(cursor, exported, status, f'Exported in EDI 837P batch ({len(exported)} claims)')
+            conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def parse_date(value, field):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} must be YYYY-MM-DD')
+
+
+@edi_bp.route('/api/billing/edi/837', methods=['POST'])
+def export_837():
+    """Stream an 837P file for claims in a status (default draft) and service date range"""
+    try:
+        data = request.json or {}
+
+        try:
+            start_date = parse_date(data.get('start_date'), 'start_date')
+            end_date = parse_date(data['end_date'], 'end_date') if data.get('end_date') else date.today()
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        status = data.get('status', 'draft')
+        if status not in EXPORTABLE_STATUSES:
+            return jsonify({
+                'success': False,
+                'error': f"status must be one of: {', '.join(EXPORTABLE_STATUSES)}"
+            }), 400
+        mark_submitted = bool(data.get('mark_submitted', True)) and status in MARKABLE_STATUSES
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(EXPORT_SQL, (status, start_date, end_date + timedelta(days=1)))
+
+        filename = f'837P_{start_date:%Y%m%d}_{end_date:%Y%m%d}.edi'
+        return Response(
+            stream_with_context(stream_837(conn, cursor, status, mark_submitted)),
+            mimetype='application/EDI-X12',
+            headers={
+                'Content-Disposition': f'attachment; filename={filename}',
+                'Cache-Control': 'no-store',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export claims as an EDI 837P file')
+    parser.add_argument('--start', required=True, help='First service date (YYYY-MM-DD)')
+    parser.add_argument('--end', default=None, help='Last service date (YYYY-MM-DD, default today)')
+    parser.add_argument('--status', default='draft', choices=EXPORTABLE_STATUSES,
+                        help='Claim status to export (default draft)')
+    parser.add_argument('--out', default=None, help='Output file (default stdout)')
+    parser.add_argument('--no-mark', action='store_true', help='Do not mark exported claims submitted')
+    args = parser.parse_args()
+
+    start_date = parse_date(args.start, '--start')
+    end_date = parse_date(args.end, '--end') if args.end else date.today()
+    mark_submitted = not args.no_mark and args.status in MARKABLE_STATUSES
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(EXPORT_SQL, (args.status, start_date, end_date + timedelta(days=1)))
+
+        exported = []
+        out = open(args.out, 'w', newline='') if args.out else sys.stdout
+        try:
+            for chunk in buffered(generate_837(fetch_rows(cursor), exported)):
+                out.write(chunk)
+        finally:
+            if args.out:
+                out.close()
+
+        if mark_submitted and exported:
+            mark_claims_submitted(cursor, exported, args.status, f'Exported in EDI 837P batch ({len(exported)} claims)')
+            conn.commit()
+        cursor.close()
+
+    print(f"Exported {len(exported)} claims{' (not marked submitted)' if not mark_submitted else ''}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+"""
+Batch insurance eligibility verification.
+
+verify_many() runs a list of eligibility lookups through a bounded thread
+pool.  Each payer channel (Medi-Cal, Availity for everything else) has its
+own concurrency limit so one slow payer cannot take every worker, and
+identical (payer, policy_number) lookups in a batch are made once.
+
+Responses are cached per (payer, policy_number) for ELIGIBILITY_CACHE_TTL
+seconds in the node-local 'eligibility' store, shared by all workers on the
+host; failed lookups are not cached.  Results are written back to
+medical.patient_insurance in one set-based upsert per batch.
+
+Backends (ELIGIBILITY_BACKEND):
+  payer - insurance_verification.dispatch_verification(), i.e. the Medi-Cal
+          and Availity integrations (default)
+  fake  - deterministic responses after ELIGIBILITY_FAKE_LATENCY seconds,
+          for tests and load runs without payer access
+
+Endpoint:  POST /api/insurance/verify-batch
+           {"patients": [{"patient_id": ..., "insurance_company": ..., "policy_number": ...}]}
+CLI:       python3 eligibility.py patients.csv [--dry-run]
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from flask import Blueprint, request, jsonify
+
+from database import get_db_connection, db_connection
+from insurance_verification import dispatch_verification
+from local_store import get_store, transaction
+
+eligibility_bp = Blueprint('eligibility', __name__)
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+ELIGIBILITY_BACKEND = os.environ.get('ELIGIBILITY_BACKEND', 'payer')
+ELIGIBILITY_MAX_WORKERS = int(os.environ.get('ELIGIBILITY_MAX_WORKERS', 16))
+ELIGIBILITY_DEFAULT_CONCURRENCY = int(os.environ.get('ELIGIBILITY_DEFAULT_CONCURRENCY', 4))
+# e.g. {"medi-cal": 4, "availity": 8}
+ELIGIBILITY_PAYER_CONCURRENCY = json.loads(os.environ.get('ELIGIBILITY_PAYER_CONCURRENCY', '{}'))
+# Requests per second per channel, e.g. {"medi-cal": 5}; unlisted channels are unpaced
+ELIGIBILITY_PAYER_RATE_LIMITS = json.loads(os.environ.get('ELIGIBILITY_PAYER_RATE_LIMITS', '{}'))
+ELIGIBILITY_CACHE_TTL = float(os.environ.get('ELIGIBILITY_CACHE_TTL', 24 * 3600))
+ELIGIBILITY_CACHE_STORE = os.environ.get('ELIGIBILITY_CACHE_STORE', 'eligibility')
+ELIGIBILITY_FAKE_LATENCY = float(os.environ.get('ELIGIBILITY_FAKE_LATENCY', 0.5))
+ELIGIBILITY_MAX_BATCH = int(os.environ.get('ELIGIBILITY_MAX_BATCH', 5000))
+
+CACHE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS eligibility_cache (
+        payer          TEXT NOT NULL,
+        policy_number  TEXT NOT NULL,
+        response       TEXT NOT NULL,
+        fetched_at     REAL NOT NULL,
+        PRIMARY KEY (payer, policy_number)
+    );
+"""
+
+
+def payer_channel(insurance_company):
+    """The payer system an eligibility lookup goes to"""
+    company = (insurance_company or '').lower()
+    if 'medi-cal' in company or 'medicaid' in company:
+        return 'medi-cal'
+    return 'availity'
+
+
+def cache_payer(insurance_company):
+    """Cache key component: Medi-Cal is one payer, commercial payers are per company"""
+    channel = payer_channel(insurance_company)
+    return channel if channel == 'medi-cal' else f"availity:{(insurance_company or '').strip().lower()}"
+
+
+# ── BACKENDS ──────────────────────────────────────────────────────────────────
+class PayerBackend:
+    """The live Medi-Cal / Availity integrations"""
+
+    def verify(self, insurance_company, policy_number, group_number=None):
+        return dispatch_verification(insurance_company, policy_number, group_number)
+
+
+class FakePayerBackend:
+    """Deterministic offline payer: answers after `latency` seconds (+/- jitter)
+
+    Policies starting with 'INACTIVE' come back inactive, 'ERROR' raise, and
+    fail_rate makes that share of calls raise at random.
+    """
+
+    def __init__(self, latency=ELIGIBILITY_FAKE_LATENCY, jitter=0.2, fail_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def verify(self, insurance_company, policy_number, group_number=None):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+        policy = (policy_number or '').upper()
+        if policy.startswith('ERROR') or (self.fail_rate and random.random() < self.fail_rate):
+            raise RuntimeError(f'Simulated payer timeout for {policy_number}')
+
+        year = date.today().year
+        medi_cal = payer_channel(insurance_company) == 'medi-cal'
+        active = not policy.startswith('INACTIVE')
+        # Stable per policy, so repeated runs agree
+        seed = int(hashlib.sha256(policy.encode()).hexdigest()[:8], 16)
+        return {
+            'verified': True,
+            'active': active,
+            'coverage_type': 'Medi-Cal' if medi_cal else insurance_company,
+            'effective_date': f'{year}-01-01',
+            'expiration_date': f'{year}-12-31',
+            'prior_auth_required': not medi_cal and seed % 2 == 0,
+            'copay': 0.00 if medi_cal else float(10 + seed % 4 * 5),
+            'deductible': 0.00 if medi_cal else 250.00,
+            'message': 'Coverage verified and active' if active else 'Coverage inactive'
+        }
+
+
+def default_backend():
+    if ELIGIBILITY_BACKEND.lower() == 'fake':
+        return FakePayerBackend()
+    return PayerBackend()
+
+
+# ── CACHE ─────────────────────────────────────────────────────────────────────
+class EligibilityCache:
+    """Payer responses per (payer, policy_number) with a TTL, in the node-local store"""
+
+    def __init__(self, store=ELIGIBILITY_CACHE_STORE, ttl=ELIGIBILITY_CACHE_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    def _db(self):
+        return get_store(self.store, CACHE_SCHEMA)
+
+    def get_many(self, keys):
+        """{(payer, policy_number): response} for the keys with a fresh entry"""
+        if not keys or self.ttl <= 0:
+            return {}
+        cutoff = time.time() - self.ttl
+        found = {}
+        db = self._db()
+        keys = list(keys)
+        for start in range(0, len(keys), 400):
+            chunk = keys[start:start + 400]
+            rows = db.execute(f"""
+                SELECT payer, policy_number, response FROM eligibility_cache
+                WHERE fetched_at >= ? AND ({' OR '.join(['(payer = ? AND policy_number = ?)'] * len(chunk))})
+            """, [cutoff] + [value for key in chunk for value in key]).fetchall()
+            for row in rows:
+                found[(row['payer'], row['policy_number'])] = json.loads(row['response'])
+        return found
+
+    def put_many(self, responses):
+        if not responses or self.ttl <= 0:
+            return
+        now = time.time()
+        db = self._db()
+        with transaction(db):
+            db.executemany("""
+                INSERT OR REPLACE INTO eligibility_cache (payer, policy_number, response, fetched_at)
+                VALUES (?, ?, ?, ?)
+            """, [(payer, policy, json.dumps(response), now) for (payer, policy), response in responses.items()])
+            db.execute("DELETE FROM eligibility_cache WHERE fetched_at < ?", (now - self.ttl,))
+
+    def invalidate(self, payer=None, policy_number=None):
+        if payer is None:
+            self._db().execute("DELETE FROM eligibility_cache")
+        else:
+            self._db().execute("DELETE FROM eligibility_cache WHERE payer = ? AND policy_number = ?",
+                               (payer, policy_number))
+
+
+# ── VERIFICATION ──────────────────────────────────────────────────────────────
+class RateLimiter:
+    """Spaces calls from any number of threads to at most `rate` per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class EligibilityVerifier:
+    """Runs lookups on a bounded pool with a concurrency limit (and optional rate) per payer channel"""
+
+    def __init__(self, backend=None, cache=None, max_workers=ELIGIBILITY_MAX_WORKERS,
+                 payer_concurrency=None, default_concurrency=ELIGIBILITY_DEFAULT_CONCURRENCY,
+                 payer_rate_limits=None):
+        self.backend = backend or default_backend()
+        self.cache = cache or EligibilityCache()
+        self.max_workers = max_workers
+        limits = dict(ELIGIBILITY_PAYER_CONCURRENCY, **(payer_concurrency or {}))
+        self._limits = {channel: threading.BoundedSemaphore(limit) for channel, limit in limits.items()}
+        self._default_concurrency = default_concurrency
+        self._limits_lock = threading.Lock()
+        rates = dict(ELIGIBILITY_PAYER_RATE_LIMITS, **(payer_rate_limits or {}))
+        self._rates = {channel: RateLimiter(rate) for channel, rate in rates.items() if rate > 0}
+
+    def _limit(self, channel):
+        with self._limits_lock:
+            if channel not in self._limits:
+                self._limits[channel] = threading.BoundedSemaphore(self._default_concurrency)
+            return self._limits[channel]
+
+    def _lookup(self, entry):
+        channel = payer_channel(entry['insurance_company'])
+        started = time.monotonic()
+        with self._limit(channel):
+            if channel in self._rates:
+                self._rates[channel].wait()
+            waited = time.monotonic() - started
+            started = time.monotonic()
+            try:
+                response = self.backend.verify(entry['insurance_company'], entry['policy_number'],
+                                               entry.get('group_number'))
+                error = None
+            except Exception as e:
+                response = None
+                error = str(e)[:500]
+        return channel, response, error, waited, time.monotonic() - started
+
+    def verify_many(self, entries, use_cache=True):
+        """(results, summary): one result per entry, in order, with 'verification' or 'error' and 'source'"""
+        started = time.monotonic()
+        keys = [(cache_payer(e['insurance_company']), (e['policy_number'] or '').strip()) for e in entries]
+        unique = {}
+        for key, entry in zip(keys, entries):
+            unique.setdefault(key, entry)
+
+        cached = self.cache.get_many(unique.keys()) if use_cache else {}
+        to_fetch = [key for key in unique if key not in cached]
+
+        fetched = {}
+        errors = {}
+        channels = {}
+        if to_fetch:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(to_fetch)),
+                                    thread_name_prefix='eligibility') as pool:
+                for key, outcome in zip(to_fetch, pool.map(lambda k: self._lookup(unique[k]), to_fetch)):
+                    channel, response, error, waited, elapsed = outcome
+                    stats = channels.setdefault(channel, {'calls': 0, 'failures': 0, 'wait_seconds': 0.0, 'call_seconds': 0.0})
+                    stats['calls'] += 1
+                    stats['wait_seconds'] += waited
+                    stats['call_seconds'] += elapsed
+                    if error is None:
+                        fetched[key] = response
+                    else:
+                        stats['failures'] += 1
+                        errors[key] = error
+            self.cache.put_many(fetched)
+
+        results = []
+        for key, entry in zip(keys, entries):
+            result = dict(entry)
+            if key in errors:
+                result.update(error=errors[key], source='payer')
+            else:
+                result.update(verification=cached.get(key) or fetched[key],
+                              source='cache' if key in cached else 'payer')
+            results.append(result)
+
+        for stats in channels.values():
+            stats['wait_seconds'] = round(stats['wait_seconds'], 3)
+            stats['call_seconds'] = round(stats['call_seconds'], 3)
+
+        summary = {
+            'requested': len(entries),
+            'unique_lookups': len(unique),
+            'cache_hits': len(cached),
+            'payer_calls': len(to_fetch),
+            'failures': len(errors),
+            'by_channel': channels,
+            'duration_ms': round((time.monotonic() - started) * 1000, 1)
+        }
+        return results, summary
+
+
+def upsert_coverage(cursor, results):
+    """Write verified coverage to medical.patient_insurance set-based; returns (updated, inserted)"""
+    rows = []
+    for r in results:
+        v = r.get('verification')
+        if not v:
+            continue
+        rows.append((
+            str(r['patient_id']), r['insurance_company'], r['policy_number'], r.get('group_number') or '',
+            v['effective_date'], v['expiration_date'], bool(v['prior_auth_required']),
+            float(v.get('copay', 0) or 0), float(v.get('deductible', 0) or 0),
+            'active' if v['active'] else 'inactive'
+        ))
+    if not rows:
+        return 0, 0
+
+    cursor.execute("""
+        IF OBJECT_ID('tempdb..#eligibility') IS NOT NULL DROP TABLE #eligibility;
+
+        CREATE TABLE #eligibility (
+            patient_id         NVARCHAR(50) NOT NULL,
+            insurance_company  NVARCHAR(200) NOT NULL,
+            policy_number      NVARCHAR(100) NOT NULL,
+            group_number       NVARCHAR(100) NULL,
+            effective_date     DATE NULL,
+            expiration_date    DATE NULL,
+            prior_auth         BIT NOT NULL,
+            copay_amount       DECIMAL(10, 2) NOT NULL,
+            deductible_amount  DECIMAL(10, 2) NOT NULL,
+            status             NVARCHAR(20) NOT NULL
+        );
+    """)
+    cursor.fast_executemany = True
+    cursor.executemany("""
+        INSERT INTO #eligibility (
+            patient_id, insurance_company, policy_number, group_number, effective_date,
+            expiration_date, prior_auth, copay_amount, deductible_amount, status
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    cursor.fast_executemany = False
+
+    # Same target as /api/insurance/verify: one active record per patient (primary, newest first),
+    # else a new primary record
+    cursor.execute("""
+        ;WITH target AS (
+            SELECT pi.*,
+                   ROW_NUMBER() OVER (PARTITION BY pi.patient_id
+                                      ORDER BY pi.is_primary DESC, pi.created_at DESC) AS rn
+            FROM medical.patient_insurance pi
+            WHERE pi.status = 'active'
+              AND pi.patient_id IN (SELECT patient_id FROM #eligibility)
+        )
+        UPDATE pi
+        SET insurance_company = e.insurance_company,
+            policy_number = e.policy_number,
+            group_number = e.group_number,
+            effective_date = e.effective_date,
+            expiration_date = e.expiration_date,
+            prior_authorization_required = e.prior_auth,
+            copay_amount = e.copay_amount,
+            deductible_amount = e.deductible_amount,
+            status = e.status
+        FROM target pi
+        INNER JOIN #eligibility e ON pi.patient_id = e.patient_id
+        WHERE pi.rn = 1
+    """)
+    updated = cursor.rowcount
+
+    cursor.execute("""
+        INSERT INTO medical.patient_insurance (
+            patient_id, insurance_company, policy_number, group_number,
+            effective_date, expiration_date, prior_authorization_required,
+            copay_amount, deductible_amount, is_primary, status, created_at
+        )
+        SELECT e.patient_id, e.insurance_company, e.policy_number, e.group_number,
+               e.effective_date, e.expiration_date, e.prior_auth,
+               e.copay_amount, e.deductible_amount, 1, e.status, GETDATE()
+        FROM #eligibility e
+        WHERE NOT EXISTS (
+            SELECT 1 FROM medical.patient_insurance pi
+            WHERE pi.patient_id = e.patient_id AND pi.status = 'active'
+        )
+    """)
+    inserted = cursor.rowcount
+
+    cursor.execute("DROP TABLE #eligibility")
+    return updated, inserted
+
+
+def run_verification_batch(conn, entries, verifier=None, dry_run=False, use_cache=True):
+    """Verify entries and write the results back; returns (results, summary)"""
+    verifier = verifier or get_verifier()
+    # Later entries for the same patient win, as they would with sequential /verify calls
+    latest = {}
+    for entry in entries:
+        latest[str(entry['patient_id'])] = entry
+    results, summary = verifier.verify_many(list(latest.values()), use_cache=use_cache)
+
+    updated = inserted = 0
+    if not dry_run:
+        cursor = conn.cursor()
+        try:
+            updated, inserted = upsert_coverage(cursor, results)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    summary.update(
+        dry_run=dry_run,
+        active=sum(1 for r in results if r.get('verification', {}).get('active')),
+        inactive=sum(1 for r in results if r.get('verification') and not r['verification']['active']),
+        records_updated=updated,
+        records_inserted=inserted
+    )
+    return results, summary
+
+
+def validate_entries(entries):
+    """List of problems with the submitted entries (empty if they are usable)"""
+    problems = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            problems.append({'index': index, 'error': 'Entry is not an object'})
+            continue
+        missing = [f for f in ('patient_id', 'insurance_company', 'policy_number') if not entry.get(f)]
+        if missing:
+            problems.append({'index': index, 'error': f"Missing required field(s): {', '.join(missing)}"})
+    return problems
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_verifier():
+    global _verifier
+    if _verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                _verifier = EligibilityVerifier()
+    return _verifier
+
+
+@eligibility_bp.route('/api/insurance/verify-batch', methods=['POST'])
+def verify_insurance_batch():
+    """Verify eligibility for many patients concurrently and upsert their coverage"""
+    try:
+        data = request.get_json(silent=True) or {}
+        entries = data.get('patients') if isinstance(data, dict) else data
+        if not isinstance(entries, list) or not entries:
+            return jsonify({'success': False, 'error': 'Expected a non-empty "patients" array'}), 400
+        if len(entries) > ELIGIBILITY_MAX_BATCH:
+            return jsonify({
+                'success': False,
+                'error': f'Batch has {len(entries)} patients; the limit is {ELIGIBILITY_MAX_BATCH}'
+            }), 413
+
+        problems = validate_entries(entries)
+        if problems:
+            return jsonify({'success': False, 'error': 'Invalid entries', 'problems': problems}), 400
+
+        conn = get_db_connection()
+        results, summary = run_verification_batch(
+            conn, entries,
+            dry_run=request.args.get('dry_run') in ('1', 'true'),
+            use_cache=request.args.get('refresh') not in ('1', 'true')
+        )
+        conn.close()
+
+        return jsonify({
+            'success': True,
+            'summary': summary,
+            'results': [{
+                'patient_id': str(r['patient_id']),
+                'policy_number': r['policy_number'],
+                'source': r['source'],
+                'active': r['verification']['active'] if 'verification' in r else None,
+                'expiration_date': r['verification']['expiration_date'] if 'verification' in r else None,
+                'error': r.get('error')
+            } for r in results]
+        })
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify insurance eligibility for a CSV of patients')
+    parser.add_argument('path', help='CSV with patient_id, insurance_company, policy_number[, group_number]')
+    parser.add_argument('--dry-run', action='store_true', help='Verify without writing coverage back')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached payer responses')
+    args = parser.parse_args()
+
+    with open(args.path, newline='', encoding='utf-8-sig') as f:
+        entries = list(csv.DictReader(f))
+    problems = validate_entries(entries)
+    if problems:
+        for problem in problems:
+            print(f"Row {problem['index'] + 2}: {problem['error']}")
+        raise SystemExit(1)
+
+    with db_connection() as conn:
+        results, summary = run_verification_batch(conn, entries, dry_run=args.dry_run, use_cache=not args.refresh)
+
+    print(json.dumps(summary, indent=2))
+    for r in results:
+        if r.get('error'):
+            print(f"  {r['patient_id']} {r['policy_number']}: {r['error']}")
+
+
+if __name__ == '__main__':
+    main()
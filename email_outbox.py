@@ -0,0 +1,359 @@
+"""
+Asynchronous email outbox.
+
+Request handlers call enqueue_email(); the message is persisted in the local
+outbox store and the call returns immediately.  A small pool of background
+worker threads drains the outbox in batches through the configured transport,
+retrying failures with exponential backoff and moving messages that keep
+failing to 'dead' so they can be inspected.
+
+Message bodies can hold credentials (welcome emails carry a temporary
+password), so a body is kept only while delivery needs it: it is dropped
+when the message is sent or dead-lettered (the subject is kept for
+inspection), messages still undelivered after OUTBOX_MAX_AGE_SECONDS are
+dead-lettered, and dead rows are purged after OUTBOX_DEAD_RETENTION_SECONDS.
+
+Messages claimed by a worker carry a lease; if the worker dies mid-send the
+lease expires and another worker (or the restarted process) picks them up.
+
+Transports (EMAIL_TRANSPORT):
+  sendgrid - SendGrid HTTPS API (default)
+  fake     - records messages in memory, for tests and local development
+"""
+
+import json
+import os
+import random
+import threading
+import time
+
+from local_store import get_store, transaction
+from metrics import external_call
+
+try:
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail
+    SENDGRID_AVAILABLE = True
+except ImportError:
+    SENDGRID_AVAILABLE = False
+
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+OUTBOX_STORE = os.environ.get('EMAIL_OUTBOX_STORE', 'email_outbox')
+OUTBOX_WORKERS = int(os.environ.get('EMAIL_OUTBOX_WORKERS', 2))
+OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE', 20))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 6))
+OUTBOX_BACKOFF_BASE = float(os.environ.get('EMAIL_OUTBOX_BACKOFF_BASE', 5))
+OUTBOX_BACKOFF_MAX = float(os.environ.get('EMAIL_OUTBOX_BACKOFF_MAX', 900))
+OUTBOX_LEASE_SECONDS = float(os.environ.get('EMAIL_OUTBOX_LEASE_SECONDS', 120))
+OUTBOX_POLL_INTERVAL = float(os.environ.get('EMAIL_OUTBOX_POLL_INTERVAL', 5))
+OUTBOX_MAX_AGE_SECONDS = float(os.environ.get('EMAIL_OUTBOX_MAX_AGE_SECONDS', 24 * 3600))
+OUTBOX_DEAD_RETENTION_SECONDS = float(os.environ.get('EMAIL_OUTBOX_DEAD_RETENTION_SECONDS', 7 * 24 * 3600))
+OUTBOX_PURGE_INTERVAL = float(os.environ.get('EMAIL_OUTBOX_PURGE_INTERVAL', 600))
+
+# Dead-lettering keeps only the subject of the body
+DEAD_PAYLOAD_SQL = "json_object('subject', json_extract(payload, '$.subject'))"
+
+OUTBOX_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        message_id      INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind            TEXT NOT NULL,
+        recipient       TEXT NOT NULL,
+        payload         TEXT,
+        status          TEXT NOT NULL DEFAULT 'pending',
+        attempts        INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        lease_until     REAL,
+        last_error      TEXT,
+        created_at      REAL NOT NULL,
+        updated_at      REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox (status, next_attempt_at);
+"""
+
+
+class EmailDeliveryError(Exception):
+    """Raised by a transport when a message could not be delivered"""
+
+
+# ── TRANSPORTS ───────────────────────────────────────────────────────────────
+class SendGridTransport:
+    """Deliver through the SendGrid API, reusing one client per worker thread"""
+
+    def __init__(self, api_key=None, from_email=None):
+        self.api_key = api_key or os.environ.get('SENDGRID_API_KEY')
+        self.from_email = from_email or os.environ.get('SENDGRID_FROM_EMAIL', 'info@goldenvalleytransit.com')
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = SendGridAPIClient(self.api_key)
+        return client
+
+    def send(self, recipient, subject, html):
+        if not SENDGRID_AVAILABLE:
+            raise EmailDeliveryError('SendGrid not installed')
+        if not self.api_key:
+            raise EmailDeliveryError('SendGrid API key not configured')
+
+        message = Mail(
+            from_email=self.from_email,
+            to_emails=recipient,
+            subject=subject,
+            html_content=html
+        )
+        with external_call('sendgrid', 'send'):
+            response = self._client().send(message)
+        if response.status_code >= 300:
+            raise EmailDeliveryError(f'SendGrid returned status {response.status_code}')
+        return response.status_code
+
+
+class FakeTransport:
+    """In-memory transport for tests: records messages, optionally fails or sleeps"""
+
+    def __init__(self, fail_times=0, latency=0.0):
+        self.sent = []
+        self.fail_times = fail_times
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def send(self, recipient, subject, html):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.fail_times > 0:
+                self.fail_times -= 1
+                raise EmailDeliveryError('Simulated delivery failure')
+            self.sent.append({'recipient': recipient, 'subject': subject, 'html': html})
+        return 202
+
+
+def default_transport():
+    if os.environ.get('EMAIL_TRANSPORT', 'sendgrid').lower() == 'fake':
+        return FakeTransport()
+    return SendGridTransport()
+
+
+# ── OUTBOX ────────────────────────────────────────────────────────────────────
+class EmailOutbox:
+    """Persistent outbox drained by a pool of background worker threads"""
+
+    def __init__(self, store=OUTBOX_STORE, transport=None, workers=OUTBOX_WORKERS,
+                 batch_size=OUTBOX_BATCH_SIZE, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 backoff_base=OUTBOX_BACKOFF_BASE, backoff_max=OUTBOX_BACKOFF_MAX,
+                 lease_seconds=OUTBOX_LEASE_SECONDS, poll_interval=OUTBOX_POLL_INTERVAL,
+                 max_age_seconds=OUTBOX_MAX_AGE_SECONDS, dead_retention_seconds=OUTBOX_DEAD_RETENTION_SECONDS):
+        self.store = store
+        self.transport = transport or default_transport()
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_age_seconds = max_age_seconds
+        self.dead_retention_seconds = dead_retention_seconds
+        self._purged_at = 0.0
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+
+    def _db(self):
+        return get_store(self.store, OUTBOX_SCHEMA)
+
+    # ── producer side ─────────────────────────────────────────────────────────
+    def enqueue(self, kind, recipient, subject, html):
+        """Persist a message for delivery and wake a worker; returns the message id"""
+        now = time.time()
+        payload = json.dumps({'subject': subject, 'html': html})
+        cursor = self._db().execute("""
+            INSERT INTO outbox (kind, recipient, payload, status, next_attempt_at, created_at, updated_at)
+            VALUES (?, ?, ?, 'pending', ?, ?, ?)
+        """, (kind, recipient, payload, now, now, now))
+        self.start()
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    # ── worker side ───────────────────────────────────────────────────────────
+    def claim_batch(self):
+        """Lease up to batch_size due messages (pending, or sending with an expired lease)"""
+        now = time.time()
+        db = self._db()
+        with transaction(db):
+            rows = db.execute("""
+                SELECT message_id, recipient, payload, attempts
+                FROM outbox
+                WHERE (status = 'pending' AND next_attempt_at <= ?)
+                   OR (status = 'sending' AND lease_until < ?)
+                ORDER BY next_attempt_at
+                LIMIT ?
+            """, (now, now, self.batch_size)).fetchall()
+
+            if rows:
+                db.executemany("""
+                    UPDATE outbox SET status = 'sending', lease_until = ?, updated_at = ?
+                    WHERE message_id = ?
+                """, [(now + self.lease_seconds, now, row['message_id']) for row in rows])
+        return rows
+
+    def process_batch(self):
+        """Deliver one claimed batch; returns the number of messages attempted"""
+        rows = self.claim_batch()
+        if not rows:
+            return 0
+
+        delivered = []
+        retries = []
+        dead = []
+        for row in rows:
+            message = json.loads(row['payload'])
+            attempts = row['attempts'] + 1
+            try:
+                self.transport.send(row['recipient'], message['subject'], message['html'])
+                delivered.append(row['message_id'])
+            except Exception as e:
+                error = str(e)[:500]
+                if attempts >= self.max_attempts:
+                    dead.append((attempts, error, row['message_id']))
+                    print(f"Email {row['message_id']} to {row['recipient']} dead-lettered: {error}")
+                else:
+                    retries.append((attempts, self._next_attempt(attempts), error, row['message_id']))
+
+        now = time.time()
+        db = self._db()
+        with transaction(db):
+            # Sent messages keep their row for auditing but drop the body (it holds credentials)
+            db.executemany("""
+                UPDATE outbox SET status = 'sent', payload = NULL, lease_until = NULL,
+                    attempts = attempts + 1, last_error = NULL, updated_at = ?
+                WHERE message_id = ?
+            """, [(now, message_id) for message_id in delivered])
+            db.executemany("""
+                UPDATE outbox SET status = 'pending', lease_until = NULL,
+                    attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?
+                WHERE message_id = ?
+            """, [(attempts, due, error, now, message_id) for attempts, due, error, message_id in retries])
+            db.executemany(f"""
+                UPDATE outbox SET status = 'dead', payload = {DEAD_PAYLOAD_SQL}, lease_until = NULL,
+                    attempts = ?, last_error = ?, updated_at = ?
+                WHERE message_id = ?
+            """, [(attempts, error, now, message_id) for attempts, error, message_id in dead])
+
+        return len(rows)
+
+    def _next_attempt(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempts - 1)))
+        return time.time() + delay * random.uniform(0.8, 1.2)
+
+    def purge(self):
+        """Dead-letter messages too old to still hold a body, and delete old dead rows"""
+        now = time.time()
+        db = self._db()
+        with transaction(db):
+            expired = db.execute(f"""
+                UPDATE outbox SET status = 'dead', payload = {DEAD_PAYLOAD_SQL}, lease_until = NULL,
+                    last_error = 'Not delivered within the outbox max age', updated_at = ?
+                WHERE (status = 'pending' OR (status = 'sending' AND lease_until < ?)) AND created_at < ?
+            """, (now, now, now - self.max_age_seconds)).rowcount
+            removed = db.execute("""
+                DELETE FROM outbox WHERE status = 'dead' AND updated_at < ?
+            """, (now - self.dead_retention_seconds,)).rowcount
+        self._purged_at = now
+        return expired, removed
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if time.time() - self._purged_at > OUTBOX_PURGE_INTERVAL:
+                    self.purge()
+                if self.process_batch():
+                    continue
+            except Exception as e:
+                print(f"Email outbox worker error: {str(e)}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        """Start the worker pool for this process (idempotent, fork-aware)"""
+        pid = os.getpid()
+        if self._started_pid == pid or self.workers <= 0:
+            return
+        with self._start_lock:
+            if self._started_pid == pid:
+                return
+            self._stopping.clear()
+            self._threads = [
+                threading.Thread(target=self._run, name=f'email-outbox-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._started_pid = pid
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._started_pid = None
+
+    def drain(self):
+        """Synchronously deliver everything currently due (tests, CLI)"""
+        total = 0
+        while True:
+            count = self.process_batch()
+            if not count:
+                return total
+            total += count
+
+    # ── admin ─────────────────────────────────────────────────────────────────
+    def requeue_dead(self):
+        """Move dead-lettered messages that still have a body back to pending; returns how many"""
+        now = time.time()
+        cursor = self._db().execute("""
+            UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?,
+                created_at = ?, updated_at = ?
+            WHERE status = 'dead' AND json_extract(payload, '$.html') IS NOT NULL
+        """, (now, now, now))
+        self._wakeup.set()
+        return cursor.rowcount
+
+    def stats(self):
+        rows = self._db().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        counts = {row[0]: row[1] for row in rows}
+        oldest = self._db().execute(
+            "SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')"
+        ).fetchone()[0]
+        return {
+            'pending': counts.get('pending', 0),
+            'sending': counts.get('sending', 0),
+            'sent': counts.get('sent', 0),
+            'dead': counts.get('dead', 0),
+            'oldest_pending_age_seconds': round(time.time() - oldest, 1) if oldest else 0.0,
+            'workers': len(self._threads)
+        }
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = EmailOutbox()
+    return _outbox
+
+
+def enqueue_email(kind, recipient, subject, html):
+    """Queue an email for background delivery; never blocks on the network"""
+    return get_outbox().enqueue(kind, recipient, subject, html)
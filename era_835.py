@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+ERA 835 remittance ingestion.
+
+Replaces one /api/billing/post-payment call per claim with one upload per
+payer remittance file:
+
+  1. the 835 is parsed into one remittance per CLP (claim payment) segment,
+     carrying the BPR/TRN payment details and N1*PR payer of its transaction
+  2. CLP01 (our claim_number) is matched to billing.claims with one
+     OPENJSON lookup; unmatched remittances are reported, not posted
+  3. payments, claim totals/statuses and status history are written in a
+     single transaction per file, set-based from a staged temp table
+
+Each remittance gets a reference_number derived from the EFT/check trace and
+the payer's claim control number; remittances whose reference_number is
+already in billing.payments are skipped, so re-uploading a file is a no-op.
+
+Endpoint:  POST /api/billing/era/835   (multipart field "file" or raw body)
+           ?dry_run=1 parses and matches without posting
+CLI:       python3 era_835.py remit.835 [--dry-run]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+from flask import Blueprint, request, jsonify
+
+from billing_aggregates import claims_changing
+from database import get_db_connection, db_connection
+
+era_bp = Blueprint('era_835', __name__)
+
+ERA_MAX_BYTES = int(os.environ.get('ERA_MAX_BYTES', 20 * 1024 * 1024))
+
+# CLP02 claim status codes
+CLAIM_STATUS_DENIED = '4'
+CLAIM_STATUS_REVERSAL = '22'
+
+PAYMENT_METHODS = {'ACH': 'eft', 'CHK': 'check', 'FWT': 'wire', 'NON': 'none'}
+
+
+class Era835Error(Exception):
+    """Raised when a file is not a parseable 835"""
+
+
+def _date(value):
+    try:
+        return datetime.strptime(value, '%Y%m%d').date()
+    except (TypeError, ValueError):
+        return None
+
+
+def _amount(value):
+    try:
+        return round(float(value), 2)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def split_segments(text):
+    """List of element lists, using the delimiters declared in the ISA segment"""
+    text = text.lstrip()
+    if not text.startswith('ISA') or len(text) < 106:
+        raise Era835Error('File does not start with an ISA segment')
+    element_sep = text[3]
+    segment_term = text[105]
+    segments = []
+    for raw in text.split(segment_term):
+        raw = raw.strip('\r\n ')
+        if raw:
+            segments.append(raw.split(element_sep))
+    return segments
+
+
+def parse_835(text):
+    """Remittances (one dict per CLP) found in an 835 file"""
+    remittances = []
+    payment = {}
+    claim = None
+    transactions = 0
+
+    def element(seg, index):
+        return seg[index].strip() if len(seg) > index else ''
+
+    for seg in split_segments(text):
+        tag = seg[0]
+        if tag == 'ST':
+            if element(seg, 1) != '835':
+                raise Era835Error(f'Transaction set {element(seg, 1)} is not an 835')
+            payment = {}
+            claim = None
+            transactions += 1
+        elif tag == 'BPR':
+            payment['total'] = _amount(element(seg, 2))
+            payment['method'] = PAYMENT_METHODS.get(element(seg, 4), 'eft')
+            payment['date'] = _date(element(seg, 16))
+        elif tag == 'TRN':
+            payment['trace'] = element(seg, 2)
+        elif tag == 'DTM' and element(seg, 1) == '405' and not payment.get('date'):
+            payment['date'] = _date(element(seg, 2))
+        elif tag == 'N1' and element(seg, 1) == 'PR':
+            payment['payer_name'] = element(seg, 2)
+        elif tag == 'CLP':
+            claim = {
+                'claim_number': element(seg, 1),
+                'status_code': element(seg, 2),
+                'charge_amount': _amount(element(seg, 3)),
+                'payment_amount': _amount(element(seg, 4)),
+                'patient_responsibility': _amount(element(seg, 5)),
+                'payer_claim_number': element(seg, 7),
+                'adjustments': [],
+                'trace': payment.get('trace', ''),
+                'payment_method': payment.get('method', 'eft'),
+                'payment_date': payment.get('date'),
+                'payer_name': payment.get('payer_name', ''),
+            }
+            remittances.append(claim)
+        elif tag == 'CAS' and claim is not None:
+            # Group code followed by up to six (reason, amount, quantity) triplets
+            group = element(seg, 1)
+            for i in range(2, len(seg), 3):
+                reason = element(seg, i)
+                if reason:
+                    claim['adjustments'].append(f'{group}-{reason} {_amount(element(seg, i + 1)):.2f}')
+        elif tag == 'SE':
+            claim = None
+
+    if not transactions:
+        raise Era835Error('No 835 transaction sets found')
+
+    # Repeated CLPs for one claim in a trace (reversal + correction) need distinct references
+    seen = {}
+    for remit in remittances:
+        base = f"ERA-{remit['trace']}-{remit['payer_claim_number'] or remit['claim_number']}-{remit['status_code']}"
+        seen[base] = seen.get(base, 0) + 1
+        remit['reference_number'] = (base if seen[base] == 1 else f'{base}-{seen[base]}')[:100]
+    return remittances
+
+
+def match_claims(cursor, remittances):
+    """claim_number -> claim_id for every remitted claim number, in one lookup"""
+    numbers = sorted({r['claim_number'] for r in remittances if r['claim_number']})
+    if not numbers:
+        return {}
+    cursor.execute("""
+        SELECT c.claim_number, c.claim_id
+        FROM billing.claims c
+        INNER JOIN OPENJSON(?) WITH (claim_number NVARCHAR(50) '$') j ON c.claim_number = j.claim_number
+    """, (json.dumps(numbers),))
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+
+def already_posted(cursor, remittances):
+    """reference_numbers from this file that are already in billing.payments"""
+    references = [r['reference_number'] for r in remittances]
+    if not references:
+        return set()
+    cursor.execute("""
+        SELECT p.reference_number
+        FROM billing.payments p
+        INNER JOIN OPENJSON(?) WITH (reference_number NVARCHAR(100) '$') j ON p.reference_number = j.reference_number
+    """, (json.dumps(references),))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def post_remittances(cursor, remittances):
+    """Write payments, claim updates and history set-based; returns the number of payments posted"""
+    cursor.execute("""
+        IF OBJECT_ID('tempdb..#era_payments') IS NOT NULL DROP TABLE #era_payments;
+        IF OBJECT_ID('tempdb..#era_posted') IS NOT NULL DROP TABLE #era_posted;
+
+        CREATE TABLE #era_payments (
+            claim_id            NVARCHAR(50) NOT NULL,
+            payment_number      NVARCHAR(100) NOT NULL,
+            payment_date        DATE NOT NULL,
+            payment_amount      DECIMAL(12, 2) NOT NULL,
+            payment_method      NVARCHAR(20) NOT NULL,
+            check_number        NVARCHAR(100) NULL,
+            payer_name          NVARCHAR(200) NULL,
+            reference_number    NVARCHAR(100) NOT NULL,
+            notes               NVARCHAR(1000) NULL,
+            payer_claim_number  NVARCHAR(100) NULL,
+            denied              BIT NOT NULL,
+            denial_reason       NVARCHAR(500) NULL
+        );
+        CREATE TABLE #era_posted (reference_number NVARCHAR(100) NOT NULL);
+    """)
+
+    today = datetime.now().date()
+    rows = []
+    for r in remittances:
+        denied = r['status_code'] == CLAIM_STATUS_DENIED
+        notes = f"ERA 835 CLP status {r['status_code']}"
+        if r['adjustments']:
+            notes += f"; adjustments {', '.join(r['adjustments'])}"
+        rows.append((
+            str(r['claim_id']),
+            f"PMT-{(r['payment_date'] or today):%Y%m%d}-E{hashlib.sha1(r['reference_number'].encode()).hexdigest()[:8].upper()}",
+            r['payment_date'] or today,
+            r['payment_amount'],
+            r['payment_method'],
+            r['trace'][:100] if r['payment_method'] == 'check' else None,
+            r['payer_name'][:200],
+            r['reference_number'],
+            notes[:1000],
+            r['payer_claim_number'][:100] or None,
+            denied,
+            ', '.join(r['adjustments'])[:500] if denied else None
+        ))
+
+    cursor.fast_executemany = True
+    cursor.executemany("""
+        INSERT INTO #era_payments (
+            claim_id, payment_number, payment_date, payment_amount, payment_method,
+            check_number, payer_name, reference_number, notes, payer_claim_number,
+            denied, denial_reason
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    cursor.fast_executemany = False
+
+    # Re-check against billing.payments inside the transaction, so concurrent uploads of one file post once
+    cursor.execute("""
+        INSERT INTO billing.payments (
+            claim_id, payment_number, payment_date, payment_amount,
+            payment_method, check_number, payer_name, reference_number, notes
+        )
+        OUTPUT INSERTED.reference_number INTO #era_posted (reference_number)
+        SELECT s.claim_id, s.payment_number, s.payment_date, s.payment_amount,
+               s.payment_method, s.check_number, s.payer_name, s.reference_number, s.notes
+        FROM #era_payments s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM billing.payments p WITH (UPDLOCK, HOLDLOCK)
+            WHERE p.reference_number = s.reference_number
+        );
+    """)
+    cursor.execute("SELECT COUNT(*) FROM #era_posted")
+    posted = cursor.fetchone()[0]
+
+    cursor.execute("""
+        ;WITH per_claim AS (
+            SELECT s.claim_id,
+                   SUM(s.payment_amount) AS amount,
+                   MAX(s.payment_date) AS payment_date,
+                   MAX(s.payer_claim_number) AS payer_claim_number,
+                   MIN(CAST(s.denied AS INT)) AS denied,
+                   MAX(s.denial_reason) AS denial_reason,
+                   COUNT(*) AS remittances
+            FROM #era_payments s
+            INNER JOIN #era_posted posted ON posted.reference_number = s.reference_number
+            GROUP BY s.claim_id
+        )
+        SELECT per_claim.*, c.claim_status AS from_status
+        INTO #era_claims
+        FROM per_claim
+        INNER JOIN billing.claims c ON c.claim_id = per_claim.claim_id;
+
+        UPDATE c
+        SET paid_amount = c.paid_amount + e.amount,
+            payment_date = e.payment_date,
+            payer_claim_number = COALESCE(e.payer_claim_number, c.payer_claim_number),
+            denial_reason = CASE WHEN e.denied = 1 AND e.amount = 0 THEN e.denial_reason ELSE c.denial_reason END,
+            claim_status = CASE
+                WHEN e.denied = 1 AND c.paid_amount + e.amount <= 0 THEN 'denied'
+                WHEN (c.paid_amount + e.amount) >= c.total_amount THEN 'paid'
+                WHEN (c.paid_amount + e.amount) > 0 THEN 'partially_paid'
+                WHEN (c.paid_amount + e.amount) <= 0 THEN 'submitted'
+                ELSE c.claim_status
+            END
+        FROM billing.claims c
+        INNER JOIN #era_claims e ON c.claim_id = e.claim_id;
+
+        INSERT INTO billing.claim_status_history (claim_id, from_status, to_status, notes)
+        SELECT c.claim_id, e.from_status, c.claim_status,
+               CASE WHEN e.amount < 0 THEN 'ERA 835 payment reversed: $' ELSE 'ERA 835 payment posted: $' END
+               + CAST(e.amount AS NVARCHAR(20))
+        FROM billing.claims c
+        INNER JOIN #era_claims e ON c.claim_id = e.claim_id;
+
+        DROP TABLE #era_claims;
+        DROP TABLE #era_posted;
+        DROP TABLE #era_payments;
+    """)
+    return posted
+
+
+def import_remittance(conn, text, dry_run=False):
+    """Parse, match and post one 835 file; returns a summary report"""
+    started = time.monotonic()
+    remittances = parse_835(text)
+    cursor = conn.cursor()
+
+    claim_ids = match_claims(cursor, remittances)
+    matched = []
+    unmatched = []
+    for r in remittances:
+        claim_id = claim_ids.get(r['claim_number'])
+        if claim_id is None:
+            unmatched.append({
+                'claim_number': r['claim_number'],
+                'payer_claim_number': r['payer_claim_number'],
+                'payment_amount': r['payment_amount'],
+                'reason': 'No claim with this claim_number'
+            })
+        else:
+            r['claim_id'] = claim_id
+            matched.append(r)
+
+    duplicates = already_posted(cursor, matched)
+    to_post = [r for r in matched if r['reference_number'] not in duplicates]
+
+    posted = 0
+    if to_post and not dry_run:
+        try:
+            with claims_changing(cursor, {r['claim_id'] for r in to_post}):
+                posted = post_remittances(cursor, to_post)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    cursor.close()
+
+    return {
+        'dry_run': dry_run,
+        'remittances': len(remittances),
+        'matched': len(matched),
+        'posted': posted,
+        'already_posted': len(duplicates) + (len(to_post) - posted if not dry_run else 0),
+        'unmatched': unmatched,
+        'total_paid': round(sum(r['payment_amount'] for r in to_post), 2),
+        'denied': sum(1 for r in to_post if r['status_code'] == CLAIM_STATUS_DENIED),
+        'reversals': sum(1 for r in to_post if r['status_code'] == CLAIM_STATUS_REVERSAL),
+        'duration_ms': round((time.monotonic() - started) * 1000, 1)
+    }
+
+
+@era_bp.route('/api/billing/era/835', methods=['POST'])
+def upload_835():
+    """Post every claim payment in an uploaded 835 remittance file"""
+    try:
+        upload = request.files.get('file')
+        raw = upload.read(ERA_MAX_BYTES + 1) if upload is not None else request.get_data()
+        if not raw:
+            return jsonify({'success': False, 'error': 'No 835 file uploaded'}), 400
+        if len(raw) > ERA_MAX_BYTES:
+            return jsonify({'success': False, 'error': f'File exceeds {ERA_MAX_BYTES} bytes'}), 413
+
+        try:
+            text = raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            text = raw.decode('latin-1')
+
+        conn = get_db_connection()
+        try:
+            report = import_remittance(conn, text, dry_run=request.args.get('dry_run') in ('1', 'true'))
+        except Era835Error as e:
+            conn.close()
+            return jsonify({'success': False, 'error': str(e)}), 400
+        conn.close()
+
+        return jsonify({
+            'success': True,
+            'report': report
+        })
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Post payments from an ERA 835 remittance file')
+    parser.add_argument('path', help='835 file')
+    parser.add_argument('--dry-run', action='store_true', help='Parse and match without posting')
+    args = parser.parse_args()
+
+    with open(args.path, encoding='utf-8-sig', errors='replace') as f:
+        text = f.read()
+
+    with db_connection() as conn:
+        report = import_remittance(conn, text, dry_run=args.dry_run)
+
+    print(f"Remittances     : {report['remittances']}")
+    print(f"Matched         : {report['matched']}")
+    print(f"Posted          : {report['posted']}{' (dry run)' if args.dry_run else ''}")
+    print(f"Already posted  : {report['already_posted']}")
+    print(f"Denied          : {report['denied']}")
+    print(f"Reversals       : {report['reversals']}")
+    print(f"Total paid      : ${report['total_paid']:,.2f}")
+    print(f"Unmatched       : {len(report['unmatched'])}")
+    for line in report['unmatched']:
+        print(f"  {line['claim_number']:<24} {line['payer_claim_number']:<20} ${line['payment_amount']:,.2f}")
+    print(f"Duration        : {report['duration_ms']} ms")
+
+
+if __name__ == '__main__':
+    main()
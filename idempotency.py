@@ -0,0 +1,223 @@
+"""
+Idempotency-Key support for mutating endpoints.
+
+A client that may retry a POST (booking, claim generation, submission,
+payment posting) sends a unique Idempotency-Key header.  The first request
+with a key claims it in the node-local 'idempotency' store and runs
+normally; its response is stored for IDEMPOTENCY_TTL_SECONDS, and a retry
+with the same key gets the stored response back (with
+Idempotent-Replayed: true) without touching the database.
+
+  * a duplicate that arrives while the first request is still running waits
+    up to IDEMPOTENCY_WAIT_SECONDS for its result instead of running in
+    parallel, then gets 409 + Retry-After if it is still not done
+  * reusing a key for a different request (other path or body) is a 422
+  * 5xx responses are not stored; the key is released so a retry runs again
+  * a claim whose worker died is taken over after IDEMPOTENCY_PENDING_SECONDS
+
+Keys are scoped per endpoint and per API key (when api_auth resolved one).
+Requests without the header are not affected.
+
+The store is per host, so a retry only short-circuits when it reaches the
+same host as the original request (true for the single-host deployment).
+
+Credentials in a response (CREDENTIAL_FIELDS, e.g. a new patient's
+temporary password) are never written to the store: a replay returns the
+body without them, marked "credentials_redacted": true.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+from flask import g, jsonify, make_response, request
+
+from local_store import get_store, transaction
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 3600))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 30))
+IDEMPOTENCY_PENDING_SECONDS = float(os.environ.get('IDEMPOTENCY_PENDING_SECONDS', 300))
+IDEMPOTENCY_PURGE_SECONDS = float(os.environ.get('IDEMPOTENCY_PURGE_SECONDS', 600))
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'idempotency')
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+STORED_HEADERS = ('Content-Type', 'Location', 'Retry-After')
+CREDENTIAL_FIELDS = ('temporary_password', 'password', 'api_key', 'token')
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS responses (
+        scope        TEXT NOT NULL,
+        key          TEXT NOT NULL,
+        fingerprint  TEXT NOT NULL,
+        state        TEXT NOT NULL,
+        status       INTEGER,
+        headers      TEXT,
+        body         BLOB,
+        owner        TEXT,
+        created_at   REAL NOT NULL,
+        expires_at   REAL NOT NULL,
+        PRIMARY KEY (scope, key)
+    );
+    CREATE INDEX IF NOT EXISTS responses_expiry ON responses (expires_at);
+"""
+
+_purged_at = 0.0
+
+
+def _db():
+    return get_store(IDEMPOTENCY_STORE, SCHEMA)
+
+
+def _owner():
+    return f'{os.getpid()}:{threading.get_ident()}'
+
+
+def _purge(db, now):
+    global _purged_at
+    if now - _purged_at > IDEMPOTENCY_PURGE_SECONDS:
+        _purged_at = now
+        db.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+
+
+def claim(scope, key, fingerprint):
+    """Claim a key: ('claimed', None), ('done', row), ('pending', None) or ('mismatch', None)"""
+    db = _db()
+    now = time.time()
+    with transaction(db):
+        _purge(db, now)
+        row = db.execute("""
+            SELECT fingerprint, state, status, headers, body, created_at, expires_at
+            FROM responses WHERE scope = ? AND key = ?
+        """, (scope, key)).fetchone()
+
+        stale = row is not None and (
+            row['expires_at'] < now
+            or (row['state'] == 'pending' and now - row['created_at'] > IDEMPOTENCY_PENDING_SECONDS)
+        )
+        if row is None or stale:
+            db.execute("""
+                INSERT OR REPLACE INTO responses (scope, key, fingerprint, state, owner, created_at, expires_at)
+                VALUES (?, ?, ?, 'pending', ?, ?, ?)
+            """, (scope, key, fingerprint, _owner(), now, now + IDEMPOTENCY_TTL_SECONDS))
+            return 'claimed', None
+
+    if row['fingerprint'] != fingerprint:
+        return 'mismatch', None
+    if row['state'] == 'done':
+        return 'done', row
+    return 'pending', None
+
+
+def _stored_body(response):
+    """Response body with any credential fields removed"""
+    body = response.get_data()
+    if not response.is_json:
+        return body
+    payload = response.get_json(silent=True)
+    if not isinstance(payload, dict) or not any(field in payload for field in CREDENTIAL_FIELDS):
+        return body
+    payload = {k: v for k, v in payload.items() if k not in CREDENTIAL_FIELDS}
+    payload['credentials_redacted'] = True
+    return json.dumps(payload).encode()
+
+
+def complete(scope, key, response):
+    """Store the response for replay (the claim is released instead for 5xx)"""
+    db = _db()
+    if response.status_code >= 500:
+        db.execute("DELETE FROM responses WHERE scope = ? AND key = ? AND owner = ?", (scope, key, _owner()))
+        return
+    headers = {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+    db.execute("""
+        UPDATE responses
+        SET state = 'done', status = ?, headers = ?, body = ?, owner = NULL
+        WHERE scope = ? AND key = ? AND owner = ?
+    """, (response.status_code, json.dumps(headers), _stored_body(response), scope, key, _owner()))
+
+
+def release(scope, key):
+    _db().execute("DELETE FROM responses WHERE scope = ? AND key = ? AND owner = ?", (scope, key, _owner()))
+
+
+def _replay(row):
+    response = make_response(row['body'], row['status'])
+    for name, value in json.loads(row['headers'] or '{}').items():
+        response.headers[name] = value
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _wait_for(scope, key, fingerprint):
+    """Poll a claim held by another request until it completes or the wait runs out"""
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    delay = 0.02
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+        state, row = claim(scope, key, fingerprint)
+        if state != 'pending':
+            return state, row
+    return 'pending', None
+
+
+def idempotent(scope):
+    """View decorator: honour an Idempotency-Key header for this endpoint"""
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER, '').strip()
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return jsonify({'success': False, 'error': f'{HEADER} is longer than {MAX_KEY_LENGTH} characters'}), 400
+
+            api_key = g.get('api_key')
+            scoped = f"{scope}:{api_key['key_id']}" if api_key else scope
+            fingerprint = hashlib.sha256(
+                request.method.encode() + b' ' + request.full_path.encode() + b'\n' + request.get_data()
+            ).hexdigest()
+
+            try:
+                state, row = claim(scoped, key, fingerprint)
+                if state == 'pending':
+                    state, row = _wait_for(scoped, key, fingerprint)
+            except Exception as e:
+                # The store is an optimization; without it the request runs as before
+                print(f"Idempotency store error: {str(e)}")
+                return view(*args, **kwargs)
+
+            if state == 'done':
+                return _replay(row)
+            if state == 'mismatch':
+                return jsonify({
+                    'success': False,
+                    'error': f'{HEADER} was already used for a different request'
+                }), 422
+            if state == 'pending':
+                response = jsonify({
+                    'success': False,
+                    'error': 'A request with this Idempotency-Key is still being processed'
+                })
+                response.headers['Retry-After'] = '1'
+                return response, 409
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                release(scoped, key)
+                raise
+            try:
+                complete(scoped, key, response)
+            except Exception as e:
+                print(f"Idempotency store error: {str(e)}")
+            return response
+
+        return wrapper
+
+    return decorator
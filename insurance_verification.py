@@ -1,29 +1,10 @@
 from flask import Blueprint, request, jsonify
-import pyodbc
 from datetime import datetime, timedelta
-import os
 
-insurance_bp = Blueprint('insurance', __name__)
+from database import get_db_connection
+from metrics import external_call
 
-def get_db_connection():
-    """Get database connection"""
-    server = os.environ.get('DB_SERVER', 'partnership-sql-server-v2.database.windows.net')
-    database = os.environ.get('DB_DATABASE', 'golden-valley-transit-prod')
-    username = os.environ.get('DB_USERNAME', 'sqladmin')
-    password = os.environ.get('DB_PASSWORD', 'GoldenValley2025')
-    
-    connection_string = (
-        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-        f"SERVER={server};"
-        f"DATABASE={database};"
-        f"UID={username};"
-        f"PWD={password};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=no;"
-        f"Connection Timeout=30;"
-    )
-    
-    return pyodbc.connect(connection_string)
+insurance_bp = Blueprint('insurance', __name__)
 
 def verify_medi_cal(policy_number):
     """
@@ -64,6 +45,15 @@ def verify_commercial_insurance(insurance_company, policy_number, group_number=N
         'message': 'Coverage verified - prior authorization may be required'
     }
 
+def dispatch_verification(insurance_company, policy_number, group_number=None):
+    """Route an eligibility check to Medi-Cal or Availity based on the insurance company"""
+    company = (insurance_company or '').lower()
+    if 'medi-cal' in company or 'medicaid' in company:
+        with external_call('medi-cal', 'eligibility'):
+            return verify_medi_cal(policy_number)
+    with external_call('availity', 'eligibility'):
+        return verify_commercial_insurance(insurance_company, policy_number, group_number)
+
 @insurance_bp.route('/api/insurance/verify', methods=['POST'])
 def verify_insurance():
     """Verify patient insurance eligibility"""
@@ -79,16 +69,11 @@ def verify_insurance():
                 }), 400
         
         # Determine verification method based on insurance company
-        insurance_company = data['insurance_company'].lower()
-        
-        if 'medi-cal' in insurance_company or 'medicaid' in insurance_company:
-            verification = verify_medi_cal(data['policy_number'])
-        else:
-            verification = verify_commercial_insurance(
-                data['insurance_company'],
-                data['policy_number'],
-                data.get('group_number')
-            )
+        verification = dispatch_verification(
+            data['insurance_company'],
+            data['policy_number'],
+            data.get('group_number')
+        )
         
         # Save verification results to database
         conn = get_db_connection()
@@ -0,0 +1,379 @@
+"""
+Server-Sent Events push channel for the dispatch, driver and patient pages.
+
+Trip creation, driver assignment and status changes publish events to an
+EventBus instead of the pages re-running their trip queries on a timer.
+
+  * publish() appends the event to the node-local 'live_events' store, which
+    assigns the global event id.  One tail thread per worker reads new rows
+    (woken immediately for events published by the same worker, otherwise
+    every LIVE_POLL_INTERVAL seconds) and fans them out in process, so every
+    gunicorn worker on the host delivers every event.
+  * each SSE client holds a Subscription with optional driver / patient /
+    region filters and a bounded buffer.  A client that falls more than
+    LIVE_CLIENT_BUFFER events behind gets a single 'resync' event (refetch
+    your state) instead of unbounded memory growth.
+  * reconnecting clients send Last-Event-ID (EventSource does this on its
+    own); missed events still in the store (LIVE_RETENTION_SECONDS) are
+    replayed before live delivery resumes, without gaps or duplicates.
+  * a comment heartbeat every LIVE_HEARTBEAT_SECONDS keeps proxies from
+    closing idle streams; streams end after LIVE_MAX_STREAM_SECONDS and the
+    browser reconnects, so worker threads are recycled.
+
+Events are published only after the transaction that caused them commits:
+callers collect them (see trip_event) and hand them to publish_all().
+
+Streams hold a worker thread each, so the app runs on gthread workers
+(see Procfile).  The streams a worker accepts are capped below its thread
+count (GUNICORN_THREADS) so LIVE_RESERVED_THREADS always stay free for
+ordinary requests; LIVE_MAX_CLIENTS can only lower that cap.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from flask import Blueprint, Response, jsonify, request
+
+from distance_engine import get_distance_engine
+from local_store import get_store, transaction
+
+live_updates_bp = Blueprint('live_updates', __name__)
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+LIVE_STORE = os.environ.get('LIVE_STORE', 'live_events')
+LIVE_POLL_INTERVAL = float(os.environ.get('LIVE_POLL_INTERVAL', 0.25))
+LIVE_RETENTION_SECONDS = float(os.environ.get('LIVE_RETENTION_SECONDS', 3600))
+LIVE_CLIENT_BUFFER = int(os.environ.get('LIVE_CLIENT_BUFFER', 256))
+LIVE_HEARTBEAT_SECONDS = float(os.environ.get('LIVE_HEARTBEAT_SECONDS', 15))
+LIVE_MAX_STREAM_SECONDS = float(os.environ.get('LIVE_MAX_STREAM_SECONDS', 1800))
+LIVE_WORKER_THREADS = int(os.environ.get('GUNICORN_THREADS', 32))
+LIVE_RESERVED_THREADS = int(os.environ.get('LIVE_RESERVED_THREADS', max(4, LIVE_WORKER_THREADS // 4)))
+LIVE_MAX_CLIENTS = max(1, min(int(os.environ.get('LIVE_MAX_CLIENTS', LIVE_WORKER_THREADS)),
+                              LIVE_WORKER_THREADS - LIVE_RESERVED_THREADS))
+LIVE_RETRY_MS = int(os.environ.get('LIVE_RETRY_MS', 3000))
+
+EVENTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS events (
+        event_id    INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type  TEXT NOT NULL,
+        driver_id   TEXT,
+        patient_id  TEXT,
+        region      TEXT,
+        data        TEXT NOT NULL,
+        created_at  REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS ix_events_created ON events (created_at);
+"""
+
+EVENT_COLUMNS = 'event_id, event_type, driver_id, patient_id, region, data'
+
+
+def _event(row):
+    return {
+        'id': row[0],
+        'type': row[1],
+        'driver_id': row[2],
+        'patient_id': row[3],
+        'region': row[4],
+        'data': row[5]   # already JSON
+    }
+
+
+def _key(value):
+    return str(value).lower() if value not in (None, '') else None
+
+
+# ── SUBSCRIPTIONS ─────────────────────────────────────────────────────────────
+class Subscription:
+    """One client's filters and bounded event buffer"""
+
+    def __init__(self, driver_id=None, patient_id=None, region=None, buffer=LIVE_CLIENT_BUFFER):
+        self.driver_id = _key(driver_id)
+        self.patient_id = _key(patient_id)
+        self.region = _key(region)
+        self.buffer = buffer
+        self.needs_resync = False
+        self._events = deque()
+        self._last_id = 0
+        self._cond = threading.Condition()
+
+    def matches(self, event):
+        return ((self.driver_id is None or event['driver_id'] == self.driver_id)
+                and (self.patient_id is None or event['patient_id'] == self.patient_id)
+                and (self.region is None or event['region'] == self.region))
+
+    def offer(self, event):
+        with self._cond:
+            if event['id'] <= self._last_id:
+                return
+            self._last_id = event['id']
+            if len(self._events) >= self.buffer:
+                # Too far behind: drop the backlog and tell the client to refetch
+                self._events.clear()
+                self.needs_resync = True
+            else:
+                self._events.append(event)
+            self._cond.notify()
+
+    def resync_from(self, event_id):
+        with self._cond:
+            self._last_id = max(self._last_id, event_id)
+            self.needs_resync = True
+            self._cond.notify()
+
+    def take(self, timeout):
+        """(events, resync_id) -- waits up to `timeout` seconds for something to send"""
+        with self._cond:
+            if not self._events and not self.needs_resync:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            resync_id = self._last_id if self.needs_resync else None
+            self.needs_resync = False
+            return events, resync_id
+
+
+# ── BUS ───────────────────────────────────────────────────────────────────────
+class EventBus:
+    """Publish through the node-local store, fan out to this worker's subscribers"""
+
+    def __init__(self, store=LIVE_STORE, poll_interval=LIVE_POLL_INTERVAL, retention=LIVE_RETENTION_SECONDS):
+        self.store = store
+        self.poll_interval = poll_interval
+        self.retention = retention
+
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._last_id = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._started_pid = None
+        self._pruned_at = 0.0
+        self._stats = {'published': 0, 'delivered': 0, 'resyncs': 0}
+
+    def _db(self):
+        return get_store(self.store, EVENTS_SCHEMA)
+
+    def publish(self, event_type, data, driver_id=None, patient_id=None, region=None):
+        return self.publish_all([(event_type, data, driver_id, patient_id, region)])[0]
+
+    def publish_all(self, events):
+        """Publish (event_type, data, driver_id, patient_id, region) tuples; returns their ids"""
+        if not events:
+            return []
+        db = self._db()
+        now = time.time()
+        ids = []
+        with transaction(db):
+            for event_type, data, driver_id, patient_id, region in events:
+                cursor = db.execute("""
+                    INSERT INTO events (event_type, driver_id, patient_id, region, data, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (event_type, _key(driver_id), _key(patient_id), _key(region),
+                      json.dumps(data, default=str), now))
+                ids.append(cursor.lastrowid)
+        with self._lock:
+            self._stats['published'] += len(ids)
+        self._wake.set()
+        return ids
+
+    def latest_id(self):
+        row = self._db().execute('SELECT MAX(event_id) FROM events').fetchone()
+        return row[0] or 0
+
+    def subscribe(self, last_event_id=None, **filters):
+        """Register a subscription, replaying stored events after last_event_id first"""
+        self.start()
+        sub = Subscription(**filters)
+        with self._lock:
+            if self._last_id is None:
+                self._last_id = self.latest_id()
+            if last_event_id is not None and last_event_id < self._last_id:
+                db = self._db()
+                oldest = db.execute('SELECT MIN(event_id) FROM events').fetchone()[0]
+                if oldest is None or oldest > last_event_id + 1:
+                    # The events it missed were pruned; a full refetch is needed
+                    sub.resync_from(self._last_id)
+                    self._stats['resyncs'] += 1
+                else:
+                    rows = db.execute(f"""
+                        SELECT {EVENT_COLUMNS} FROM events
+                        WHERE event_id > ? AND event_id <= ?
+                        ORDER BY event_id
+                    """, (last_event_id, self._last_id)).fetchall()
+                    for event in map(_event, rows):
+                        if sub.matches(event):
+                            sub.offer(event)
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def pump(self):
+        """Deliver events published since the last pump (any worker) to matching subscribers"""
+        if self._last_id is None:
+            self._last_id = self.latest_id()
+            return 0
+        rows = self._db().execute(f"""
+            SELECT {EVENT_COLUMNS} FROM events WHERE event_id > ? ORDER BY event_id LIMIT 1000
+        """, (self._last_id,)).fetchall()
+
+        delivered = 0
+        with self._lock:
+            for event in map(_event, rows):
+                if event['id'] <= self._last_id:
+                    continue
+                for sub in self._subscribers:
+                    if sub.matches(event):
+                        sub.offer(event)
+                        delivered += 1
+                self._last_id = event['id']
+            self._stats['delivered'] += delivered
+
+        now = time.time()
+        if now - self._pruned_at > 60:
+            self._pruned_at = now
+            self._db().execute('DELETE FROM events WHERE created_at < ?', (now - self.retention,))
+        return delivered
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self.pump()
+            except Exception as e:
+                print(f"Live updates pump error: {str(e)}")
+
+    def start(self):
+        pid = os.getpid()
+        if self._started_pid == pid:
+            return
+        with self._lock:
+            if self._started_pid == pid:
+                return
+            # Subscribers and positions inherited from a forking parent are not ours
+            self._subscribers = set()
+            self._last_id = None
+            self._stopping.clear()
+            threading.Thread(target=self._run, name='live-updates-pump', daemon=True).start()
+            self._started_pid = pid
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        self._started_pid = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, subscribers=len(self._subscribers), last_event_id=self._last_id)
+
+
+bus = EventBus()
+
+
+def get_bus():
+    return bus
+
+
+# ── TRIP EVENTS ───────────────────────────────────────────────────────────────
+def trip_event(event_type, trip_id, patient_id=None, driver_id=None, pickup_address=None,
+               pickup_time=None, status=None, **extra):
+    """Event tuple for publish_all(); collect these and publish after the commit"""
+    try:
+        region = get_distance_engine().region(pickup_address) if pickup_address else None
+    except Exception:
+        region = None
+    data = dict(extra, trip_id=str(trip_id), patient_id=str(patient_id) if patient_id else None,
+                driver_id=str(driver_id) if driver_id else None, pickup_address=pickup_address,
+                pickup_time=str(pickup_time) if pickup_time else None, status=status, region=region)
+    return (event_type, data, driver_id, patient_id, region)
+
+
+def publish_all(events):
+    """Publish collected events; failures are logged, never raised into the caller"""
+    try:
+        return bus.publish_all(events)
+    except Exception as e:
+        print(f"Live updates publish error: {str(e)}")
+        return []
+
+
+# ── SSE ───────────────────────────────────────────────────────────────────────
+def format_sse(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
+
+
+def sse_stream(sub, heartbeat=LIVE_HEARTBEAT_SECONDS, max_seconds=LIVE_MAX_STREAM_SECONDS):
+    deadline = time.monotonic() + max_seconds
+    try:
+        yield f"retry: {LIVE_RETRY_MS}\n\n"
+        while time.monotonic() < deadline:
+            events, resync_id = sub.take(heartbeat)
+            if resync_id is not None:
+                yield format_sse(resync_id, 'resync', json.dumps({'reason': 'missed events, refetch state'}))
+            for event in events:
+                yield format_sse(event['id'], event['type'], event['data'])
+            if not events and resync_id is None:
+                yield ": heartbeat\n\n"
+    finally:
+        bus.unsubscribe(sub)
+
+
+def _last_event_id():
+    value = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def open_stream(driver_id=None, patient_id=None, region=None):
+    if bus.subscriber_count() >= LIVE_MAX_CLIENTS:
+        response = jsonify({'success': False, 'error': 'Too many live connections, retry shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    sub = bus.subscribe(last_event_id=_last_event_id(), driver_id=driver_id,
+                        patient_id=patient_id, region=region)
+    return Response(sse_stream(sub), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@live_updates_bp.route('/api/events/stream', methods=['GET'])
+def event_stream():
+    """All trip events, optionally filtered by ?driver_id=, ?patient_id=, ?region="""
+    return open_stream(request.args.get('driver_id'), request.args.get('patient_id'),
+                       request.args.get('region'))
+
+
+@live_updates_bp.route('/api/events/drivers/<driver_id>', methods=['GET'])
+def driver_event_stream(driver_id):
+    return open_stream(driver_id=driver_id)
+
+
+@live_updates_bp.route('/api/events/patients/<patient_id>', methods=['GET'])
+def patient_event_stream(patient_id):
+    return open_stream(patient_id=patient_id)
+
+
+@live_updates_bp.route('/api/events/dispatch', methods=['GET'])
+def dispatch_event_stream():
+    """Dispatcher feed: every trip event, or one region's with ?region=bakersfield"""
+    return open_stream(region=request.args.get('region'))
+
+
+@live_updates_bp.route('/api/events/stats', methods=['GET'])
+def event_stats():
+    return jsonify(dict(bus.stats(), success=True))
@@ -0,0 +1,75 @@
+"""
+Node-local persistent storage for state that must survive worker restarts and
+be shared by the gunicorn workers on the same host (email outbox, etc.).
+
+Backed by SQLite files under LOCAL_STORE_DIR in WAL mode.  Each thread gets
+its own connection per store; SQLite handles cross-process locking.
+"""
+
+import os
+import sqlite3
+import threading
+
+LOCAL_STORE_DIR = os.environ.get('LOCAL_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'var'))
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schemas_applied = set()
+
+
+def store_path(name):
+    """Path of the SQLite file backing store `name`
+
+    ':memory:' is rejected: connections are per thread but the schema is
+    applied once per process, so other threads would see an empty database.
+    """
+    if name == ':memory:':
+        raise ValueError("local_store does not support ':memory:'; use a file path")
+    if os.path.isabs(name):
+        return name
+    os.makedirs(LOCAL_STORE_DIR, exist_ok=True)
+    return os.path.join(LOCAL_STORE_DIR, f'{name}.db')
+
+
+def get_store(name, schema=None):
+    """Return this thread's connection to store `name`, creating the schema once per process"""
+    path = store_path(name)
+    key = (os.getpid(), path)
+
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        connections[key] = conn
+
+    if schema and key not in _schemas_applied:
+        with _schema_lock:
+            if key not in _schemas_applied:
+                conn.executescript(schema)
+                _schemas_applied.add(key)
+
+    return conn
+
+
+class transaction:
+    """`with transaction(conn):` runs a BEGIN IMMEDIATE ... COMMIT/ROLLBACK block"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
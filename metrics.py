@@ -0,0 +1,419 @@
+"""
+Low-overhead instrumentation with a Prometheus-format /metrics endpoint.
+
+What is measured:
+  * every request: latency histogram by method, route rule and status
+  * every SQL statement run through a pooled connection's cursor: latency
+    histogram and row counts by statement fingerprint (operation + first
+    table + short hash of the normalised SQL), plus slow-query logging
+  * connection pool checkout wait, and pool size/in-use gauges
+  * outbound calls (SendGrid, payer eligibility): latency by service and
+    outcome, through `with external_call(service, operation):`
+
+Recording is an in-process dict update under a per-metric lock, so it can
+stay on in production.  Each gunicorn worker periodically flushes a snapshot
+of its metrics to the node-local store; /metrics merges the live snapshots
+of every worker on the host, so a scrape sees the whole node no matter which
+worker answers it.
+
+Slow statements (METRICS_SLOW_QUERY_MS) and requests (METRICS_SLOW_REQUEST_MS)
+are also printed, with the normalised SQL or the route.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from local_store import get_store
+
+try:
+    from flask import g, request
+except ImportError:  # scripts import the database layer without Flask installed
+    g = request = None
+
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no')
+METRICS_SLOW_QUERY_MS = float(os.environ.get('METRICS_SLOW_QUERY_MS', 500))
+METRICS_SLOW_REQUEST_MS = float(os.environ.get('METRICS_SLOW_REQUEST_MS', 2000))
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 15))
+METRICS_STORE = os.environ.get('METRICS_STORE', 'metrics')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+SNAPSHOT_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS snapshots (
+        pid         INTEGER PRIMARY KEY,
+        updated_at  REAL NOT NULL,
+        data        TEXT NOT NULL
+    );
+"""
+
+
+# ── METRIC TYPES ──────────────────────────────────────────────────────────────
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), self._copy(value)] for labels, value in self._values.items()]
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def _copy(self, value):
+        return [list(value[0]), value[1]]
+
+
+_registry = {}
+_collectors = []
+
+
+def _register(metric):
+    _registry[metric.name] = metric
+    return metric
+
+
+def counter(name, help_text, labels=()):
+    return _register(Counter(name, help_text, labels))
+
+
+def gauge(name, help_text, labels=()):
+    return _register(Gauge(name, help_text, labels))
+
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram(name, help_text, labels, buckets))
+
+
+def register_collector(collect):
+    """`collect()` is called before every snapshot, to refresh gauges"""
+    _collectors.append(collect)
+
+
+REQUEST_SECONDS = histogram('http_request_duration_seconds', 'Request latency', ('method', 'route', 'status'))
+SLOW_REQUESTS = counter('http_slow_requests_total', 'Requests slower than METRICS_SLOW_REQUEST_MS', ('route',))
+SQL_SECONDS = histogram('sql_statement_duration_seconds', 'SQL statement execution time', ('statement',))
+SQL_ROWS = histogram('sql_statement_rows', 'Rows affected or fetched per SQL statement', ('statement',), ROW_BUCKETS)
+SQL_ERRORS = counter('sql_statement_errors_total', 'SQL statements that raised', ('statement',))
+SLOW_QUERIES = counter('sql_slow_statements_total', 'SQL statements slower than METRICS_SLOW_QUERY_MS', ('statement',))
+POOL_WAIT_SECONDS = histogram('db_pool_wait_seconds', 'Time spent waiting to check out a pooled connection')
+EXTERNAL_SECONDS = histogram('external_call_duration_seconds', 'Outbound call latency', ('service', 'operation', 'outcome'))
+
+
+# ── SQL ───────────────────────────────────────────────────────────────────────
+_WHITESPACE = re.compile(r'\s+')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+_OPERATION = re.compile(r'^\W*([A-Za-z]+)')
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|MERGE|JOIN)\s+((?:\[?\w+\]?\.)?\[?#?\w+\]?)', re.IGNORECASE)
+
+_fingerprints = {}
+_FINGERPRINT_CACHE_SIZE = 4096
+
+
+def normalize_sql(sql):
+    """SQL with literals, IN-lists of placeholders and whitespace collapsed"""
+    sql = _LITERALS.sub('?', sql)
+    sql = _PLACEHOLDER_LISTS.sub('?, ...', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def sql_fingerprint(sql):
+    """Stable, low-cardinality label for a statement, e.g. 'select billing.claims 1f3a9c0e'
+
+    The operation is the leading keyword, so CTE statements show as 'with'.
+    """
+    label = _fingerprints.get(sql)
+    if label is None:
+        normalized = normalize_sql(sql)
+        operation = _OPERATION.match(normalized)
+        table = _TABLE.search(normalized)
+        label = ' '.join([
+            operation.group(1).lower() if operation else 'sql',
+            table.group(1).replace('[', '').replace(']', '').lower() if table else '-',
+            hashlib.sha1(normalized.encode()).hexdigest()[:8]
+        ])
+        if len(_fingerprints) >= _FINGERPRINT_CACHE_SIZE:
+            _fingerprints.clear()
+        _fingerprints[sql] = label
+    return label
+
+
+class InstrumentedCursor:
+    """pyodbc cursor wrapper that times execute()/executemany() and counts rows"""
+
+    __slots__ = ('_cursor', '_statement')
+
+    def __init__(self, cursor):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_statement', None)
+
+    def _run(self, method, sql, args):
+        statement = sql_fingerprint(sql)
+        object.__setattr__(self, '_statement', statement)
+        started = time.perf_counter()
+        try:
+            method(sql, *args)
+        except Exception:
+            SQL_ERRORS.inc(statement)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            SQL_SECONDS.observe(elapsed, statement)
+            if elapsed * 1000 >= METRICS_SLOW_QUERY_MS:
+                SLOW_QUERIES.inc(statement)
+                print(f"Slow query ({elapsed * 1000:.0f} ms) [{statement}]: {normalize_sql(sql)[:500]}")
+        rowcount = self._cursor.rowcount
+        if rowcount is not None and rowcount >= 0:
+            SQL_ROWS.observe(rowcount, statement)
+        return self
+
+    def execute(self, sql, *args):
+        return self._run(self._cursor.execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return self._run(self._cursor.executemany, sql, args)
+
+    def _fetched(self, count):
+        if self._statement is not None:
+            SQL_ROWS.observe(count, self._statement)
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._fetched(len(rows))
+        return rows
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._fetched(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cursor.close()
+        return False
+
+
+def instrument_cursor(cursor):
+    return InstrumentedCursor(cursor) if METRICS_ENABLED else cursor
+
+
+# ── EXTERNAL CALLS ────────────────────────────────────────────────────────────
+@contextmanager
+def external_call(service, operation):
+    """Time an outbound call; outcome is 'ok' or 'error' (the exception propagates)"""
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        EXTERNAL_SECONDS.observe(time.perf_counter() - started, service, operation, outcome)
+
+
+# ── SNAPSHOTS ACROSS WORKERS ──────────────────────────────────────────────────
+def snapshot():
+    for collect in _collectors:
+        try:
+            collect()
+        except Exception as e:
+            print(f"Metrics collector error: {str(e)}")
+    return {
+        name: {
+            'kind': metric.kind,
+            'help': metric.help,
+            'labels': list(metric.labels),
+            'buckets': list(getattr(metric, 'buckets', ())),
+            'values': metric.snapshot()
+        }
+        for name, metric in _registry.items()
+    }
+
+
+def flush(store=METRICS_STORE):
+    """Write this worker's snapshot to the node-local store; returns it"""
+    data = snapshot()
+    db = get_store(store, SNAPSHOT_SCHEMA)
+    db.execute(
+        'INSERT OR REPLACE INTO snapshots (pid, updated_at, data) VALUES (?, ?, ?)',
+        (os.getpid(), time.time(), json.dumps(data))
+    )
+    return data
+
+
+def merge(snapshots):
+    """Sum counters, gauges and histogram buckets across worker snapshots"""
+    merged = {}
+    for data in snapshots:
+        for name, metric in data.items():
+            target = merged.setdefault(name, dict(metric, values={}))
+            for labels, value in metric['values']:
+                key = tuple(labels)
+                current = target['values'].get(key)
+                if current is None:
+                    target['values'][key] = value if metric['kind'] != 'histogram' else [list(value[0]), value[1]]
+                elif metric['kind'] == 'histogram':
+                    current[0] = [a + b for a, b in zip(current[0], value[0])]
+                    current[1] += value[1]
+                else:
+                    target['values'][key] = current + value
+    return merged
+
+
+def collect_node(store=METRICS_STORE):
+    """Merged metrics of every live worker on this host (this worker's are always fresh)"""
+    own = flush(store)
+    db = get_store(store, SNAPSHOT_SCHEMA)
+    cutoff = time.time() - max(3 * METRICS_FLUSH_SECONDS, 30)
+    db.execute('DELETE FROM snapshots WHERE updated_at < ?', (cutoff,))
+    others = [json.loads(row['data']) for row in
+              db.execute('SELECT data FROM snapshots WHERE pid != ?', (os.getpid(),)).fetchall()]
+    return merge([own] + others)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render(merged):
+    """Prometheus text exposition format (0.0.4)"""
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for labels, value in sorted(metric['values'].items()):
+            if metric['kind'] == 'histogram':
+                cumulative = 0
+                for bound, count in zip(list(metric['buckets']) + ['+Inf'], value[0]):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f"{name}_bucket{_label_text(metric['labels'], labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{_label_text(metric['labels'], labels)} {value[1]:.6f}")
+                lines.append(f"{name}_count{_label_text(metric['labels'], labels)} {cumulative}")
+            else:
+                lines.append(f"{name}{_label_text(metric['labels'], labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class Flusher:
+    """Background thread that publishes this worker's snapshot (fork-aware)"""
+
+    def __init__(self, interval=METRICS_FLUSH_SECONDS):
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._started_pid = None
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                flush()
+            except Exception as e:
+                print(f"Metrics flush error: {str(e)}")
+
+    def start(self):
+        pid = os.getpid()
+        if self._started_pid == pid or self.interval <= 0 or not METRICS_ENABLED:
+            return
+        self._stopping.clear()
+        threading.Thread(target=self._run, name='metrics-flush', daemon=True).start()
+        self._started_pid = pid
+
+    def stop(self):
+        self._stopping.set()
+        self._started_pid = None
+
+
+flusher = Flusher()
+
+
+# ── FLASK HOOKS ───────────────────────────────────────────────────────────────
+def _start_timer():
+    g.metrics_started = time.perf_counter()
+
+
+def _record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUEST_SECONDS.observe(elapsed, request.method, route, str(response.status_code))
+    if elapsed * 1000 >= METRICS_SLOW_REQUEST_MS:
+        SLOW_REQUESTS.inc(route)
+        print(f"Slow request ({elapsed * 1000:.0f} ms): {request.method} {request.path} -> {response.status_code}")
+    return response
+
+
+def init_app(app):
+    """Register request timing (first, so it includes the other hooks) and start flushing"""
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    flusher.start()
@@ -17,15 +17,32 @@ Usage:
     --plan "standard"
 
 Plans: standard | professional | enterprise | custom
+
+Bulk onboarding (e.g. a broker network) from a CSV or JSON manifest with
+columns name, email, contact, phone, plan:
+  python3 onboard_tenant.py --manifest operators.csv [--workers 8] [--dry-run]
+
+All tenant and API key rows are inserted in one transaction; containers and
+welcome emails are then provisioned concurrently.  Progress is checkpointed
+to <manifest>.checkpoint.json after every step, so rerunning the same command
+after a failure only retries what did not finish.
+
+Set ONBOARD_BACKEND=local to use the local stand-ins for blob storage and
+email (directories and JSON files under var/onboarding) instead of Azure.
 """
 
 import argparse
+import csv
 import hashlib
+import json
 import os
 import sys
+import threading
+import time
 import uuid
 import secrets
 import string
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 from pathlib import Path
@@ -44,9 +61,9 @@ except ImportError:
 
 try:
     from azure.storage.blob import BlobServiceClient
+    BLOB_AVAILABLE = True
 except ImportError:
-    print("ERROR: azure-storage-blob not installed. Run: pip install azure-storage-blob")
-    sys.exit(1)
+    BLOB_AVAILABLE = False
 
 try:
     from azure.communication.email import EmailClient
@@ -71,6 +88,13 @@ ACS_CONNECTION_STRING = os.environ.get('ACS_CONNECTION_STRING',
 
 ACS_SENDER = os.environ.get('ACS_SENDER', 'onboarding@nemtsystem.com')
 
+# azure | local (stand-ins under ONBOARD_LOCAL_DIR, for testing)
+ONBOARD_BACKEND   = os.environ.get('ONBOARD_BACKEND', 'azure')
+ONBOARD_LOCAL_DIR = os.environ.get('ONBOARD_LOCAL_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'var', 'onboarding'))
+ONBOARD_LOCAL_EMAIL_LATENCY = float(os.environ.get('ONBOARD_LOCAL_EMAIL_LATENCY', 0))
+ONBOARD_WORKERS   = int(os.environ.get('ONBOARD_WORKERS', 8))
+
 PLAN_LIMITS = {
     'standard':     {'providers': 10,  'monthly_rate': 299},
     'professional': {'providers': 50,  'monthly_rate': 799},
@@ -149,36 +173,104 @@ def create_api_key(conn, tenant_id, name):
     return raw_key
 
 
+# ── LOCAL STAND-INS ───────────────────────────────────────────────────────────
+class LocalBlobService:
+    """Stand-in for BlobServiceClient: each container is a directory"""
+
+    def __init__(self, root=None):
+        self.root = os.path.join(root or ONBOARD_LOCAL_DIR, 'blobs')
+        os.makedirs(self.root, exist_ok=True)
+        self.url = f"file://{self.root}"
+
+    def create_container(self, name):
+        try:
+            os.mkdir(os.path.join(self.root, name))
+        except FileExistsError:
+            raise Exception(f"ContainerAlreadyExists: {name}")
+
+
+class LocalEmailPoller:
+    def __init__(self, result, latency):
+        self._result  = result
+        self._latency = latency
+
+    def result(self):
+        time.sleep(self._latency)
+        return self._result
+
+
+class LocalEmailClient:
+    """Stand-in for the ACS EmailClient: each message is written out as a JSON file"""
+
+    def __init__(self, root=None, latency=None):
+        self.root    = os.path.join(root or ONBOARD_LOCAL_DIR, 'outbox')
+        self.latency = ONBOARD_LOCAL_EMAIL_LATENCY if latency is None else latency
+        os.makedirs(self.root, exist_ok=True)
+
+    def begin_send(self, message):
+        message_id = str(uuid.uuid4())
+        with open(os.path.join(self.root, f"{message_id}.json"), 'w') as f:
+            json.dump(message, f, indent=2)
+        return LocalEmailPoller({'id': message_id, 'status': 'Succeeded'}, self.latency)
+
+
+def get_blob_service():
+    if ONBOARD_BACKEND == 'local':
+        return LocalBlobService()
+    if not BLOB_AVAILABLE:
+        raise RuntimeError("azure-storage-blob not installed. Run: pip install azure-storage-blob")
+    return BlobServiceClient(account_url=f"https://{STORAGE_ACCOUNT_NAME}.blob.core.windows.net",
+                             credential=STORAGE_ACCOUNT_KEY)
+
+
+def get_email_client():
+    """The configured email client, or None when ACS is not installed"""
+    if ONBOARD_BACKEND == 'local':
+        return LocalEmailClient()
+    if not ACS_AVAILABLE:
+        return None
+    return EmailClient.from_connection_string(ACS_CONNECTION_STRING)
+
+
 # ── STEP 3: CREATE BLOB CONTAINER ─────────────────────────────────────────────
-def create_storage_container(tenant_id):
-    print(f"\n[3/4] Creating Azure Blob Storage container")
+def container_name_for(tenant_id):
+    return tenant_id.lower().replace('-', '')[:63]
 
-    container_name = tenant_id.lower().replace('-', '')[:63]
-    account_url    = f"https://{STORAGE_ACCOUNT_NAME}.blob.core.windows.net"
 
+def ensure_container(client, tenant_id):
+    """Create the tenant's container; returns (container_name, created)"""
+    container_name = container_name_for(tenant_id)
     try:
-        client = BlobServiceClient(account_url=account_url, credential=STORAGE_ACCOUNT_KEY)
         client.create_container(container_name)
-        print(f"    container : {container_name}")
-        print(f"    url       : {account_url}/{container_name}")
+        return container_name, True
     except Exception as e:
         if 'ContainerAlreadyExists' in str(e):
-            print(f"    container : {container_name} (already exists -- reusing)")
+            return container_name, False
+        raise
+
+
+def create_storage_container(tenant_id):
+    print(f"\n[3/4] Creating Azure Blob Storage container")
+
+    container_name = container_name_for(tenant_id)
+
+    try:
+        client = get_blob_service()
+        container_name, created = ensure_container(client, tenant_id)
+        if created:
+            print(f"    container : {container_name}")
+            print(f"    url       : {client.url.rstrip('/')}/{container_name}")
         else:
-            print(f"    WARNING: Storage container creation failed: {e}")
-            print(f"    Continuing -- container can be created manually later")
+            print(f"    container : {container_name} (already exists -- reusing)")
+    except Exception as e:
+        print(f"    WARNING: Storage container creation failed: {e}")
+        print(f"    Continuing -- container can be created manually later")
 
     return container_name
 
 
 # ── STEP 4: SEND WELCOME EMAIL ────────────────────────────────────────────────
-def send_welcome_email(email, contact_name, org_name, api_key, plan):
-    print(f"\n[4/4] Sending welcome email to {email}")
-
-    if not ACS_AVAILABLE:
-        print("    SKIPPED: azure-communication-email not installed")
-        return
-
+def build_welcome_message(email, contact_name, org_name, api_key, plan):
     limits = PLAN_LIMITS.get(plan, PLAN_LIMITS['standard'])
     rate   = f"${limits['monthly_rate']}/month" if limits['monthly_rate'] > 0 else "Custom pricing"
 
@@ -253,17 +345,26 @@ def send_welcome_email(email, contact_name, org_name, api_key, plan):
         f"nemtsystem.com"
     )
 
+    return {
+        "senderAddress": ACS_SENDER,
+        "recipients": {"to": [{"address": email, "displayName": contact_name}]},
+        "content": {
+            "subject": f"Welcome to NEMTsystem — {org_name} Account Ready",
+            "plainText": text_body,
+            "html": html_body,
+        },
+    }
+
+
+def send_welcome_email(email, contact_name, org_name, api_key, plan):
+    print(f"\n[4/4] Sending welcome email to {email}")
+
     try:
-        client  = EmailClient.from_connection_string(ACS_CONNECTION_STRING)
-        message = {
-            "senderAddress": ACS_SENDER,
-            "recipients": {"to": [{"address": email, "displayName": contact_name}]},
-            "content": {
-                "subject": f"Welcome to NEMTsystem — {org_name} Account Ready",
-                "plainText": text_body,
-                "html": html_body,
-            },
-        }
+        client = get_email_client()
+        if client is None:
+            print("    SKIPPED: azure-communication-email not installed")
+            return
+        message  = build_welcome_message(email, contact_name, org_name, api_key, plan)
         poller   = client.begin_send(message)
         result   = poller.result()
         print(f"    message_id: {result.get('id', 'sent')}")
@@ -273,20 +374,315 @@ def send_welcome_email(email, contact_name, org_name, api_key, plan):
         print(f"    Continuing -- email can be sent manually")
 
 
+# ── MANIFEST (BULK) MODE ──────────────────────────────────────────────────────
+def load_manifest(path):
+    """(tenants, problems) from a CSV with a header row or a JSON list / {"tenants": [...]}"""
+    if path.lower().endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        rows = data.get('tenants', []) if isinstance(data, dict) else data
+    else:
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            rows = list(csv.DictReader(f))
+
+    tenants, problems, seen = [], [], set()
+    for index, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            problems.append(f"Row {index}: not an object")
+            continue
+        row  = {str(k).strip().lower(): str(v).strip() for k, v in row.items() if k and v is not None}
+        plan = (row.get('plan') or 'standard').lower()
+
+        missing = [f for f in ('name', 'email', 'contact') if not row.get(f)]
+        if missing:
+            problems.append(f"Row {index}: missing {', '.join(missing)}")
+            continue
+        if plan not in PLAN_LIMITS:
+            problems.append(f"Row {index}: unknown plan '{plan}'")
+            continue
+        key = row['name'].lower()
+        if key in seen:
+            problems.append(f"Row {index}: duplicate organization '{row['name']}'")
+            continue
+        seen.add(key)
+
+        tenants.append({
+            'key': key, 'name': row['name'], 'email': row['email'],
+            'contact': row['contact'], 'phone': row.get('phone', ''), 'plan': plan,
+        })
+    return tenants, problems
+
+
+class Checkpoint:
+    """Per-tenant progress of a manifest run, rewritten atomically after every step.
+
+    It holds the raw API keys (needed to resend a welcome email on resume), so
+    the file is created readable by the owner only.
+    """
+
+    def __init__(self, path):
+        self.path    = path
+        self.tenants = {}
+        self._lock   = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.tenants = json.load(f).get('tenants', {})
+
+    def get(self, key):
+        return self.tenants.get(key)
+
+    def update(self, key, **fields):
+        self.update_many({key: fields})
+
+    def update_many(self, changes):
+        with self._lock:
+            for key, fields in changes.items():
+                self.tenants.setdefault(key, {}).update(fields)
+            tmp = self.path + '.tmp'
+            fd  = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'updated_at': datetime.now(timezone.utc).isoformat(),
+                           'tenants': self.tenants}, f, indent=2)
+            os.replace(tmp, self.path)
+
+
+def provision_database(conn, tenants, checkpoint):
+    """Insert tenant and API key rows for every manifest row not yet in the database.
+
+    New rows get their ids and keys written to the checkpoint as 'pending'
+    before the single commit; on resume, pending rows that did commit are
+    recognised by tenant_id and not inserted twice.
+    """
+    cur = conn.cursor()
+
+    pending = [t for t in tenants if (checkpoint.get(t['key']) or {}).get('db') == 'pending']
+    if pending:
+        cur.execute("""
+            SELECT t.tenant_id FROM organizations.tenants t
+            INNER JOIN OPENJSON(?) WITH (tenant_id NVARCHAR(50) '$') j ON t.tenant_id = j.tenant_id
+        """, json.dumps([checkpoint.get(t['key'])['tenant_id'] for t in pending]))
+        committed = {str(row[0]).lower() for row in cur.fetchall()}
+        checkpoint.update_many({t['key']: {'db': 'done'} for t in pending
+                                if checkpoint.get(t['key'])['tenant_id'] in committed})
+
+    # Organizations already onboarded outside this manifest run are left alone
+    fresh = [t for t in tenants if checkpoint.get(t['key']) is None]
+    if fresh:
+        cur.execute("""
+            SELECT t.organization_name FROM organizations.tenants t
+            INNER JOIN OPENJSON(?) WITH (name NVARCHAR(200) '$') j ON t.organization_name = j.name
+        """, json.dumps([t['name'] for t in fresh]))
+        existing = {row[0].lower() for row in cur.fetchall()}
+        checkpoint.update_many({t['key']: {'db': 'exists'} for t in fresh if t['key'] in existing})
+
+    to_insert = [t for t in tenants if (checkpoint.get(t['key']) or {}).get('db') in (None, 'pending')]
+    if not to_insert:
+        return 0
+
+    now = datetime.now(timezone.utc)
+    planned = {}
+    for t in to_insert:
+        state = checkpoint.get(t['key'])
+        if state is None:
+            raw_key, prefix, key_hash = generate_api_key()
+            state = {'tenant_id': str(uuid.uuid4()), 'key_id': str(uuid.uuid4()),
+                     'api_key': raw_key, 'key_prefix': prefix, 'key_hash': key_hash}
+        planned[t['key']] = dict(state, db='pending')
+    checkpoint.update_many(planned)
+
+    try:
+        cur.fast_executemany = True
+        cur.executemany("""
+            INSERT INTO organizations.tenants (
+                tenant_id, organization_name, tenant_type, subscription_tier,
+                subscription_status, max_providers, billing_email,
+                primary_contact, primary_phone,
+                is_active, created_at, updated_at
+            ) VALUES (?, ?, 'nemt_operator', ?, 'active', ?, ?, ?, ?, 1, ?, ?)
+        """, [(planned[t['key']]['tenant_id'], t['name'], t['plan'], PLAN_LIMITS[t['plan']]['providers'],
+               t['email'], t['contact'], t['phone'], now, now) for t in to_insert])
+        cur.executemany("""
+            INSERT INTO organizations.api_keys (
+                key_id, tenant_id, key_name, key_hash, key_prefix,
+                permissions, rate_limit_per_hour,
+                is_active, created_at
+            ) VALUES (?, ?, ?, ?, ?, 'read,write', 1000, 1, ?)
+        """, [(planned[t['key']]['key_id'], planned[t['key']]['tenant_id'], f"{t['name']} — Primary Key",
+               planned[t['key']]['key_hash'], planned[t['key']]['key_prefix'], now) for t in to_insert])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    checkpoint.update_many({t['key']: {'db': 'done'} for t in to_insert})
+    return len(to_insert)
+
+
+def needs_services(state):
+    """True when the tenant's rows are in but its container or welcome email is not done
+
+    An email recorded as 'skipped' (ACS was not installed) is final: a rerun
+    could not send it either, and new runs refuse to start without ACS.
+    """
+    return bool(state) and state.get('db') == 'done' and (
+        state.get('container') not in ('created', 'exists') or state.get('email') not in ('sent', 'skipped'))
+
+
+def provision_services(tenants, checkpoint, workers=ONBOARD_WORKERS):
+    """Create containers and send welcome emails concurrently for tenants whose rows are in"""
+    todo = [t for t in tenants if needs_services(checkpoint.get(t['key']))]
+    if not todo:
+        return
+
+    try:
+        blob_client, blob_error = get_blob_service(), None
+    except Exception as e:
+        blob_client, blob_error = None, str(e)
+    email_client = get_email_client()
+
+    def provision(t):
+        state = checkpoint.get(t['key'])
+
+        if state.get('container') not in ('created', 'exists'):
+            try:
+                if blob_client is None:
+                    raise RuntimeError(blob_error)
+                name, created = ensure_container(blob_client, state['tenant_id'])
+                checkpoint.update(t['key'], container='created' if created else 'exists',
+                                  container_name=name, container_error=None)
+            except Exception as e:
+                checkpoint.update(t['key'], container='failed', container_error=str(e))
+
+        if state.get('email') != 'sent':
+            if email_client is None:
+                checkpoint.update(t['key'], email='skipped',
+                                  email_error='azure-communication-email not installed')
+                return
+            try:
+                message = build_welcome_message(t['email'], t['contact'], t['name'],
+                                                state['api_key'], t['plan'])
+                result  = email_client.begin_send(message).result()
+                checkpoint.update(t['key'], email='sent', email_id=result.get('id'), email_error=None)
+            except Exception as e:
+                checkpoint.update(t['key'], email='failed', email_error=str(e))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(todo)))) as pool:
+        list(pool.map(provision, todo))
+
+
+def print_summary(tenants, checkpoint):
+    print(f"\n  {'Organization':<30} {'Plan':<13} {'Tenant ID':<36} {'Key':<12} "
+          f"{'Database':<9} {'Container':<10} {'Email':<8}")
+    print("  " + "-" * 124)
+    problems = []
+    for t in tenants:
+        state = checkpoint.get(t['key']) or {}
+        print(f"  {t['name'][:30]:<30} {t['plan']:<13} {state.get('tenant_id', '-'):<36} "
+              f"{state.get('key_prefix', '-'):<12} {state.get('db', '-'):<9} "
+              f"{state.get('container') or '-':<10} {state.get('email') or '-':<8}")
+        for step in ('container', 'email'):
+            if state.get(f'{step}_error'):
+                problems.append(f"  {t['name']}: {step} -- {state[f'{step}_error']}")
+    if problems:
+        print("\nProblems:")
+        print("\n".join(problems))
+
+
+def onboard_manifest(args):
+    tenants, problems = load_manifest(args.manifest)
+
+    print("=" * 60)
+    print("  NEMTsystem Bulk Tenant Onboarding")
+    print("=" * 60)
+    print(f"  Manifest     : {args.manifest}")
+    print(f"  Tenants      : {len(tenants)}")
+    print(f"  Backend      : {ONBOARD_BACKEND}")
+
+    if problems:
+        print("\nERROR: manifest has invalid rows:")
+        print("\n".join(f"  {p}" for p in problems))
+        sys.exit(1)
+
+    if args.dry_run:
+        print("\n  DRY RUN -- no changes will be made")
+        for t in tenants:
+            limits = PLAN_LIMITS[t['plan']]
+            print(f"  Would onboard: {t['name']} <{t['email']}> "
+                  f"({t['plan']}, up to {limits['providers']} providers)")
+        return
+
+    if ONBOARD_BACKEND != 'local' and not ACS_AVAILABLE:
+        print("\nERROR: azure-communication-email is not installed, so welcome emails "
+              "(with the API keys) cannot be sent. Install it or set ONBOARD_BACKEND=local.")
+        sys.exit(1)
+
+    checkpoint_path = args.checkpoint or f"{args.manifest}.checkpoint.json"
+    checkpoint = Checkpoint(checkpoint_path)
+    if checkpoint.tenants:
+        print(f"  Resuming     : {checkpoint_path}")
+
+    print("\nConnecting to credigraph-prod...")
+    try:
+        conn = get_credigraph()
+        print("Connected.")
+    except Exception as e:
+        print(f"ERROR: Could not connect to credigraph-prod: {e}")
+        sys.exit(1)
+
+    started = time.monotonic()
+    try:
+        inserted = provision_database(conn, tenants, checkpoint)
+        print(f"\n[1/2] Tenant and API key rows: {inserted} inserted in one transaction")
+    except Exception as e:
+        print(f"\nERROR inserting tenant rows (rolled back, rerun to retry): {e}")
+        conn.close()
+        sys.exit(1)
+    conn.close()
+
+    print(f"[2/2] Provisioning containers and welcome emails ({args.workers} workers)")
+    provision_services(tenants, checkpoint, args.workers)
+
+    print_summary(tenants, checkpoint)
+
+    incomplete = [t for t in tenants if needs_services(checkpoint.get(t['key']))]
+    skipped = [t for t in tenants if (checkpoint.get(t['key']) or {}).get('db') == 'exists']
+
+    print("\n" + "=" * 60)
+    print(f"  Onboarded  : {len(tenants) - len(incomplete) - len(skipped)}")
+    print(f"  Incomplete : {len(incomplete)}")
+    print(f"  Skipped    : {len(skipped)} (organization already a tenant)")
+    print(f"  Duration   : {time.monotonic() - started:.1f} s")
+    print(f"  Checkpoint : {checkpoint_path} (holds the API keys -- share them securely)")
+    print("=" * 60)
+
+    if incomplete:
+        print("\nRerun the same command to retry the incomplete steps.")
+        sys.exit(1)
+
+
 # ── MAIN ──────────────────────────────────────────────────────────────────────
 def main():
     parser = argparse.ArgumentParser(description='Onboard a new NEMTsystem tenant')
-    parser.add_argument('--name',    required=True,  help='Organization name')
-    parser.add_argument('--email',   required=True,  help='Primary admin email')
-    parser.add_argument('--contact', required=True,  help='Primary contact name')
+    parser.add_argument('--name',    help='Organization name')
+    parser.add_argument('--email',   help='Primary admin email')
+    parser.add_argument('--contact', help='Primary contact name')
     parser.add_argument('--phone',   default='',     help='Primary phone number')
     parser.add_argument('--plan',    default='standard',
                         choices=['standard','professional','enterprise','custom'],
                         help='Subscription plan (default: standard)')
     parser.add_argument('--dry-run', action='store_true',
                         help='Validate inputs without writing to database')
+    parser.add_argument('--manifest', help='CSV or JSON file of tenants to onboard in bulk')
+    parser.add_argument('--checkpoint', help='Checkpoint file (default: <manifest>.checkpoint.json)')
+    parser.add_argument('--workers', type=int, default=ONBOARD_WORKERS,
+                        help=f'Concurrent container/email workers (default: {ONBOARD_WORKERS})')
     args = parser.parse_args()
 
+    if args.manifest:
+        return onboard_manifest(args)
+    if not (args.name and args.email and args.contact):
+        parser.error('--name, --email and --contact are required unless --manifest is given')
+
     print("=" * 60)
     print("  NEMTsystem Tenant Onboarding")
     print("=" * 60)
@@ -299,7 +695,7 @@ def main():
         print("\n  DRY RUN -- no changes will be made")
         tenant_id          = str(uuid.uuid4())
         raw_key, prefix, _ = generate_api_key()
-        container          = tenant_id.lower().replace('-','')[:63]
+        container          = container_name_for(tenant_id)
         print(f"\n  Would create tenant_id  : {tenant_id}")
         print(f"  Would create api_key    : {raw_key}")
         print(f"  Would create key_prefix : {prefix}")
@@ -0,0 +1,142 @@
+"""
+In-process rate schedule table.
+
+billing.rate_schedules changes a few times a year, so every active schedule
+is loaded once into per-(payer_type, service_type) interval lists sorted by
+effective_date.  A lookup for a service date is a bisect on those lists, so
+backdated claims are priced with the rates that were in effect on the day
+of service rather than today's.
+
+Freshness: at most every RATE_TABLE_CHECK_SECONDS, ensure_fresh() runs a
+one-row checksum query over the table and reloads only if it changed.
+reload() (POST /api/billing/rates/reload) forces a reload immediately.
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_right
+from datetime import date, datetime
+
+RATE_TABLE_CHECK_SECONDS = float(os.environ.get('RATE_TABLE_CHECK_SECONDS', 60))
+
+VERSION_SQL = """
+    SELECT COUNT(*), CHECKSUM_AGG(BINARY_CHECKSUM(
+        payer_type, service_type, base_rate, per_mile_rate, wait_time_rate,
+        after_hours_surcharge, weekend_surcharge, effective_date, expiration_date, is_active
+    ))
+    FROM billing.rate_schedules
+"""
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    return value
+
+
+class RateTable:
+    """Rate schedules keyed by (payer_type, service_type), resolved by service date"""
+
+    def __init__(self, check_seconds=RATE_TABLE_CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._schedules = {}   # key -> (sorted effective dates, [(effective, expiration, rates)])
+        self._version = None
+        self._checked_at = None
+        self._loaded_at = None
+        self.loads = 0
+
+    def load(self, cursor):
+        cursor.execute(VERSION_SQL)
+        version = tuple(cursor.fetchone())
+
+        cursor.execute("""
+            SELECT payer_type, service_type, base_rate, per_mile_rate, wait_time_rate,
+                   after_hours_surcharge, weekend_surcharge, effective_date, expiration_date
+            FROM billing.rate_schedules
+            WHERE is_active = 1
+        """)
+        grouped = {}
+        for row in cursor.fetchall():
+            grouped.setdefault((row[0].lower(), row[1].lower()), []).append((
+                _as_date(row[7]),
+                _as_date(row[8]),
+                {
+                    'base_rate': float(row[2]),
+                    'per_mile_rate': float(row[3]),
+                    'wait_time_rate': float(row[4]),
+                    'after_hours_surcharge': float(row[5]) if row[5] else 0.0,
+                    'weekend_surcharge': float(row[6]) if row[6] else 0.0
+                }
+            ))
+
+        schedules = {}
+        for key, intervals in grouped.items():
+            intervals.sort(key=lambda interval: interval[0])
+            schedules[key] = ([interval[0] for interval in intervals], intervals)
+
+        now = time.monotonic()
+        with self._lock:
+            self._schedules = schedules
+            self._version = version
+            self._checked_at = now
+            self._loaded_at = now
+            self.loads += 1
+
+    def ensure_fresh(self, cursor):
+        """Load on first use; afterwards reload only when the table's checksum changed"""
+        if self._loaded_at is None:
+            self.load(cursor)
+            return
+        if time.monotonic() - self._checked_at < self.check_seconds:
+            return
+
+        cursor.execute(VERSION_SQL)
+        version = tuple(cursor.fetchone())
+        if version != self._version:
+            self.load(cursor)
+        else:
+            self._checked_at = time.monotonic()
+
+    def reload(self, cursor):
+        self.load(cursor)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def lookup(self, payer_type, service_type, service_date=None):
+        """Rates in effect on service_date (default today), latest effective_date wins, or None"""
+        service_date = _as_date(service_date) if service_date else date.today()
+        entry = self._schedules.get((payer_type.lower(), service_type.lower()))
+        if entry is None:
+            return None
+
+        starts, intervals = entry
+        i = bisect_right(starts, service_date)
+        # Walk back past schedules that expired before the service date
+        while i > 0:
+            i -= 1
+            effective, expiration, rates = intervals[i]
+            if expiration is None or expiration >= service_date:
+                return rates
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'schedules': sum(len(intervals) for _, intervals in self._schedules.values()),
+                'keys': len(self._schedules),
+                'loads': self.loads,
+                'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None
+            }
+
+
+_rate_table = RateTable()
+
+
+def get_rate_table():
+    return _rate_table
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Nightly insurance reverification sweep.
+
+Finds patients with trips in the next REVERIFY_TRIP_WINDOW_DAYS whose active
+primary coverage has expired or expires within REVERIFY_EXPIRY_DAYS, and runs
+them through batch eligibility verification (soonest trip first), writing
+the results back to medical.patient_insurance.  Expired coverage is then
+found overnight instead of at booking or dispatch time.
+
+Payer calls are paced per channel with REVERIFY_RATE_LIMITS (requests per
+second) on top of the usual per-payer concurrency limits.  Progress is
+printed per batch; the final report lists patients whose coverage came back
+inactive or could not be verified, with their next pickup.
+
+Schedule it nightly (cron, Heroku Scheduler, Azure WebJob):
+
+    python3 reverification_sweep.py [--dry-run] [--limit N] [--report sweep.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from database import db_connection
+from eligibility import EligibilityVerifier, run_verification_batch
+
+REVERIFY_TRIP_WINDOW_DAYS = int(os.environ.get('REVERIFY_TRIP_WINDOW_DAYS', 7))
+REVERIFY_EXPIRY_DAYS = int(os.environ.get('REVERIFY_EXPIRY_DAYS', 14))
+REVERIFY_BATCH_SIZE = int(os.environ.get('REVERIFY_BATCH_SIZE', 200))
+REVERIFY_RATE_LIMITS = json.loads(os.environ.get('REVERIFY_RATE_LIMITS', '{"medi-cal": 5, "availity": 10}'))
+
+
+def select_due_patients(cursor, trip_window_days=REVERIFY_TRIP_WINDOW_DAYS,
+                        expiry_days=REVERIFY_EXPIRY_DAYS, limit=None):
+    """Active primary coverage that is expired or expiring, for patients with upcoming trips"""
+    cursor.execute(f"""
+        SELECT {'TOP (?)' if limit else ''}
+            pi.patient_id, pi.insurance_company, pi.policy_number, pi.group_number,
+            pi.expiration_date, t.next_pickup, t.upcoming_trips
+        FROM medical.patient_insurance pi
+        INNER JOIN (
+            SELECT patient_id,
+                   MIN(scheduled_pickup_time) AS next_pickup,
+                   COUNT(*) AS upcoming_trips
+            FROM operations.trips
+            WHERE scheduled_pickup_time >= GETDATE()
+              AND scheduled_pickup_time < DATEADD(day, ?, GETDATE())
+              AND status NOT IN ('completed', 'cancelled', 'no_show')
+            GROUP BY patient_id
+        ) t ON t.patient_id = pi.patient_id
+        WHERE pi.is_primary = 1
+          AND pi.status = 'active'
+          AND (pi.expiration_date IS NULL
+               OR pi.expiration_date < DATEADD(day, ?, CAST(GETDATE() AS DATE)))
+        ORDER BY t.next_pickup
+    """, ((limit,) if limit else ()) + (trip_window_days, expiry_days))
+
+    due = []
+    seen = set()
+    for row in cursor.fetchall():
+        # A patient with several active primary rows is verified once
+        if row[0] in seen:
+            continue
+        seen.add(row[0])
+        due.append({
+            'patient_id': row[0],
+            'insurance_company': row[1],
+            'policy_number': row[2],
+            'group_number': row[3],
+            'expiration_date': row[4],
+            'next_pickup': row[5],
+            'upcoming_trips': row[6]
+        })
+    return due
+
+
+def run_sweep(dry_run=False, limit=None, batch_size=REVERIFY_BATCH_SIZE, use_cache=True,
+              verifier=None, progress=print):
+    """Verify every due patient in batches; returns the metrics report"""
+    started = time.monotonic()
+    verifier = verifier or EligibilityVerifier(payer_rate_limits=REVERIFY_RATE_LIMITS)
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        due = select_due_patients(cursor, limit=limit)
+        cursor.close()
+
+    report = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'dry_run': dry_run,
+        'due': len(due),
+        'verified': 0,
+        'active': 0,
+        'inactive': 0,
+        'failed': 0,
+        'cache_hits': 0,
+        'payer_calls': 0,
+        'records_updated': 0,
+        'records_inserted': 0,
+        'by_channel': {},
+        'needs_attention': []
+    }
+    batches = -(-len(due) // batch_size) if due else 0
+    progress(f"{len(due)} patients due for reverification, {batches} batches")
+
+    for number, start in enumerate(range(0, len(due), batch_size), start=1):
+        batch = due[start:start + batch_size]
+        batch_started = time.monotonic()
+
+        # Each batch commits on its own, so an interrupted sweep keeps what it finished
+        with db_connection() as conn:
+            results, summary = run_verification_batch(conn, batch, verifier=verifier,
+                                                       dry_run=dry_run, use_cache=use_cache)
+
+        report['verified'] += summary['requested'] - summary['failures']
+        report['active'] += summary['active']
+        report['inactive'] += summary['inactive']
+        report['failed'] += summary['failures']
+        report['cache_hits'] += summary['cache_hits']
+        report['payer_calls'] += summary['payer_calls']
+        report['records_updated'] += summary['records_updated']
+        report['records_inserted'] += summary['records_inserted']
+        for channel, stats in summary['by_channel'].items():
+            totals = report['by_channel'].setdefault(channel, {'calls': 0, 'failures': 0, 'call_seconds': 0.0})
+            totals['calls'] += stats['calls']
+            totals['failures'] += stats['failures']
+            totals['call_seconds'] = round(totals['call_seconds'] + stats['call_seconds'], 3)
+
+        for r in results:
+            if r.get('error') or not r['verification']['active']:
+                report['needs_attention'].append({
+                    'patient_id': str(r['patient_id']),
+                    'insurance_company': r['insurance_company'],
+                    'policy_number': r['policy_number'],
+                    'next_pickup': str(r['next_pickup']),
+                    'upcoming_trips': r['upcoming_trips'],
+                    'problem': r.get('error') or 'Coverage inactive'
+                })
+
+        done = min(start + batch_size, len(due))
+        progress(f"Batch {number}/{batches}: {len(batch)} patients, "
+                 f"{summary['inactive']} inactive, {summary['failures']} failed, "
+                 f"{summary['cache_hits']} cached in {time.monotonic() - batch_started:.1f}s "
+                 f"({done}/{len(due)})")
+
+    report['duration_seconds'] = round(time.monotonic() - started, 1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reverify expiring insurance for patients with upcoming trips')
+    parser.add_argument('--dry-run', action='store_true', help='Verify without writing coverage back')
+    parser.add_argument('--limit', type=int, default=None, help='Verify at most N patients')
+    parser.add_argument('--batch-size', type=int, default=REVERIFY_BATCH_SIZE, help='Patients per batch')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached payer responses')
+    parser.add_argument('--report', default=None, help='Also write the report as JSON to this file')
+    args = parser.parse_args()
+
+    report = run_sweep(dry_run=args.dry_run, limit=args.limit, batch_size=args.batch_size,
+                       use_cache=not args.refresh)
+
+    print(f"Due             : {report['due']}")
+    print(f"Verified        : {report['verified']}{' (dry run)' if args.dry_run else ''}")
+    print(f"Active          : {report['active']}")
+    print(f"Inactive        : {report['inactive']}")
+    print(f"Failed          : {report['failed']}")
+    print(f"Payer calls     : {report['payer_calls']} ({report['cache_hits']} cached)")
+    print(f"Records updated : {report['records_updated']} (+{report['records_inserted']} inserted)")
+    print(f"Duration        : {report['duration_seconds']} s")
+    for item in report['needs_attention']:
+        print(f"  {item['patient_id']:<38} {item['next_pickup']:<20} {item['problem']}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    # Non-zero exit lets the scheduler flag runs where payers could not be reached
+    sys.exit(1 if report['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
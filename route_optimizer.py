@@ -0,0 +1,764 @@
+#!/usr/bin/env python3
+"""
+Shared-ride run optimizer.
+
+Takes a day's scheduled, unassigned operations.trips and groups them into
+runs, one vehicle picking up and dropping off several patients, and then
+chains the runs onto drivers' shifts.  Assignments are written back in one
+set-based UPDATE, and the stop order goes to operations.trip_runs.
+
+Each run has to respect:
+  * pickup windows: ROUTE_PICKUP_EARLY_MINUTES before to
+    ROUTE_PICKUP_LATE_MINUTES after the scheduled pickup
+  * vehicle capacity: ROUTE_VEHICLE_CAPACITY patients on board
+  * ride time: no patient rides longer than ROUTE_MAX_RIDE_FACTOR times the
+    direct trip plus ROUTE_MAX_RIDE_EXTRA_MINUTES
+  * length: a run lasts at most ROUTE_MAX_RUN_MINUTES (a driver's day is
+    several runs)
+
+The heuristic:
+  1. cheapest insertion: trips are taken in pickup order, and each one goes
+     where it adds the fewest travel minutes, or into a new run when that
+     is cheaper (a new run costs ROUTE_RUN_COST_MINUTES on top of its
+     travel time)
+  2. local search until ROUTE_SEARCH_SECONDS run out or nothing improves:
+     relocate (take one trip out and reinsert it at its best position
+     anywhere) and run elimination (the savings move: dissolve small runs
+     into the others when that saves time)
+  3. chaining: runs in start order go to the driver who is on shift, free
+     of overlapping trips, can reach the first pickup in time, and has the
+     least idle time (ties go to the best rating)
+
+Travel minutes come from a point-to-point matrix over the distinct geocoded
+stops (distance_engine's haversine times its road factor, at
+ROUTE_AVERAGE_MPH), built with NumPy (a requirement of the app).  Scripts
+run without NumPy fall back to computing rows on demand.
+
+    python3 route_optimizer.py --date 2026-10-19 [--dry-run] [--time-limit 20] [--report runs.json]
+    POST /api/dispatch/optimize-runs {"date": "2026-10-19", "dry_run": true}
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+from flask import Blueprint, jsonify, request
+
+from database import db_connection
+from distance_engine import DISTANCE_ROAD_FACTOR, EARTH_RADIUS_MILES, haversine_miles, get_distance_engine
+from driver_availability import get_availability_index, DRIVER_TRIP_BLOCK_MINUTES
+from live_updates import publish_all, trip_event
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+route_optimizer_bp = Blueprint('route_optimizer', __name__)
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+ROUTE_VEHICLE_CAPACITY = int(os.environ.get('ROUTE_VEHICLE_CAPACITY', 4))
+ROUTE_PICKUP_EARLY_MINUTES = float(os.environ.get('ROUTE_PICKUP_EARLY_MINUTES', 15))
+ROUTE_PICKUP_LATE_MINUTES = float(os.environ.get('ROUTE_PICKUP_LATE_MINUTES', 15))
+ROUTE_SERVICE_MINUTES = float(os.environ.get('ROUTE_SERVICE_MINUTES', 5))
+ROUTE_MAX_RIDE_FACTOR = float(os.environ.get('ROUTE_MAX_RIDE_FACTOR', 1.5))
+ROUTE_MAX_RIDE_EXTRA_MINUTES = float(os.environ.get('ROUTE_MAX_RIDE_EXTRA_MINUTES', 20))
+ROUTE_RUN_COST_MINUTES = float(os.environ.get('ROUTE_RUN_COST_MINUTES', 30))
+ROUTE_MAX_RUN_MINUTES = float(os.environ.get('ROUTE_MAX_RUN_MINUTES', 180))
+ROUTE_AVERAGE_MPH = float(os.environ.get('ROUTE_AVERAGE_MPH', 30))
+ROUTE_SEARCH_SECONDS = float(os.environ.get('ROUTE_SEARCH_SECONDS', 20))
+ROUTE_CANDIDATE_GAP_MINUTES = float(os.environ.get('ROUTE_CANDIDATE_GAP_MINUTES', 60))
+ROUTE_SMALL_RUN_TRIPS = int(os.environ.get('ROUTE_SMALL_RUN_TRIPS', 2))
+# Drivers with these statuses are left out when planning today's trips
+ROUTE_EXCLUDED_DRIVER_STATUSES = tuple(
+    s.strip() for s in os.environ.get('ROUTE_EXCLUDED_DRIVER_STATUSES', 'offline').split(',') if s.strip()
+)
+
+IMPROVEMENT_EPSILON = 1e-6
+MATRIX_CHUNK_ROWS = 512
+
+SCHEMA_SQL = """
+    IF OBJECT_ID('operations.trip_runs') IS NULL
+    BEGIN
+        CREATE TABLE operations.trip_runs (
+            trip_id           NVARCHAR(50) NOT NULL,
+            run_id            NVARCHAR(40) NOT NULL,
+            service_date      DATE NOT NULL,
+            driver_id         NVARCHAR(50) NOT NULL,
+            pickup_sequence   INT NOT NULL,
+            dropoff_sequence  INT NOT NULL,
+            planned_pickup    DATETIME2(0) NOT NULL,
+            planned_dropoff   DATETIME2(0) NOT NULL,
+            created_at        DATETIME2(0) NOT NULL DEFAULT GETDATE(),
+            CONSTRAINT PK_trip_runs PRIMARY KEY (trip_id)
+        );
+        CREATE INDEX IX_trip_runs_run ON operations.trip_runs (run_id, pickup_sequence);
+        CREATE INDEX IX_trip_runs_driver ON operations.trip_runs (driver_id, service_date);
+    END
+"""
+
+_optimize_lock = threading.Lock()
+
+
+# ── TRAVEL TIMES ──────────────────────────────────────────────────────────────
+class TravelTimes:
+    """Symmetric driving-minutes matrix over a list of (lat, lon) points"""
+
+    def __init__(self, points, mph=ROUTE_AVERAGE_MPH, road_factor=DISTANCE_ROAD_FACTOR):
+        self.points = points
+        self.minutes_per_mile = road_factor / mph * 60
+        self._matrix = None
+        if NUMPY_AVAILABLE and points:
+            lat, lon = np.radians(np.asarray(points, dtype=float)).T
+            cos_lat = np.cos(lat)
+            matrix = np.empty((len(points), len(points)), dtype=np.float32)
+            for start in range(0, len(points), MATRIX_CHUNK_ROWS):
+                rows = slice(start, start + MATRIX_CHUNK_ROWS)
+                a = (np.sin((lat[None, :] - lat[rows, None]) / 2) ** 2
+                     + cos_lat[rows, None] * cos_lat[None, :] * np.sin((lon[None, :] - lon[rows, None]) / 2) ** 2)
+                matrix[rows] = 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1.0))) * self.minutes_per_mile
+            self._matrix = matrix
+
+    def __len__(self):
+        return len(self.points)
+
+    def between(self, a, b):
+        if self._matrix is not None:
+            return float(self._matrix[a, b])
+        return haversine_miles(*self.points[a], *self.points[b]) * self.minutes_per_mile
+
+    def row(self, a):
+        """Minutes from point a to every point, as a list"""
+        if self._matrix is not None:
+            return self._matrix[a].tolist()
+        lat, lon = self.points[a]
+        return [haversine_miles(lat, lon, b_lat, b_lon) * self.minutes_per_mile for b_lat, b_lon in self.points]
+
+
+# ── RUN BUILDING ──────────────────────────────────────────────────────────────
+class Run:
+    """A vehicle run: stop nodes in order with their service start times.
+
+    Node 2k is trip k's pickup, node 2k+1 its dropoff.  loads[i] is the number
+    of patients on board after stop i; costs[i] the travel minutes up to it.
+    """
+    __slots__ = ('nodes', 'starts', 'loads', 'costs')
+
+    def __init__(self, nodes, starts, loads, costs):
+        self.nodes = nodes
+        self.starts = starts
+        self.loads = loads
+        self.costs = costs
+
+    @property
+    def cost(self):
+        return self.costs[-1]
+
+    def trips(self):
+        return [n >> 1 for n in self.nodes if not n & 1]
+
+
+class RunPlanner:
+    """Builds shared-ride runs for one service day; times are minutes after midnight"""
+
+    def __init__(self, trips, service_date, capacity=ROUTE_VEHICLE_CAPACITY,
+                 service_minutes=ROUTE_SERVICE_MINUTES, run_cost=ROUTE_RUN_COST_MINUTES,
+                 mph=ROUTE_AVERAGE_MPH):
+        """trips: dicts with pickup_time (datetime), pickup_point and dropoff_point ((lat, lon))"""
+        self.trips = trips
+        self.service_date = service_date
+        self.midnight = datetime.combine(service_date, datetime.min.time())
+        self.capacity = capacity
+        self.service = service_minutes
+        self.run_cost = run_cost
+        self.max_run = ROUTE_MAX_RUN_MINUTES
+
+        points = {}
+        self.addr = []
+        for trip in trips:
+            for key in ('pickup_point', 'dropoff_point'):
+                self.addr.append(points.setdefault(tuple(trip[key]), len(points)))
+        self.times = TravelTimes(list(points), mph)
+
+        count = len(trips)
+        self.target = [0.0] * (2 * count)
+        self.earliest = [0.0] * (2 * count)
+        self.latest = [math.inf] * (2 * count)
+        self.direct = [0.0] * count
+        self.max_ride = [0.0] * count
+        for k, trip in enumerate(trips):
+            pickup = (trip['pickup_time'] - self.midnight).total_seconds() / 60
+            self.target[2 * k] = pickup
+            self.earliest[2 * k] = pickup - ROUTE_PICKUP_EARLY_MINUTES
+            self.latest[2 * k] = pickup + ROUTE_PICKUP_LATE_MINUTES
+            self.direct[k] = self.times.between(self.addr[2 * k], self.addr[2 * k + 1])
+            self.max_ride[k] = (self.direct[k] * ROUTE_MAX_RIDE_FACTOR + ROUTE_MAX_RIDE_EXTRA_MINUTES
+                                + self.service)
+
+        self.runs = {}              # run number -> Run
+        self.run_of = [None] * count
+        self._next_run = 0
+        self.stats = {'trips': count, 'points': len(points), 'relocations': 0, 'runs_eliminated': 0,
+                      'search_passes': 0}
+
+    # ── scheduling ────────────────────────────────────────────────────────────
+    def _evaluate(self, nodes, begin=0, prefix=None):
+        """Schedule `nodes` as a Run, or None if infeasible; stops before `begin` are copied from `prefix`"""
+        addr, earliest, latest = self.addr, self.earliest, self.latest
+        if begin:
+            starts, loads, costs = prefix.starts[:begin], prefix.loads[:begin], prefix.costs[:begin]
+            clock = starts[-1] + self.service
+            load = loads[-1]
+            cost = costs[-1]
+            prev = addr[nodes[begin - 1]]
+        else:
+            starts, loads, costs = [], [], []
+            clock = load = cost = 0.0
+            prev = None
+
+        for position in range(begin, len(nodes)):
+            node = nodes[position]
+            here = addr[node]
+            if prev is None:
+                start = self.target[node]
+            else:
+                leg = self.times.between(prev, here)
+                cost += leg
+                start = max(clock + leg, earliest[node])
+            if start > latest[node] or (starts and start - starts[0] > self.max_run):
+                return None
+            if node & 1:
+                load -= 1
+                if start - starts[nodes.index(node - 1)] > self.max_ride[node >> 1]:
+                    return None
+            else:
+                load += 1
+                if load > self.capacity:
+                    return None
+            starts.append(start)
+            loads.append(load)
+            costs.append(cost)
+            clock = start + self.service
+            prev = here
+        return Run(nodes, starts, loads, costs)
+
+    def _best_insertion(self, k, run, pickup_row, dropoff_row, bound):
+        """(added minutes, Run) for the cheapest feasible insertion of trip k below `bound`, or None"""
+        p, d = 2 * k, 2 * k + 1
+        nodes = run.nodes
+        m = len(nodes)
+        stops = [self.addr[n] for n in nodes]
+        legs = [0.0] + [run.costs[i] - run.costs[i - 1] for i in range(1, m)] + [0.0]
+        direct = pickup_row[self.addr[d]]
+        earliest_p, latest_p = self.earliest[p], self.latest[p]
+        # Latest each stop may start: its window, or for a dropoff its pickup plus the ride limit
+        limits = [run.starts[nodes.index(n - 1)] + self.max_ride[n >> 1] if n & 1 else self.latest[n]
+                  for n in nodes]
+
+        # Cost of putting the pickup / dropoff alone in front of stop i
+        add_p = [(pickup_row[stops[i - 1]] if i else 0.0) + (pickup_row[stops[i]] if i < m else 0.0) - legs[i]
+                 for i in range(m + 1)]
+        add_d = [(dropoff_row[stops[j - 1]] if j else 0.0) + (dropoff_row[stops[j]] if j < m else 0.0) - legs[j]
+                 for j in range(m + 1)]
+
+        candidates = []
+        for i in range(m + 1):
+            if i:
+                if run.starts[i - 1] > latest_p:
+                    break
+                if run.starts[i - 1] + self.service + pickup_row[stops[i - 1]] > latest_p:
+                    continue
+            if i < m and earliest_p + self.service + pickup_row[stops[i]] > limits[i]:
+                continue
+            together = ((pickup_row[stops[i - 1]] if i else 0.0) + direct
+                        + (dropoff_row[stops[i]] if i < m else 0.0) - legs[i])
+            if together < bound:
+                candidates.append((together, i, i))
+            for j in range(i + 1, m + 1):
+                cost = add_p[i] + add_d[j]
+                if cost < bound:
+                    candidates.append((cost, i, j))
+
+        candidates.sort()
+        for cost, i, j in candidates:
+            new = self._evaluate(nodes[:i] + [p] + nodes[i:j] + [d] + nodes[j:], i, run)
+            if new is not None:
+                return cost, new
+        return None
+
+    def _cheapest_insertion(self, k, allow_new=True):
+        """(added minutes, run number or None for a new run, Run)"""
+        if allow_new:
+            best = (self.direct[k] + self.run_cost, None, None)
+        else:
+            best = (math.inf, None, None)
+        pickup_row = self.times.row(self.addr[2 * k])
+        dropoff_row = self.times.row(self.addr[2 * k + 1])
+        lo = self.earliest[2 * k] - ROUTE_CANDIDATE_GAP_MINUTES
+        hi = self.latest[2 * k] + self.max_ride[k] + ROUTE_CANDIDATE_GAP_MINUTES
+        for number, run in self.runs.items():
+            if run.starts[0] > hi or run.starts[-1] < lo:
+                continue
+            found = self._best_insertion(k, run, pickup_row, dropoff_row, best[0])
+            if found is not None:
+                best = (found[0], number, found[1])
+        return best
+
+    def _place(self, k, number, run):
+        """Store the result of _cheapest_insertion for trip k"""
+        if number is None:
+            number = self._next_run
+            self._next_run += 1
+            run = self._evaluate([2 * k, 2 * k + 1])
+        self.runs[number] = run
+        self.run_of[k] = number
+
+    def _without(self, run, k):
+        """Run minus trip k (None if that leaves it empty or infeasible)"""
+        nodes = [n for n in run.nodes if n >> 1 != k]
+        if not nodes:
+            return None
+        first = next(i for i, n in enumerate(run.nodes) if n >> 1 == k)
+        return self._evaluate(nodes, first, run)
+
+    def build(self):
+        """Cheapest-insertion construction, trips in pickup order"""
+        for k in sorted(range(len(self.trips)), key=lambda k: self.target[2 * k]):
+            _, number, run = self._cheapest_insertion(k)
+            self._place(k, number, run)
+
+    # ── local search ──────────────────────────────────────────────────────────
+    def _relocate_pass(self, deadline):
+        moved = 0
+        for k in sorted(range(len(self.trips)), key=lambda k: self.target[2 * k]):
+            if time.monotonic() > deadline:
+                break
+            number = self.run_of[k]
+            run = self.runs[number]
+            if len(run.nodes) == 2:
+                saving = run.cost + self.run_cost
+                reduced = None
+            else:
+                reduced = self._without(run, k)
+                if reduced is None:
+                    continue
+                saving = run.cost - reduced.cost
+
+            if reduced is None:
+                del self.runs[number]
+            else:
+                self.runs[number] = reduced
+            cost, target, new = self._cheapest_insertion(k)
+            if cost < saving - IMPROVEMENT_EPSILON:
+                self._place(k, target, new)
+                moved += 1
+            else:
+                self.runs[number] = run
+        self.stats['relocations'] += moved
+        return moved
+
+    def _eliminate_pass(self, deadline):
+        eliminated = 0
+        small = [number for number, run in self.runs.items() if len(run.nodes) <= 2 * ROUTE_SMALL_RUN_TRIPS]
+        for number in sorted(small, key=lambda n: len(self.runs[n].nodes)):
+            if time.monotonic() > deadline:
+                break
+            run = self.runs.pop(number, None)
+            if run is None:
+                continue
+            backup = {}
+            added = 0.0
+            for k in run.trips():
+                cost, target, new = self._cheapest_insertion(k, allow_new=False)
+                if target is None:
+                    added = math.inf
+                    break
+                backup.setdefault(target, self.runs[target])
+                self.runs[target] = new
+                self.run_of[k] = target
+                added += cost
+            if added < run.cost + self.run_cost - IMPROVEMENT_EPSILON:
+                eliminated += 1
+                continue
+            self.runs.update(backup)
+            self.runs[number] = run
+            for k in run.trips():
+                self.run_of[k] = number
+        self.stats['runs_eliminated'] += eliminated
+        return eliminated
+
+    def improve(self, seconds=ROUTE_SEARCH_SECONDS):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.stats['search_passes'] += 1
+            changed = self._relocate_pass(deadline) + self._eliminate_pass(deadline)
+            if not changed:
+                break
+
+    def total_cost(self):
+        return sum(run.cost for run in self.runs.values()) + self.run_cost * len(self.runs)
+
+    # ── drivers ───────────────────────────────────────────────────────────────
+    def _minute_of_day(self, minutes):
+        return minutes % (24 * 60)
+
+    def assign_drivers(self, drivers, block_minutes=DRIVER_TRIP_BLOCK_MINUTES):
+        """Chain runs onto drivers: run number -> DriverRecord (runs left out have no driver)"""
+        block = timedelta(minutes=block_minutes)
+        free = {}      # driver_id -> (minute free again, point of last dropoff)
+        assigned = {}
+        for number, run in sorted(self.runs.items(), key=lambda item: item[1].starts[0]):
+            start, end = run.starts[0], run.starts[-1] + self.service
+            first_point = self.addr[run.nodes[0]]
+            pickups = [self.midnight + timedelta(minutes=run.starts[i])
+                       for i, n in enumerate(run.nodes) if not n & 1]
+            best, best_key = None, None
+            for driver in drivers:
+                if not (driver.on_shift(self._minute_of_day(start)) and driver.on_shift(self._minute_of_day(end))):
+                    continue
+                state = free.get(driver.driver_id)
+                if state is not None and state[0] + self.times.between(state[1], first_point) > start:
+                    continue
+                if any(driver.conflicts(pickup, block) for pickup in pickups):
+                    continue
+                # Keep working drivers busy (least idle time) before starting a new one
+                key = (0, start - state[0], driver.rank) if state else (1, 0.0, driver.rank)
+                if best_key is None or key < best_key:
+                    best, best_key = driver, key
+            if best is not None:
+                assigned[number] = best
+                free[best.driver_id] = (end, self.addr[run.nodes[-1]])
+        return assigned
+
+    def plan(self, drivers):
+        """Runs as dicts, earliest first, with their driver (or None) and stops"""
+        assigned = self.assign_drivers(drivers)
+        runs = []
+        for number, run in sorted(self.runs.items(), key=lambda item: item[1].starts[0]):
+            driver = assigned.get(number)
+            stops = []
+            for sequence, (node, start) in enumerate(zip(run.nodes, run.starts), start=1):
+                trip = self.trips[node >> 1]
+                stops.append({
+                    'sequence': sequence,
+                    'type': 'dropoff' if node & 1 else 'pickup',
+                    'trip_id': trip['trip_id'],
+                    'address': trip['dropoff_address'] if node & 1 else trip['pickup_address'],
+                    'planned_time': self.midnight + timedelta(minutes=round(start))
+                })
+            runs.append({
+                'run_id': f"RUN-{self.service_date:%Y%m%d}-{uuid.uuid4().hex[:8]}",
+                'driver_id': driver.driver_id if driver else None,
+                'driver_name': driver.name if driver else None,
+                'trips': len(run.nodes) // 2,
+                'travel_minutes': round(run.cost, 1),
+                'stops': stops
+            })
+        return runs
+
+
+# ── DATABASE ──────────────────────────────────────────────────────────────────
+def load_trips(cursor, service_date):
+    """Scheduled, unassigned trips of the day that have not been picked up yet"""
+    cursor.execute("""
+        SELECT trip_id, patient_id, pickup_address, destination_address, scheduled_pickup_time
+        FROM operations.trips
+        WHERE status = 'scheduled'
+          AND driver_id IS NULL
+          AND scheduled_pickup_time >= ?
+          AND scheduled_pickup_time < DATEADD(day, 1, ?)
+          AND scheduled_pickup_time >= GETDATE()
+        ORDER BY scheduled_pickup_time
+    """, (service_date, service_date))
+    return [{
+        'trip_id': row[0],
+        'patient_id': row[1],
+        'pickup_address': row[2],
+        'dropoff_address': row[3],
+        'pickup_time': row[4]
+    } for row in cursor.fetchall()]
+
+
+def geocode_trips(trips):
+    """Attach pickup/dropoff points; returns (routable trips, trips with an unknown address)"""
+    engine = get_distance_engine()
+    points = {}
+    routable, unknown = [], []
+    for trip in trips:
+        for field, key in (('pickup_address', 'pickup_point'), ('dropoff_address', 'dropoff_point')):
+            address = trip[field] or ''
+            if address not in points:
+                point = engine.geocode(address)
+                points[address] = point[:2] if point else None
+            trip[key] = points[address]
+        (routable if trip['pickup_point'] and trip['dropoff_point'] else unknown).append(trip)
+    return routable, unknown
+
+
+def plannable_drivers(index, service_date):
+    drivers = [d for d in index.drivers() if d.shift_start is not None and d.shift_end is not None]
+    if service_date == date.today():
+        drivers = [d for d in drivers if d.status not in ROUTE_EXCLUDED_DRIVER_STATUSES]
+    return drivers
+
+
+def ensure_runs_table(cursor):
+    cursor.execute(SCHEMA_SQL)
+
+
+def write_plan(cursor, runs, service_date):
+    """Assign every run with a driver in one UPDATE; returns the trip_ids actually assigned.
+
+    Trips that were assigned or changed meanwhile, or whose driver picked up
+    an overlapping trip outside this plan, are skipped by the UPDATE.
+    """
+    rows = []
+    for run in runs:
+        if run['driver_id'] is None:
+            continue
+        positions = {}
+        for stop in run['stops']:
+            positions.setdefault(stop['trip_id'], {})[stop['type']] = stop
+        for trip_id, stops in positions.items():
+            rows.append((trip_id, run['driver_id'], run['run_id'],
+                         stops['pickup']['sequence'], stops['dropoff']['sequence'],
+                         stops['pickup']['planned_time'], stops['dropoff']['planned_time']))
+    if not rows:
+        return set()
+
+    ensure_runs_table(cursor)
+    cursor.execute("""
+        IF OBJECT_ID('tempdb..#route_assign') IS NOT NULL DROP TABLE #route_assign;
+        IF OBJECT_ID('tempdb..#route_done') IS NOT NULL DROP TABLE #route_done;
+
+        SELECT TOP 0 t.trip_id, t.driver_id,
+               CAST(NULL AS NVARCHAR(40)) AS run_id,
+               CAST(NULL AS INT) AS pickup_sequence,
+               CAST(NULL AS INT) AS dropoff_sequence,
+               CAST(NULL AS DATETIME2(0)) AS planned_pickup,
+               CAST(NULL AS DATETIME2(0)) AS planned_dropoff
+        INTO #route_assign
+        FROM operations.trips t CROSS JOIN (SELECT 1 AS one) x;
+
+        SELECT TOP 0 t.trip_id
+        INTO #route_done
+        FROM operations.trips t CROSS JOIN (SELECT 1 AS one) x;
+    """)
+
+    cursor.fast_executemany = True
+    cursor.executemany("""
+        INSERT INTO #route_assign (trip_id, driver_id, run_id, pickup_sequence, dropoff_sequence,
+                                   planned_pickup, planned_dropoff)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    cursor.fast_executemany = False
+
+    cursor.execute("""
+        UPDATE t
+        SET driver_id = a.driver_id,
+            status = 'assigned',
+            updated_at = GETDATE()
+        OUTPUT INSERTED.trip_id INTO #route_done (trip_id)
+        FROM operations.trips t
+        INNER JOIN #route_assign a ON a.trip_id = t.trip_id
+        WHERE t.status = 'scheduled'
+          AND t.driver_id IS NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM operations.trips o WITH (UPDLOCK, HOLDLOCK)
+              WHERE o.driver_id = a.driver_id
+                AND o.trip_id <> t.trip_id
+                AND NOT EXISTS (SELECT 1 FROM #route_assign b WHERE b.trip_id = o.trip_id)
+                AND o.status NOT IN ('completed', 'cancelled', 'no_show')
+                AND o.scheduled_pickup_time > DATEADD(minute, -?, t.scheduled_pickup_time)
+                AND o.scheduled_pickup_time < DATEADD(minute, ?, t.scheduled_pickup_time)
+          );
+
+        DELETE r
+        FROM operations.trip_runs r
+        INNER JOIN #route_done d ON r.trip_id = CAST(d.trip_id AS NVARCHAR(50));
+
+        INSERT INTO operations.trip_runs (trip_id, run_id, service_date, driver_id, pickup_sequence,
+                                          dropoff_sequence, planned_pickup, planned_dropoff)
+        SELECT CAST(a.trip_id AS NVARCHAR(50)), a.run_id, ?, CAST(a.driver_id AS NVARCHAR(50)),
+               a.pickup_sequence, a.dropoff_sequence, a.planned_pickup, a.planned_dropoff
+        FROM #route_assign a
+        INNER JOIN #route_done d ON d.trip_id = a.trip_id;
+
+        SELECT trip_id FROM #route_done;
+    """, (DRIVER_TRIP_BLOCK_MINUTES, DRIVER_TRIP_BLOCK_MINUTES, service_date))
+
+    while cursor.description is None:
+        if not cursor.nextset():
+            break
+    assigned = {str(row[0]) for row in cursor.fetchall()} if cursor.description else set()
+
+    cursor.execute("DROP TABLE #route_assign; DROP TABLE #route_done;")
+    return assigned
+
+
+# ── ORCHESTRATION ─────────────────────────────────────────────────────────────
+def optimize_day(service_date, dry_run=False, search_seconds=ROUTE_SEARCH_SECONDS, progress=None):
+    """Plan (and unless dry_run, assign) the day's scheduled trips; returns a report dict"""
+    say = progress or (lambda message: None)
+    started = time.monotonic()
+    timings = {}
+
+    index = get_availability_index()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        index.ensure_fresh(cursor)
+        trips = load_trips(cursor, service_date)
+        cursor.close()
+    timings['load'] = time.monotonic() - started
+
+    routable, unknown = geocode_trips(trips)
+    say(f"{len(trips)} scheduled trips, {len(unknown)} with an address that could not be geocoded")
+
+    mark = time.monotonic()
+    planner = RunPlanner(routable, service_date)
+    timings['matrix'] = time.monotonic() - mark
+
+    mark = time.monotonic()
+    planner.build()
+    constructed = planner.total_cost()
+    timings['build'] = time.monotonic() - mark
+    say(f"Built {len(planner.runs)} runs in {timings['build']:.1f}s")
+
+    mark = time.monotonic()
+    planner.improve(search_seconds)
+    timings['search'] = time.monotonic() - mark
+    say(f"Local search: {len(planner.runs)} runs after {planner.stats['search_passes']} passes "
+        f"in {timings['search']:.1f}s")
+
+    mark = time.monotonic()
+    runs = planner.plan(plannable_drivers(index, service_date))
+    timings['drivers'] = time.monotonic() - mark
+
+    assigned = set()
+    if not dry_run and runs:
+        mark = time.monotonic()
+        trips_by_id = {str(t['trip_id']): t for t in routable}
+        driver_of = {}
+        for run in runs:
+            for stop in run['stops']:
+                driver_of[str(stop['trip_id'])] = run['driver_id']
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                assigned = write_plan(cursor, runs, service_date)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                index.invalidate()
+                raise
+            finally:
+                cursor.close()
+        for trip_id in assigned:
+            index.assign(trip_id, driver_of[trip_id], trips_by_id[trip_id]['pickup_time'])
+        publish_all([
+            trip_event('trip.assigned', trip_id, patient_id=trips_by_id[trip_id]['patient_id'],
+                       driver_id=driver_of[trip_id], pickup_address=trips_by_id[trip_id]['pickup_address'],
+                       pickup_time=trips_by_id[trip_id]['pickup_time'], status='assigned')
+            for trip_id in assigned
+        ])
+        timings['write'] = time.monotonic() - mark
+
+    with_driver = [run for run in runs if run['driver_id'] is not None]
+    direct = sum(planner.direct) + planner.run_cost * len(routable)
+    return {
+        'service_date': service_date.isoformat(),
+        'dry_run': dry_run,
+        'trips': len(trips),
+        'routable_trips': len(routable),
+        'ungeocoded_trip_ids': [str(t['trip_id']) for t in unknown],
+        'runs': len(runs),
+        'shared_runs': sum(1 for run in runs if run['trips'] > 1),
+        'trips_per_run': round(len(routable) / len(runs), 2) if runs else 0,
+        'runs_with_driver': len(with_driver),
+        'runs_without_driver': len(runs) - len(with_driver),
+        'trips_assigned': len(assigned),
+        'cost_minutes': {
+            'one_run_per_trip': round(direct, 1),
+            'constructed': round(constructed, 1),
+            'optimized': round(planner.total_cost(), 1)
+        },
+        'search': dict(planner.stats),
+        'timings_seconds': {name: round(value, 2) for name, value in timings.items()},
+        'elapsed_seconds': round(time.monotonic() - started, 2),
+        'plan': runs
+    }
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+# ── ROUTES ────────────────────────────────────────────────────────────────────
+@route_optimizer_bp.route('/api/dispatch/optimize-runs', methods=['POST'])
+def optimize_runs():
+    """Build shared-ride runs for a day and assign them (dry_run: plan only)"""
+    try:
+        data = request.json or {}
+        try:
+            service_date = datetime.strptime(data['date'], '%Y-%m-%d').date() if data.get('date') \
+                else date.today() + timedelta(days=1)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'date must be YYYY-MM-DD'}), 400
+        search_seconds = min(float(data.get('time_limit') or ROUTE_SEARCH_SECONDS), 120.0)
+
+        if not _optimize_lock.acquire(blocking=False):
+            return jsonify({'success': False, 'error': 'An optimization is already running'}), 409
+        try:
+            report = optimize_day(service_date, dry_run=bool(data.get('dry_run')), search_seconds=search_seconds)
+        finally:
+            _optimize_lock.release()
+
+        return jsonify(dict(report, success=True))
+
+    except Exception as e:
+        print(f"Run optimizer error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+def main():
+    parser = argparse.ArgumentParser(description='Build shared-ride runs for a day of scheduled trips')
+    parser.add_argument('--date', help='Service date YYYY-MM-DD (default: tomorrow)')
+    parser.add_argument('--dry-run', action='store_true', help='Plan only, do not assign drivers')
+    parser.add_argument('--time-limit', type=float, default=ROUTE_SEARCH_SECONDS,
+                        help=f'Seconds of local search (default: {ROUTE_SEARCH_SECONDS:g})')
+    parser.add_argument('--report', help='Write the full plan as JSON to this file')
+    args = parser.parse_args()
+
+    service_date = (datetime.strptime(args.date, '%Y-%m-%d').date() if args.date
+                    else date.today() + timedelta(days=1))
+    report = optimize_day(service_date, dry_run=args.dry_run, search_seconds=args.time_limit, progress=print)
+
+    cost = report['cost_minutes']
+    print(f"\n{report['routable_trips']} trips -> {report['runs']} runs "
+          f"({report['shared_runs']} shared, {report['trips_per_run']} trips/run)")
+    print(f"Cost (travel + run minutes): {cost['one_run_per_trip']} one-per-trip, "
+          f"{cost['constructed']} constructed, {cost['optimized']} optimized")
+    print(f"Runs without a driver: {report['runs_without_driver']}")
+    if not args.dry_run:
+        print(f"Trips assigned: {report['trips_assigned']}")
+    print(f"Elapsed: {report['elapsed_seconds']}s")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, default=_json_default)
+        print(f"Report written to {args.report}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+In-process snapshot cache for expensive, read-mostly API payloads.
+
+A snapshot is fresh for `ttl` seconds.  After that, and for up to
+`stale_ttl` more seconds, readers are served the stale snapshot immediately
+while a single background thread recomputes it (stale-while-revalidate).
+Only when there is no usable snapshot at all does a reader compute it
+inline, and concurrent readers of the same key wait for that one
+computation instead of each running their own.
+"""
+
+import threading
+import time
+
+
+class SnapshotCache:
+    """Keyed snapshot cache with TTL, stale-while-revalidate and single-flight loads"""
+
+    def __init__(self, ttl, stale_ttl=None, name='snapshot'):
+        self.ttl = ttl
+        self.stale_ttl = ttl * 5 if stale_ttl is None else stale_ttl
+        self.name = name
+        self._lock = threading.Lock()
+        self._entries = {}       # key -> (value, computed_at)
+        self._inflight = {}      # key -> threading.Event
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+
+    def get(self, key, loader):
+        """Return the snapshot for `key`, calling `loader()` when it must be (re)computed"""
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    value, computed_at = entry
+                    age = now - computed_at
+                    if age < self.ttl:
+                        self._stats['hits'] += 1
+                        return value
+                    if age < self.ttl + self.stale_ttl:
+                        self._stats['stale_hits'] += 1
+                        if key not in self._inflight:
+                            self._inflight[key] = threading.Event()
+                            threading.Thread(
+                                target=self._refresh, args=(key, loader),
+                                name=f'{self.name}-refresh', daemon=True
+                            ).start()
+                        return value
+
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    self._stats['misses'] += 1
+                    break
+
+            # Someone else is computing it; wait, then re-read
+            event.wait()
+
+        try:
+            value = loader()
+            with self._lock:
+                self._entries[key] = (value, time.monotonic())
+            return value
+        except Exception:
+            with self._lock:
+                self._stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def _refresh(self, key, loader):
+        try:
+            value = loader()
+            with self._lock:
+                self._entries[key] = (value, time.monotonic())
+                self._stats['refreshes'] += 1
+        except Exception as e:
+            # Keep serving the stale snapshot; the next stale read retries
+            with self._lock:
+                self._stats['errors'] += 1
+            print(f"{self.name} refresh failed: {str(e)}")
+        finally:
+            with self._lock:
+                event = self._inflight.pop(key, None)
+            if event is not None:
+                event.set()
+
+    def age(self, key):
+        """Seconds since `key` was computed, or None if it is not cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+        return None if entry is None else time.monotonic() - entry[1]
+
+    def invalidate(self, key=None):
+        """Drop one snapshot, or all of them"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        stats['ttl'] = self.ttl
+        stats['stale_ttl'] = self.stale_ttl
+        return stats
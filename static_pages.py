@@ -0,0 +1,182 @@
+"""
+Precompressed, cache-validated serving of the dashboard's HTML pages.
+
+Pages are read from disk once (at startup via preload(), or on first hit),
+and kept in memory with their gzip and brotli variants and strong ETags.
+A request then costs a dict lookup: Accept-Encoding picks the smallest
+variant the client accepts, and If-None-Match gets a 304.
+
+Every worker notices changed files on its own: a page whose file was not
+checked for STATIC_PAGE_CHECK_SECONDS gets one os.stat() on its next
+request and is re-read if its mtime moved.  reload() forces that check for
+every page in the worker that handles POST /internal/static-pages/reload
+(guarded by STATIC_RELOAD_TOKEN).
+"""
+
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+from flask import Response, request
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_PAGE_MAX_AGE = int(os.environ.get('STATIC_PAGE_MAX_AGE', 300))
+STATIC_PAGE_CHECK_SECONDS = float(os.environ.get('STATIC_PAGE_CHECK_SECONDS', 5))
+
+# Smallest first: preferred when the client accepts several
+ENCODING_PREFERENCE = ('br', 'gzip')
+
+
+class StaticPage:
+    """One file with its precomputed encodings: {encoding: (body, etag)}"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.mtime = os.stat(path).st_mtime
+        self.checked_at = time.monotonic()
+        self.mimetype = 'text/html' if path.endswith('.html') else 'application/octet-stream'
+
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {'identity': (body, digest)}
+
+        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants['gzip'] = (compressed, f'{digest}-gz')
+
+        if BROTLI_AVAILABLE:
+            compressed = brotli.compress(body, quality=11, mode=brotli.MODE_TEXT)
+            if len(compressed) < len(body):
+                self.variants['br'] = (compressed, f'{digest}-br')
+
+    def etags(self):
+        return [etag for _, etag in self.variants.values()]
+
+
+def parse_accept_encoding(header):
+    """Encodings the client accepts with q > 0"""
+    accepted = set()
+    for part in (header or '').split(','):
+        pieces = part.strip().split(';')
+        coding = pieces[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in pieces[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(coding)
+    if '*' in accepted:
+        accepted.update(ENCODING_PREFERENCE)
+    return accepted
+
+
+class StaticPageCache:
+    """In-memory store of StaticPage objects keyed by their path relative to BASE_DIR"""
+
+    def __init__(self, base_dir=BASE_DIR, max_age=STATIC_PAGE_MAX_AGE, check_seconds=STATIC_PAGE_CHECK_SECONDS):
+        self.base_dir = base_dir
+        self.max_age = max_age
+        self.check_seconds = check_seconds
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def _resolve(self, filename):
+        path = os.path.normpath(os.path.join(self.base_dir, filename))
+        if not path.startswith(self.base_dir + os.sep):
+            raise FileNotFoundError(filename)
+        return path
+
+    def load(self, filename):
+        page = StaticPage(self._resolve(filename))
+        with self._lock:
+            self._pages[filename] = page
+        return page
+
+    def preload(self, filenames):
+        """Load pages at startup; missing files are reported, not fatal"""
+        for filename in filenames:
+            try:
+                self.load(filename)
+            except FileNotFoundError:
+                print(f"Static page not found, will 404: {filename}")
+
+    def _refresh(self, filename, page):
+        """Re-read a page if its file changed; returns the current page (None if it is gone)"""
+        page.checked_at = time.monotonic()
+        try:
+            if os.stat(page.path).st_mtime != page.mtime:
+                return self.load(filename)
+        except FileNotFoundError:
+            with self._lock:
+                self._pages.pop(filename, None)
+            return None
+        return page
+
+    def reload(self):
+        """Re-read pages whose file changed on disk; returns the reloaded names"""
+        reloaded = []
+        for filename, page in list(self._pages.items()):
+            if self._refresh(filename, page) is not page:
+                reloaded.append(filename)
+        return reloaded
+
+    def get(self, filename):
+        page = self._pages.get(filename)
+        if page is not None and time.monotonic() - page.checked_at > self.check_seconds:
+            page = self._refresh(filename, page)
+        if page is None:
+            page = self.load(filename)
+        return page
+
+    def serve(self, filename):
+        """Response for `filename`, negotiated on Accept-Encoding and If-None-Match"""
+        try:
+            page = self.get(filename)
+        except FileNotFoundError:
+            return Response('Not Found', status=404, mimetype='text/plain')
+
+        accepted = parse_accept_encoding(request.headers.get('Accept-Encoding'))
+        encoding = next((e for e in ENCODING_PREFERENCE if e in accepted and e in page.variants), 'identity')
+        body, etag = page.variants[encoding]
+
+        headers = {
+            'ETag': f'"{etag}"',
+            'Vary': 'Accept-Encoding',
+            'Cache-Control': f'public, max-age={self.max_age}'
+        }
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+
+        if request.if_none_match and any(request.if_none_match.contains(tag) for tag in page.etags()):
+            return Response(status=304, headers=headers)
+
+        return Response(body, mimetype=page.mimetype, headers=headers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {encoding: len(body) for encoding, (body, _) in page.variants.items()}
+                for name, page in self._pages.items()
+            }
+
+
+pages = StaticPageCache()
+
+
+def serve(filename):
+    return pages.serve(filename)
@@ -0,0 +1,519 @@
+"""
+Driver GPS telemetry ingestion.
+
+The driver app posts batches of location pings to POST /api/telemetry/pings,
+either as compact JSON:
+
+    {"driver_id": "...", "pings": [[epoch_seconds, lat, lon, speed_mph, heading, accuracy_m], ...]}
+    {"batches": [{"driver_id": "...", "pings": [...]}, ...]}      (several drivers)
+
+(speed, heading and accuracy may be omitted or null), or as binary frames
+(Content-Type: application/octet-stream), one or more per body:
+
+    header  '<2sBBH'  magic b'GT', version 1, driver_id length, ping count
+    driver_id         utf-8
+    pings   '<dffHHH' epoch seconds, lat, lon, speed (0.1 mph), heading (deg),
+                      accuracy (m); 0xFFFF means unknown
+
+Accepted pings go into a per-driver ring buffer (latest position and recent
+track, in memory) and onto a pending list that a background thread writes to
+operations.driver_locations with fast_executemany, every
+TELEMETRY_FLUSH_SECONDS or as soon as TELEMETRY_FLUSH_ROWS are waiting.
+Every flush also upserts each driver's newest fix into the node-local store,
+so latest-position reads see pings that landed on other gunicorn workers.
+
+Backpressure: while more than TELEMETRY_MAX_PENDING rows are unwritten (the
+database is slow or down; failed flushes are retried with backoff) new
+batches get 503 + Retry-After, and the app keeps them in its own buffer.
+Speed, heading and accuracy outside what their columns can hold are stored
+as NULL; a batch the database still rejects as bad data is split until the
+offending rows are found, and those are discarded instead of retried.
+"""
+
+import atexit
+import json
+import math
+import os
+import struct
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import pyodbc
+from flask import Blueprint, jsonify, request
+
+import metrics
+from database import db_connection
+from local_store import get_store, transaction
+
+telemetry_bp = Blueprint('telemetry', __name__)
+
+# ── CONFIG ────────────────────────────────────────────────────────────────────
+TELEMETRY_RING_SIZE = int(os.environ.get('TELEMETRY_RING_SIZE', 120))
+TELEMETRY_FLUSH_ROWS = int(os.environ.get('TELEMETRY_FLUSH_ROWS', 2000))
+TELEMETRY_FLUSH_SECONDS = float(os.environ.get('TELEMETRY_FLUSH_SECONDS', 2))
+TELEMETRY_MAX_PENDING = int(os.environ.get('TELEMETRY_MAX_PENDING', 50000))
+TELEMETRY_INSERT_CHUNK = int(os.environ.get('TELEMETRY_INSERT_CHUNK', 1000))
+TELEMETRY_MAX_BODY_BYTES = int(os.environ.get('TELEMETRY_MAX_BODY_BYTES', 1024 * 1024))
+TELEMETRY_MAX_FUTURE_SECONDS = float(os.environ.get('TELEMETRY_MAX_FUTURE_SECONDS', 300))
+TELEMETRY_MAX_AGE_SECONDS = float(os.environ.get('TELEMETRY_MAX_AGE_SECONDS', 86400))
+TELEMETRY_STORE = os.environ.get('TELEMETRY_STORE', 'telemetry')
+
+FRAME_HEADER = struct.Struct('<2sBBH')
+FRAME_PING = struct.Struct('<dffHHH')
+FRAME_MAGIC = b'GT'
+UNKNOWN = 0xFFFF
+MAX_SPEED_MPH = 9999.9      # speed_mph DECIMAL(5, 1)
+MAX_ACCURACY_M = 32767      # accuracy_m SMALLINT
+
+SCHEMA_SQL = """
+    IF OBJECT_ID('operations.driver_locations') IS NULL
+    BEGIN
+        CREATE TABLE operations.driver_locations (
+            location_id  BIGINT IDENTITY(1, 1) NOT NULL,
+            driver_id    NVARCHAR(50) NOT NULL,
+            recorded_at  DATETIME2(3) NOT NULL,
+            latitude     DECIMAL(9, 6) NOT NULL,
+            longitude    DECIMAL(9, 6) NOT NULL,
+            speed_mph    DECIMAL(5, 1) NULL,
+            heading      SMALLINT NULL,
+            accuracy_m   SMALLINT NULL,
+            received_at  DATETIME2(3) NOT NULL DEFAULT SYSUTCDATETIME(),
+            CONSTRAINT PK_driver_locations PRIMARY KEY (location_id)
+        );
+        CREATE INDEX IX_driver_locations_driver ON operations.driver_locations (driver_id, recorded_at);
+    END
+"""
+
+INSERT_SQL = """
+    INSERT INTO operations.driver_locations
+        (driver_id, recorded_at, latitude, longitude, speed_mph, heading, accuracy_m)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+LATEST_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS latest (
+        driver_id    TEXT PRIMARY KEY,
+        recorded_at  REAL NOT NULL,
+        latitude     REAL NOT NULL,
+        longitude    REAL NOT NULL,
+        speed_mph    REAL,
+        heading      INTEGER,
+        accuracy_m   INTEGER
+    );
+"""
+
+PINGS = metrics.counter('telemetry_pings_total', 'GPS pings received', ('outcome',))
+PENDING_ROWS = metrics.gauge('telemetry_pending_rows', 'GPS pings waiting to be written')
+
+
+# ── PARSING ───────────────────────────────────────────────────────────────────
+def _valid(ping, now):
+    t, lat, lon = ping[0], ping[1], ping[2]
+    return (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0 and not (lat == 0.0 and lon == 0.0)
+            and now - TELEMETRY_MAX_AGE_SECONDS <= t <= now + TELEMETRY_MAX_FUTURE_SECONDS)
+
+
+def _optional(value):
+    return None if value is None or value == UNKNOWN else value
+
+
+def _bounded(value, low, high):
+    """value as a float when it lies in [low, high], else None (NaN included)"""
+    if value is None:
+        return None
+    value = float(value)
+    return value if low <= value <= high else None
+
+
+def _make_ping(t, lat, lon, speed, heading, accuracy):
+    """Ping tuple with the optional fields fitted to their columns or set to None"""
+    speed = _bounded(speed, 0.0, MAX_SPEED_MPH)
+    heading = _bounded(heading, -360.0, 360.0)
+    accuracy = _bounded(accuracy, 0.0, MAX_ACCURACY_M)
+    return (t, lat, lon,
+            round(speed, 1) if speed is not None else None,
+            int(heading) % 360 if heading is not None else None,
+            int(accuracy) if accuracy is not None else None)
+
+
+def parse_json_batches(payload):
+    """[(driver_id, [ping, ...])] and the number of invalid pings dropped"""
+    if not isinstance(payload, dict):
+        raise ValueError('Expected a JSON object')
+    batches = payload['batches'] if 'batches' in payload else [payload]
+    if not isinstance(batches, list):
+        raise ValueError('"batches" must be an array')
+
+    now = time.time()
+    parsed, invalid = [], 0
+    for batch in batches:
+        driver_id = str(batch.get('driver_id') or '').strip() if isinstance(batch, dict) else ''
+        pings = batch.get('pings') if isinstance(batch, dict) else None
+        if not driver_id or len(driver_id) > 50 or not isinstance(pings, list):
+            raise ValueError('Each batch needs a driver_id and a "pings" array')
+        good = []
+        for raw in pings:
+            try:
+                t = float(raw[0])
+                if t > 1e12:   # milliseconds
+                    t /= 1000.0
+                extra = list(raw[3:6]) + [None] * (6 - max(3, len(raw)))
+                ping = _make_ping(t, float(raw[1]), float(raw[2]), *extra)
+            except (TypeError, ValueError, IndexError):
+                invalid += 1
+                continue
+            if _valid(ping, now) and not math.isnan(ping[1] + ping[2]):
+                good.append(ping)
+            else:
+                invalid += 1
+        if good:
+            parsed.append((driver_id, good))
+    return parsed, invalid
+
+
+def parse_binary_frames(body):
+    """Same as parse_json_batches, for a body of binary frames"""
+    now = time.time()
+    parsed, invalid = [], 0
+    offset = 0
+    while offset < len(body):
+        magic, version, id_length, count = FRAME_HEADER.unpack_from(body, offset)
+        if magic != FRAME_MAGIC or version != 1:
+            raise ValueError(f'Bad frame header at byte {offset}')
+        offset += FRAME_HEADER.size
+        driver_id = body[offset:offset + id_length].decode('utf-8').strip()
+        offset += id_length
+        end = offset + count * FRAME_PING.size
+        if not driver_id or end > len(body):
+            raise ValueError(f'Truncated frame at byte {offset}')
+
+        good = []
+        for t, lat, lon, speed, heading, accuracy in FRAME_PING.iter_unpack(body[offset:end]):
+            ping = _make_ping(t, lat, lon, speed / 10.0 if speed != UNKNOWN else None,
+                              _optional(heading), _optional(accuracy))
+            if _valid(ping, now):
+                good.append(ping)
+            else:
+                invalid += 1
+        if good:
+            parsed.append((driver_id, good))
+        offset = end
+    return parsed, invalid
+
+
+def encode_binary_frame(driver_id, pings):
+    """Build one binary frame (used by tests and load generators)"""
+    encoded_id = driver_id.encode('utf-8')
+    parts = [FRAME_HEADER.pack(FRAME_MAGIC, 1, len(encoded_id), len(pings)), encoded_id]
+    for t, lat, lon, speed, heading, accuracy in pings:
+        parts.append(FRAME_PING.pack(
+            t, lat, lon,
+            UNKNOWN if speed is None else int(round(speed * 10)),
+            UNKNOWN if heading is None else int(heading),
+            UNKNOWN if accuracy is None else int(accuracy)
+        ))
+    return b''.join(parts)
+
+
+# ── INGESTOR ──────────────────────────────────────────────────────────────────
+def _position(driver_id, ping):
+    return {
+        'driver_id': driver_id,
+        'recorded_at': datetime.fromtimestamp(ping[0], timezone.utc).isoformat(),
+        'latitude': ping[1],
+        'longitude': ping[2],
+        'speed_mph': ping[3],
+        'heading': ping[4],
+        'accuracy_m': ping[5],
+        'age_seconds': round(max(0.0, time.time() - ping[0]), 1)
+    }
+
+
+class TelemetryIngestor:
+    """Per-driver ring buffers plus a bulk, backpressured writer to the database"""
+
+    def __init__(self, ring_size=TELEMETRY_RING_SIZE, flush_rows=TELEMETRY_FLUSH_ROWS,
+                 flush_seconds=TELEMETRY_FLUSH_SECONDS, max_pending=TELEMETRY_MAX_PENDING,
+                 store=TELEMETRY_STORE, connect=db_connection):
+        self.ring_size = ring_size
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.store = store
+        self._connect = connect
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rings = {}      # driver_id -> deque of pings
+        self._latest = {}     # driver_id -> newest ping
+        self._dirty = set()   # drivers whose newest ping is not in the local store yet
+        self._pending = []    # (driver_id, *ping) rows not yet written
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._started_pid = None
+        self._schema_ready = False
+        self._stats = {'accepted': 0, 'rejected': 0, 'written': 0, 'flushes': 0, 'flush_failures': 0,
+                       'discarded': 0}
+
+    def _db(self):
+        return get_store(self.store, LATEST_SCHEMA)
+
+    def ingest(self, batches):
+        """Buffer [(driver_id, pings)]; False (nothing taken) when the backlog is full"""
+        total = sum(len(pings) for _, pings in batches)
+        with self._lock:
+            if len(self._pending) + total > self.max_pending:
+                self._stats['rejected'] += total
+                return False
+            for driver_id, pings in batches:
+                ring = self._rings.get(driver_id)
+                if ring is None:
+                    ring = self._rings[driver_id] = deque(maxlen=self.ring_size)
+                ring.extend(pings)
+                newest = max(pings)
+                current = self._latest.get(driver_id)
+                if current is None or newest[0] >= current[0]:
+                    self._latest[driver_id] = newest
+                    self._dirty.add(driver_id)
+                self._pending.extend([(driver_id,) + ping for ping in pings])
+            self._stats['accepted'] += total
+            backlog = len(self._pending)
+        if backlog >= self.flush_rows:
+            self._wake.set()
+        return True
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    # ── reads ─────────────────────────────────────────────────────────────────
+    def recent(self, driver_id, limit=None):
+        """This worker's most recent pings for a driver, oldest first"""
+        with self._lock:
+            ring = list(self._rings.get(str(driver_id), ()))
+        return ring[-limit:] if limit else ring
+
+    def latest_position(self, driver_id):
+        driver_id = str(driver_id)
+        with self._lock:
+            ping = self._latest.get(driver_id)
+        row = self._db().execute(
+            'SELECT recorded_at, latitude, longitude, speed_mph, heading, accuracy_m FROM latest WHERE driver_id = ?',
+            (driver_id,)
+        ).fetchone()
+        if row is not None and (ping is None or row[0] > ping[0]):
+            ping = tuple(row)
+        return _position(driver_id, ping) if ping else None
+
+    def latest_fixes(self, max_age_seconds=None):
+        """Newest ping of every driver (all workers on this host): driver_id -> ping tuple"""
+        cutoff = time.time() - max_age_seconds if max_age_seconds else 0
+        pings = {row[0]: tuple(row[1:]) for row in self._db().execute(
+            'SELECT driver_id, recorded_at, latitude, longitude, speed_mph, heading, accuracy_m '
+            'FROM latest WHERE recorded_at >= ?', (cutoff,)
+        ).fetchall()}
+        with self._lock:
+            for driver_id, ping in self._latest.items():
+                if ping[0] >= cutoff and (driver_id not in pings or ping[0] > pings[driver_id][0]):
+                    pings[driver_id] = ping
+        return pings
+
+    def latest_positions(self, max_age_seconds=None):
+        """Newest known position of every driver, by driver_id"""
+        return {driver_id: _position(driver_id, ping)
+                for driver_id, ping in self.latest_fixes(max_age_seconds).items()}
+
+    # ── writes ────────────────────────────────────────────────────────────────
+    def _ensure_table(self, cursor):
+        if not self._schema_ready:
+            cursor.execute(SCHEMA_SQL)
+            self._schema_ready = True
+
+    def _write(self, rows):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            try:
+                self._ensure_table(cursor)
+                cursor.fast_executemany = True
+                for start in range(0, len(rows), TELEMETRY_INSERT_CHUNK):
+                    cursor.executemany(INSERT_SQL, [
+                        (driver_id, datetime.fromtimestamp(t, timezone.utc).replace(tzinfo=None),
+                         round(lat, 6), round(lon, 6), speed, heading, accuracy)
+                        for driver_id, t, lat, lon, speed, heading, accuracy
+                        in rows[start:start + TELEMETRY_INSERT_CHUNK]
+                    ])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def _publish_latest(self):
+        with self._lock:
+            latest = [(driver_id,) + self._latest[driver_id] for driver_id in self._dirty]
+            self._dirty = set()
+        if not latest:
+            return
+        db = self._db()
+        with transaction(db):
+            db.executemany("""
+                INSERT INTO latest (driver_id, recorded_at, latitude, longitude, speed_mph, heading, accuracy_m)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (driver_id) DO UPDATE SET
+                    recorded_at = excluded.recorded_at, latitude = excluded.latitude,
+                    longitude = excluded.longitude, speed_mph = excluded.speed_mph,
+                    heading = excluded.heading, accuracy_m = excluded.accuracy_m
+                WHERE excluded.recorded_at >= latest.recorded_at
+            """, latest)
+
+    def flush(self):
+        """Write everything pending in bulk; on failure the unwritten rows go back to the front"""
+        with self._flush_lock:
+            self._publish_latest()
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+            parts, written, discarded = [rows], 0, 0
+            try:
+                while parts:
+                    part = parts.pop()
+                    try:
+                        self._write(part)
+                        written += len(part)
+                    except pyodbc.DataError as e:
+                        # Retrying can't fix a value the column won't hold: split the
+                        # batch down to the offending rows and drop those
+                        if len(part) == 1:
+                            discarded += 1
+                            print(f"Telemetry ping discarded for driver {part[0][0]}: {str(e)}")
+                        else:
+                            middle = len(part) // 2
+                            parts += [part[middle:], part[:middle]]
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = part + [row for rest in reversed(parts) for row in rest]
+                    self._stats['flush_failures'] += 1
+                raise
+            finally:
+                with self._lock:
+                    self._stats['written'] += written
+                    self._stats['discarded'] += discarded
+            with self._lock:
+                self._stats['flushes'] += 1
+            return written
+
+    def _run(self):
+        backoff = 0.0
+        while not self._stopping.is_set():
+            self._wake.wait(backoff or self.flush_seconds)
+            self._wake.clear()
+            try:
+                self.flush()
+                backoff = 0.0
+            except Exception as e:
+                backoff = min(60.0, max(1.0, backoff * 2))
+                print(f"Telemetry flush error (retrying in {backoff:.0f}s): {str(e)}")
+
+    def start(self):
+        pid = os.getpid()
+        if self._started_pid == pid:
+            return
+        self._stopping.clear()
+        threading.Thread(target=self._run, name='telemetry-flush', daemon=True).start()
+        self._started_pid = pid
+
+    def stop(self, flush=True):
+        self._stopping.set()
+        self._wake.set()
+        self._started_pid = None
+        if flush:
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Telemetry final flush error: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending), drivers=len(self._rings))
+
+
+ingestor = TelemetryIngestor()
+metrics.register_collector(lambda: PENDING_ROWS.set(ingestor.pending()))
+
+
+def get_ingestor():
+    return ingestor
+
+
+def _stop_on_exit():
+    if ingestor._started_pid == os.getpid():
+        ingestor.stop()
+
+
+atexit.register(_stop_on_exit)
+
+
+# ── ROUTES ────────────────────────────────────────────────────────────────────
+@telemetry_bp.route('/api/telemetry/pings', methods=['POST'])
+def ingest_pings():
+    """Accept a batch of GPS pings (JSON or binary frames)"""
+    try:
+        if request.content_length and request.content_length > TELEMETRY_MAX_BODY_BYTES:
+            return jsonify({'success': False, 'error': 'Batch too large'}), 413
+
+        try:
+            if request.mimetype == 'application/octet-stream':
+                batches, invalid = parse_binary_frames(request.get_data())
+            else:
+                batches, invalid = parse_json_batches(json.loads(request.get_data() or b'null'))
+        except (ValueError, KeyError, struct.error, UnicodeDecodeError) as e:
+            return jsonify({'success': False, 'error': f'Invalid telemetry batch: {str(e)}'}), 400
+
+        accepted = sum(len(pings) for _, pings in batches)
+        if invalid:
+            PINGS.inc('invalid', amount=invalid)
+        if batches and not ingestor.ingest(batches):
+            PINGS.inc('rejected', amount=accepted)
+            response = jsonify({'success': False, 'error': 'Telemetry backlog full, retry later'})
+            response.headers['Retry-After'] = str(max(1, int(TELEMETRY_FLUSH_SECONDS * 2)))
+            return response, 503
+        PINGS.inc('accepted', amount=accepted)
+
+        return jsonify({'success': True, 'accepted': accepted, 'invalid': invalid}), 202
+
+    except Exception as e:
+        print(f"Telemetry ingest error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@telemetry_bp.route('/api/telemetry/drivers/<driver_id>/latest', methods=['GET'])
+def driver_latest_position(driver_id):
+    try:
+        position = ingestor.latest_position(driver_id)
+        if position is None:
+            return jsonify({'success': False, 'error': 'No position reported for this driver'}), 404
+        return jsonify({'success': True, 'position': position})
+    except Exception as e:
+        print(f"Telemetry read error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@telemetry_bp.route('/api/telemetry/positions', methods=['GET'])
+def latest_positions():
+    """Newest position of every driver; ?max_age=300 skips stale ones"""
+    try:
+        max_age = request.args.get('max_age', type=float)
+        positions = ingestor.latest_positions(max_age)
+        return jsonify({'success': True, 'count': len(positions), 'positions': list(positions.values())})
+    except Exception as e:
+        print(f"Telemetry read error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@telemetry_bp.route('/api/telemetry/stats', methods=['GET'])
+def telemetry_stats():
+    return jsonify(dict(ingestor.stats(), success=True))